@@ -1,5 +1,11 @@
+# tournament.sql needs PostgreSQL 12 or later, newer than the distribution's
 apt-get -qqy update
-apt-get -qqy install postgresql python-psycopg2
+apt-get -qqy install curl ca-certificates gnupg
+curl -fsSL https://www.postgresql.org/media/keys/ACCC4CF8.asc | apt-key add -
+echo "deb https://apt-archive.postgresql.org/pub/repos/apt bionic-pgdg main" \
+    > /etc/apt/sources.list.d/pgdg.list
+apt-get -qqy update
+apt-get -qqy install postgresql-12 python-psycopg2
 apt-get -qqy install python-flask python-sqlalchemy
 apt-get -qqy install python-pip
 pip install bleach
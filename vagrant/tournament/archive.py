@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+'''archive.py -- compact binary archives of tournaments
+
+exportTournament writes the players, registrations, matches and byes of a
+tournament to a file laid out in columns: fixed-width integer arrays
+followed by a string table of the names. TournamentArchive memory-maps
+such a file and exposes the columns as NumPy arrays without copying
+them, so that analysis tools can load a large archive at once and
+compute standings without a database. importTournament loads an archive
+back as a new tournament.
+
+File layout, all integers little-endian:
+
+    header          magic 'TRNARCH\\0', then uint32 version, players,
+                    matches, byes, names size and title size
+    player_ids      int32[players], increasing
+    name_offsets    uint32[players + 1], start of each name in the names
+    player_a        int32[matches]
+    player_b        int32[matches]
+    winner          int32[matches], 0 for a draw
+    bye_player      int32[byes]
+    names           UTF-8 names, concatenated
+    title           UTF-8 tournament name
+
+Matches and byes are in the order they were reported. Rounds aren't
+archived.
+
+Requires NumPy.
+
+Usage:
+    ./archive.py export tournament_id path
+    ./archive.py import path [--name NAME]
+    ./archive.py standings path
+
+'''
+
+import argparse
+import struct
+
+import numpy as np
+
+from tournament import (Session,
+                        playerStandings,
+                        registerPlayers,
+                        registerTournament,
+                        reportBye,
+                        reportMatches,
+                        tournamentByes,
+                        tournamentMatches,
+                        tournamentName)
+
+MAGIC = 'TRNARCH\0'
+VERSION = 1
+
+_HEADER = struct.Struct('<8s6I')
+_INT32 = np.dtype('<i4')
+_UINT32 = np.dtype('<u4')
+_BYTE = np.dtype('u1')
+
+
+def _encode(text):
+    return text.encode('utf-8') if isinstance(text, unicode) else text
+
+
+def exportTournament(tournament, path):
+    """Write a tournament to an archive file.
+
+    Args:
+        tournament: id of the tournament.
+        path: name of the file to write, replaced if it exists.
+
+    Raises:
+        ValueError if the tournament doesn't exist.
+    """
+    with Session():
+        title = tournamentName(tournament)
+        if title is None:
+            raise ValueError('No tournament %s' % tournament)
+        players = sorted((row[0], row[1]) for row in playerStandings(tournament))
+        matches = tournamentMatches(tournament)
+        byes = tournamentByes(tournament)
+
+    names = [_encode(name) for _, name in players]
+    title = _encode(title)
+    offsets = np.zeros(len(names) + 1, dtype=_UINT32)
+    np.cumsum([len(name) for name in names], out=offsets[1:])
+    columns = np.array([(a, b, w or 0) for a, b, w in matches],
+                       dtype=_INT32).reshape(len(matches), 3)
+
+    with open(path, 'wb') as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(players), len(matches), len(byes),
+                             int(offsets[-1]), len(title)))
+        f.write(np.array([p for p, _ in players], dtype=_INT32).tostring())
+        f.write(offsets.tostring())
+        for column in columns.T:
+            f.write(np.ascontiguousarray(column).tostring())
+        f.write(np.array(byes, dtype=_INT32).tostring())
+        f.write(''.join(names))
+        f.write(title)
+
+
+class TournamentArchive(object):
+    '''Read-only, memory-mapped view of an archive file
+
+    The integer columns are NumPy arrays over the mapped file; pages are
+    read from disk as they are first accessed. The file stays mapped as
+    long as any of the arrays is referenced.
+
+    Attributes:
+        title: name of the tournament.
+        player_ids, name_offsets, player_a, player_b, winner, bye_player:
+            the columns described in the module documentation.
+
+    Raises:
+        ValueError if the file isn't an archive of a known version.
+    '''
+
+    def __init__(self, path):
+        self._data = np.memmap(path, dtype=_BYTE, mode='r')
+        if len(self._data) < _HEADER.size:
+            raise ValueError('%s is not a tournament archive' % path)
+        (magic, version, players, matches, byes,
+         names_size, title_size) = _HEADER.unpack(self._data[:_HEADER.size].tostring())
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a tournament archive of version %d'
+                             % (path, VERSION))
+        self._offset = _HEADER.size
+        self.player_ids = self._column(_INT32, players)
+        self.name_offsets = self._column(_UINT32, players + 1)
+        self.player_a = self._column(_INT32, matches)
+        self.player_b = self._column(_INT32, matches)
+        self.winner = self._column(_INT32, matches)
+        self.bye_player = self._column(_INT32, byes)
+        self._names = self._column(_BYTE, names_size)
+        self.title = self._column(_BYTE, title_size).tostring()
+        if self._offset != len(self._data):
+            raise ValueError('%s is truncated or has trailing data' % path)
+
+    def _column(self, dtype, count):
+        start = self._offset
+        self._offset += dtype.itemsize * count
+        if self._offset > len(self._data):
+            raise ValueError('Tournament archive is truncated')
+        return self._data[start:self._offset].view(dtype)
+
+    def __len__(self):
+        return len(self.player_ids)
+
+    def name(self, i):
+        '''Return the name of the i-th player, in player_ids order'''
+        return self._names[self.name_offsets[i]:self.name_offsets[i + 1]].tostring()
+
+    def names(self):
+        '''Return the list of player names, in player_ids order'''
+        text = self._names.tostring()
+        offsets = self.name_offsets.tolist()
+        return [text[offsets[i]:offsets[i + 1]] for i in xrange(len(self))]
+
+    def standings(self):
+        """Compute the standings of the archived tournament.
+
+        Returns:
+            A list of (id, name, wins, draws, matches, points) tuples
+            ordered like playerStandings, with the archived player ids.
+        """
+        n = len(self)
+        ids = self.player_ids
+        a = np.searchsorted(ids, self.player_a)
+        b = np.searchsorted(ids, self.player_b)
+        draw = self.winner == 0
+        wins = (np.bincount(np.searchsorted(ids, self.winner[~draw]), minlength=n) +
+                np.bincount(np.searchsorted(ids, self.bye_player), minlength=n))
+        draws = np.bincount(a[draw], minlength=n) + np.bincount(b[draw], minlength=n)
+        matches = np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+        points = 2 * wins + draws
+        order = np.lexsort((ids, -wins, -points))
+        names = self.names()
+        return [(int(ids[i]), names[i], int(wins[i]), int(draws[i]),
+                 int(matches[i]), int(points[i])) for i in order]
+
+
+def importTournament(path, name=None):
+    """Load an archive file as a new tournament.
+
+    The players are registered anew, so they get new ids. Everything is
+    stored in one transaction.
+
+    Args:
+        path: name of the archive file.
+        name: name of the new tournament. Defaults to the archived one.
+
+    Returns:
+        id of the new tournament
+
+    Raises:
+        ValueError if the file isn't a valid archive.
+    """
+    archive = TournamentArchive(path)
+    with Session():
+        tournament = registerTournament(archive.title if name is None else name)
+        new_ids = dict(zip(archive.player_ids.tolist(),
+                           registerPlayers(archive.names(), (tournament,))))
+        reportMatches(tournament,
+                      [(new_ids[a], new_ids[b], new_ids.get(w))
+                       for a, b, w in zip(archive.player_a.tolist(),
+                                          archive.player_b.tolist(),
+                                          archive.winner.tolist())])
+        for player in archive.bye_player.tolist():
+            reportBye(new_ids[player], tournament)
+    return tournament
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command')
+    export = commands.add_parser('export', help='write a tournament to an archive')
+    export.add_argument('tournament', type=int)
+    export.add_argument('path')
+    load = commands.add_parser('import', help='load an archive as a new tournament')
+    load.add_argument('path')
+    load.add_argument('--name')
+    show = commands.add_parser('standings', help='print the standings of an archive')
+    show.add_argument('path')
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        exportTournament(args.tournament, args.path)
+    elif args.command == 'import':
+        print importTournament(args.path, args.name)
+    else:
+        print '%8s %-30s %5s %5s %7s %6s' % ('id', 'name', 'wins', 'draws',
+                                            'matches', 'points')
+        for row in TournamentArchive(args.path).standings():
+            print '%8d %-30s %5d %5d %7d %6d' % row
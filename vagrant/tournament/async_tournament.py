@@ -0,0 +1,340 @@
+'''async_tournament.py -- asyncio counterpart of tournament.py
+
+Coroutine versions of the tournament operations a web process serves most:
+registration, match reports, standings, pairings and the deletes. They run
+the same statements as tournament.py, on aiopg (psycopg2 in asynchronous
+mode) with a pool of their own, so a single event loop can keep many
+queries in flight instead of blocking a thread on each.
+
+Requires Python 3.5+ and aiopg. The rest of the package stays on Python 2;
+tournament.py is imported for its statements, error messages and the
+pairing engine only.
+
+Example:
+
+    import asyncio
+    import async_tournament as at
+
+    async def main():
+        await at.configurePool(maxsize=20)
+        tournament = await at.registerTournament('Open')
+        ...
+        await at.closePool()
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+Writes also invalidate the cache of tournament.py (see configureCache),
+so processes that mix both modules don't serve stale standings. Reads
+here always go to the database.
+
+'''
+
+import asyncio
+import functools
+import itertools
+import random
+
+import aiopg
+from psycopg2 import IntegrityError
+from psycopg2.extensions import TransactionRollbackError
+
+from pairing import pairKey, pairPlayers
+from tournament import (DBNAME,
+                        POOL_MINCONN,
+                        POOL_MAXCONN,
+                        RETRY_BACKOFF,
+                        TRANSIENT_RETRIES,
+                        _DELETE_ALL,
+                        _DELETE_TOURNAMENT,
+                        _HAD_BYE_QUERY,
+                        _INSERT_MATCH,
+                        _INSERT_PLAYER,
+                        _INSERT_REGISTRATION,
+                        _MATCH_CONSTRAINT_ERRORS,
+                        _PAIRING_QUERY,
+                        _PLAYED_PAIRS_QUERY,
+                        _STANDINGS_QUERY,
+                        _constraintName,
+                        _invalidate,
+                        _log)
+
+# Seconds to wait for a pooled connection before giving up.
+POOL_TIMEOUT = 30
+
+_pool = None
+_pool_lock = None
+
+
+def _lock():
+    # Created on first use, within the running event loop
+    global _pool_lock
+    if _pool_lock is None:
+        _pool_lock = asyncio.Lock()
+    return _pool_lock
+
+
+async def configurePool(database_name=DBNAME,
+                        minsize=POOL_MINCONN,
+                        maxsize=POOL_MAXCONN,
+                        timeout=POOL_TIMEOUT):
+    """(Re)create the connection pool used by the coroutines of this module.
+
+    Any existing pool is closed. If this is never called, a pool with the
+    default settings is created on first use.
+
+    Args:
+        database_name: name of the database to connect to.
+        minsize: number of connections kept open when idle.
+        maxsize: maximum number of simultaneous connections.
+        timeout: seconds to wait for a free connection.
+
+    Returns:
+        The new aiopg.Pool
+    """
+    global _pool
+    async with _lock():
+        if _pool is not None:
+            _pool.close()
+            await _pool.wait_closed()
+        _pool = await aiopg.create_pool("dbname=%s" % database_name,
+                                        minsize=minsize,
+                                        maxsize=maxsize,
+                                        timeout=timeout)
+    return _pool
+
+
+async def closePool():
+    """Close all pooled connections. A new pool is created on next use."""
+    global _pool
+    async with _lock():
+        if _pool is not None:
+            _pool.close()
+            await _pool.wait_closed()
+        _pool = None
+
+
+async def _getPool():
+    if _pool is None:
+        await configurePool()
+    return _pool
+
+
+async def _execute(statements):
+    '''Run (query, vals) statements in one transaction
+
+    Returns:
+        Rows fetched by each statement, None for those returning no rows.
+    '''
+    pool = await _getPool()
+    results = []
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            async with cur.begin():
+                for query, vals in statements:
+                    await cur.execute(query, vals)
+                    results.append(await cur.fetchall() if cur.description else None)
+    return results
+
+
+async def _select(query, vals=()):
+    return (await _execute([(query, vals)]))[0]
+
+
+def _retried(func):
+    '''Decorator retrying a coroutine that lost a deadlock or serialization
+    conflict, as tournament._retried, sleeping without blocking the loop'''
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        for attempt in itertools.count(1):
+            try:
+                return await func(*args, **kwargs)
+            except TransactionRollbackError as e:
+                if attempt >= TRANSIENT_RETRIES:
+                    raise
+                _log.info('%s retried after %s', func.__name__, e.pgcode)
+                await asyncio.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+    return wrapper
+
+
+def _statements(statements, tournament=None):
+    '''(query, vals) pairs of the statements of a delete function'''
+    return [(statement, {'t': tournament}) for statement in statements]
+
+
+async def deleteTournaments(tournament=None):
+    """Remove tournaments, with their registrations, matches, byes and
+    rounds, from the database.
+
+    Args:
+        tournament: id of the tournament to remove. If None, all
+                    tournaments are removed.
+    """
+    if tournament is not None:
+        await _execute(_statements(_DELETE_TOURNAMENT['tournaments'], tournament))
+    else:
+        await _execute(_statements(_DELETE_ALL['tournaments']))
+    _invalidate(tournament)
+
+
+async def deleteMatches(tournament=None):
+    """Remove match records, byes and rounds from the database.
+
+    Args:
+        tournament: id of tournament whose matches must be deleted. If
+                    None, all matches are deleted.
+    """
+    if tournament is not None:
+        await _execute(_statements(_DELETE_TOURNAMENT['matches'], tournament))
+    else:
+        await _execute(_statements(_DELETE_ALL['matches']))
+    _invalidate(tournament)
+
+
+async def deleteTournamentPlayers(tournament=None):
+    """Remove tournament player registries from the database.
+
+    Args:
+        tournament: id of tournament whose player registry will be deleted.
+                    If None, all registries are deleted.
+    """
+    if tournament is not None:
+        await _execute(_statements(_DELETE_TOURNAMENT['tournament_players'], tournament))
+    else:
+        await _execute(_statements(_DELETE_ALL['tournament_players']))
+    _invalidate(tournament)
+
+
+async def deletePlayers():
+    """Remove all the player records from the database."""
+    await _execute(_statements(_DELETE_ALL['players']))
+    _invalidate()
+
+
+async def resetAll():
+    """Remove all players and tournaments, and everything about them,
+    from the database, in one transaction."""
+    await _execute(_statements(_DELETE_ALL['everything']))
+    _invalidate()
+
+
+async def registerTournament(name):
+    """Adds a tournament to the tournament database.
+
+    Returns:
+        id of the registered tournament
+    """
+    rows = await _select('INSERT INTO tournaments(name) VALUES (%s) RETURNING id', (name,))
+    return rows[0][0]
+
+
+async def registerPlayer(name, tournaments=()):
+    """Adds a player to the global tournament database.
+
+    The player and their registrations are inserted in one transaction.
+
+    Args:
+      name: the player's full name (need not be unique).
+      tournaments(optional): Iterable with IDs of tournaments to which this
+      player should be registered.
+
+    Returns:
+        ID of registered player
+
+    Raises:
+        IntegrityError if a registration failed.
+    """
+    tournaments = list(tournaments)
+    pool = await _getPool()
+    async with pool.acquire() as conn:
+        async with conn.cursor() as cur:
+            async with cur.begin():
+                await cur.execute(_INSERT_PLAYER, (name,))
+                player_id = (await cur.fetchone())[0]
+                for tournament_id in tournaments:
+                    await cur.execute(_INSERT_REGISTRATION, (player_id, tournament_id))
+    for tournament_id in tournaments:
+        _invalidate(tournament_id)
+    return player_id
+
+
+async def registerPlayerToTournament(player_id, tournament_id):
+    '''Register an existing player to a tournament
+
+    Raises:
+        IntegrityError if registration failed.
+    '''
+    await _execute([(_INSERT_REGISTRATION, (player_id, tournament_id))])
+    _invalidate(tournament_id)
+
+
+async def playerStandings(tournament):
+    """Returns the standings of a tournament, as tournament.playerStandings.
+
+    Returns:
+      A list of (id, name, wins, draws, matches, points) tuples, the
+      leader first.
+    """
+    return await _select(_STANDINGS_QUERY, (tournament,))
+
+
+@_retried
+async def reportMatch(player_a, player_b, winner=None, tournament=None):
+    """Records the outcome of a single match between two players.
+
+    Deadlocks with other reports are retried.
+
+    Args:
+      player_a:  the id number of the first player
+      player_b:  the id number of the second player
+      winner: the id of the winner. None in case of draw.
+      tournament: id of the tournament the match is being played in.
+
+    Returns:
+        id of the match
+
+    Raises:
+        ValueError if players already played each other in this tournament.
+        ValueError if either player isn't registered in the tournament.
+        IntegrityError if player_a == player_b.
+        IntegrityError if winner is not player_a or player_b or None.
+    """
+    try:
+        rows = await _select(_INSERT_MATCH, (tournament, player_a, player_b, winner))
+    except IntegrityError as e:
+        message = _MATCH_CONSTRAINT_ERRORS.get(_constraintName(e))
+        if message is None:
+            raise
+        raise ValueError(message % {'a': player_a, 'b': player_b, 't': tournament})
+    _invalidate(tournament, [(player_a, player_b)])
+    return rows[0][0]
+
+
+async def swissPairings(tournament):
+    """Returns the pairings of the next round, as tournament.swissPairings.
+
+    Standings, played pairs and byes are read in one transaction; the
+    pairing itself runs in the event loop's default executor so that
+    large fields don't stall other coroutines.
+
+    Returns:
+      A list of (id1, name1, id2, name2) tuples, the last one with None
+      as opponent if a player gets a bye.
+
+    Raises:
+        ValueError if every possible pairing includes a rematch.
+    """
+    standings, played, byes = await _execute([(_PAIRING_QUERY, (tournament,)),
+                                              (_PLAYED_PAIRS_QUERY, (tournament,)),
+                                              (_HAD_BYE_QUERY, (tournament,))])
+    played = set(pairKey(a, b) for a, b in played)
+    had_bye = set(row[0] for row in byes)
+
+    loop = asyncio.get_event_loop()
+    pairs, bye = await loop.run_in_executor(
+        None, pairPlayers, [row[0] for row in standings], played, had_bye)
+
+    names = dict((row[0], row[1]) for row in standings)
+    pairings = [(a, names[a], b, names[b]) for a, b in pairs]
+    if bye is not None:
+        pairings.append((bye, names[bye], None, None))
+    return pairings
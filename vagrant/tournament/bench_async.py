@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+'''bench_async.py -- requests/sec of tournament.py vs async_tournament.py
+
+Creates a tournament with a few rounds played, then runs N concurrent
+clients against it for a fixed time: N threads sharing the connection pool
+of tournament.py, and N tasks on one event loop sharing the pool of
+async_tournament.py. Each client issues one request after another. Both
+pools are sized to the number of clients. The tournament and its players
+are removed at the end.
+
+Requires Python 3.5+ and aiopg, like async_tournament.py.
+
+Usage:
+    ./bench_async.py [--clients 1 10 50] [--seconds 5]
+                     [--request standings|pairings|report] [--players 200]
+
+'''
+
+import argparse
+import asyncio
+import threading
+import time
+
+import async_tournament
+import tournament
+
+
+async def setUp(players, rounds):
+    '''Register a tournament and play a few rounds'''
+    t = await async_tournament.registerTournament('bench_async')
+    ids = await asyncio.gather(*[async_tournament.registerPlayer('Player %d' % i, (t,))
+                                 for i in range(players)])
+    for _ in range(rounds):
+        await asyncio.gather(*[async_tournament.reportMatch(id1, id2, id1, t)
+                               for (id1, _, id2, _) in await async_tournament.swissPairings(t)
+                               if id2 is not None])
+    return t, list(ids)
+
+
+async def newTournament(ids):
+    '''Register ids to a new tournament for the report requests
+
+    Returns:
+        Tuple of the tournament id and an iterator over (a, b, winner, t)
+        arguments of every match between the players, none of which has
+        been played yet.
+    '''
+    t = await async_tournament.registerTournament('bench_async')
+    await asyncio.gather(*[async_tournament.registerPlayerToTournament(p, t)
+                           for p in ids])
+    return t, iter([(a, b, a, t) for i, a in enumerate(ids) for b in ids[i + 1:]])
+
+
+def tearDown(tournaments, ids):
+    with tournament.Session() as session:
+        for t in tournaments:
+            tournament.deleteTournaments(t)
+        session.cursor().execute('DELETE FROM players WHERE id = ANY(%s)', (ids,))
+
+
+def runSync(request, clients, seconds):
+    '''Returns requests completed by clients threads in seconds'''
+    tournament.configurePool(minconn=clients, maxconn=clients)
+    done = [0] * clients
+    deadline = time.time() + seconds
+
+    def client(k):
+        while time.time() < deadline:
+            request()
+            done[k] += 1
+
+    threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    tournament.closePool()
+    return sum(done)
+
+
+async def runAsync(request, clients, seconds):
+    '''Returns requests completed by clients tasks in seconds'''
+    await async_tournament.configurePool(minsize=clients, maxsize=clients)
+    done = [0] * clients
+    deadline = time.time() + seconds
+
+    async def client(k):
+        while time.time() < deadline:
+            await request()
+            done[k] += 1
+
+    await asyncio.gather(*[client(k) for k in range(clients)])
+    await async_tournament.closePool()
+    return sum(done)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50])
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--request', choices=['standings', 'pairings', 'report'],
+                        default='standings')
+    parser.add_argument('--players', type=int, default=200)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    t, ids = loop.run_until_complete(setUp(args.players, args.rounds))
+    tournaments = [t]
+    matches = None
+    lock = threading.Lock()
+
+    def nextMatch():
+        with lock:
+            try:
+                return next(matches)
+            except StopIteration:
+                raise RuntimeError('Ran out of unplayed pairs, use more --players')
+
+    sync_requests = {
+        'standings': lambda: tournament.playerStandings(t),
+        'pairings': lambda: tournament.swissPairings(t),
+        'report': lambda: tournament.reportMatch(*nextMatch()),
+    }
+    async_requests = {
+        'standings': lambda: async_tournament.playerStandings(t),
+        'pairings': lambda: async_tournament.swissPairings(t),
+        'report': lambda: async_tournament.reportMatch(*nextMatch()),
+    }
+
+    try:
+        print('%8s %12s %12s' % ('clients', 'sync req/s', 'async req/s'))
+        for clients in args.clients:
+            rates = []
+            for run in (runSync, runAsync):
+                if args.request == 'report':
+                    report_t, matches = loop.run_until_complete(newTournament(ids))
+                    tournaments.append(report_t)
+                if run is runSync:
+                    done = runSync(sync_requests[args.request], clients, args.seconds)
+                else:
+                    done = loop.run_until_complete(
+                        runAsync(async_requests[args.request], clients, args.seconds))
+                rates.append(done / args.seconds)
+            print('%8d %12.0f %12.0f' % (clients, rates[0], rates[1]))
+    finally:
+        loop.run_until_complete(async_tournament.closePool())
+        tearDown(tournaments, ids)
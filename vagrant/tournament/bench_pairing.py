@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+'''bench_pairing.py -- time the Swiss pairing engine against field size
+
+Simulates tournaments with random results entirely in memory and prints
+the time taken by pairing.pairPlayers for every round. No database is
+needed.
+
+Usage:
+    ./bench_pairing.py [--sizes 100 1000 10000] [--rounds 11] [--seed 1]
+
+'''
+
+import argparse
+import random
+import time
+
+from pairing import pairKey, pairPlayers
+
+
+def simulate(n, rounds, rng):
+    '''Play rounds of an n-player tournament, returning pairing times'''
+    points = [0] * n
+    wins = [0] * n
+    played = set()
+    had_bye = set()
+    timings = []
+    for _ in xrange(rounds):
+        ranked = sorted(xrange(n), key=lambda p: (-points[p], -wins[p]))
+        start = time.time()
+        pairs, bye = pairPlayers(ranked, played, had_bye)
+        timings.append(time.time() - start)
+
+        for a, b in pairs:
+            played.add(pairKey(a, b))
+            r = rng.random()
+            if r < 0.45:
+                points[a] += 2
+                wins[a] += 1
+            elif r < 0.9:
+                points[b] += 2
+                wins[b] += 1
+            else:
+                points[a] += 1
+                points[b] += 1
+        if bye is not None:
+            had_bye.add(bye)
+            points[bye] += 2
+            wins[bye] += 1
+    return timings
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[100, 1000, 10000, 10001])
+    parser.add_argument('--rounds', type=int, default=11)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    print '%8s  %s  %10s' % ('players',
+                             ' '.join('%7s' % ('R%d' % (r + 1))
+                                      for r in xrange(args.rounds)),
+                             'total (s)')
+    for n in args.sizes:
+        timings = simulate(n, args.rounds, rng)
+        print '%8d  %s  %10.3f' % (n,
+                                   ' '.join('%7.3f' % t for t in timings),
+                                   sum(timings))
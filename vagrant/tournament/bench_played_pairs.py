@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''bench_played_pairs.py -- memory and lookup times of the played-pairs index
+
+Registers a synthetic tournament of --players players and reports
+--rounds random rounds of matches, then compares the ways of telling
+whether two players have met:
+
+    index       played_pairs.PlayedPairs, as used by havePlayed with the
+                cache enabled
+    tuple set   set of pairKey tuples, as swissPairings builds
+    SQL         SELECT EXISTS over matches, as havePlayed without the cache
+                or inside a Session
+
+and prints the time to build each in-memory structure from the database,
+its approximate size, and the latency of havePlayed and opponents. The
+tournament and players are removed at the end.
+
+Usage:
+    ./bench_played_pairs.py [--players 10000] [--rounds 10] [--lookups 100000]
+                            [--queries 2000] [--seed 1]
+
+'''
+
+import argparse
+import random
+import sys
+import time
+
+from pairing import pairKey
+from played_pairs import PlayedPairs
+from tournament import (_PLAYED_PAIRS_QUERY,
+                        Session,
+                        _select,
+                        configureCache,
+                        deleteTournaments,
+                        havePlayed,
+                        opponents,
+                        registerPlayers,
+                        registerTournament,
+                        reportMatches)
+
+
+def setUp(players, rounds, rng):
+    '''Register a tournament and report random rounds without rematches'''
+    t = registerTournament('bench_played_pairs')
+    ids = registerPlayers(['Player %d' % i for i in xrange(players)], (t,))
+    played = set()
+    for _ in xrange(rounds):
+        rng.shuffle(ids)
+        results = []
+        for a, b in zip(ids[0::2], ids[1::2]):
+            if pairKey(a, b) not in played:
+                played.add(pairKey(a, b))
+                results.append((a, b, rng.choice((a, b, None))))
+        reportMatches(t, results)
+    return t, ids, sorted(played)
+
+
+def deepSize(obj, seen=None):
+    '''Approximate bytes used by obj and the containers and numbers in it'''
+    seen = set() if seen is None else seen
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deepSize(k, seen) + deepSize(v, seen) for k, v in obj.iteritems())
+    elif isinstance(obj, (set, frozenset, tuple, list)):
+        size += sum(deepSize(item, seen) for item in obj)
+    elif isinstance(obj, PlayedPairs):
+        size += deepSize(obj._keys, seen) + deepSize(obj._opponents, seen)
+    return size
+
+
+def perCall(call, args):
+    '''Return the mean time of call(*a) for a in args, in microseconds'''
+    start = time.time()
+    for a in args:
+        call(*a)
+    return (time.time() - start) / len(args) * 1e6
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=10000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--lookups', type=int, default=100000)
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    t, ids, pairs = setUp(args.players, args.rounds, rng)
+    try:
+        start = time.time()
+        rows = _select(_PLAYED_PAIRS_QUERY, (t,))
+        query = time.time() - start
+        start = time.time()
+        index = PlayedPairs(rows)
+        index_build = time.time() - start
+        start = time.time()
+        tuples = set(pairKey(a, b) for a, b in rows)
+        tuples_build = time.time() - start
+
+        # Half the lookups are pairs that met, half random pairs
+        lookups = ([rng.choice(pairs) for _ in xrange(args.lookups // 2)] +
+                   [tuple(rng.sample(ids, 2)) for _ in xrange(args.lookups // 2)])
+        rng.shuffle(lookups)
+        players = [(rng.choice(ids),) for _ in xrange(args.lookups)]
+
+        print '%d players, %d matches; played pairs query %.0fms' % (
+            len(ids), len(pairs), query * 1e3)
+        print '%-12s %10s %10s %14s %14s' % ('', 'build ms', 'size MB',
+                                             'havePlayed us', 'opponents us')
+        print '%-12s %10.0f %10.2f %14.3f %14.3f' % (
+            'index', index_build * 1e3, deepSize(index) / 1e6,
+            perCall(index.havePlayed, lookups),
+            perCall(index.opponents, players))
+        print '%-12s %10.0f %10.2f %14.3f %14s' % (
+            'tuple set', tuples_build * 1e3, deepSize(tuples) / 1e6,
+            perCall(lambda a, b: pairKey(a, b) in tuples, lookups), '-')
+        # Through the module: the index with the cache, SQL inside a Session
+        configureCache()
+        print '%-12s %10s %10s %14.3f %14.3f' % (
+            'havePlayed', '', '',
+            perCall(lambda a, b: havePlayed(t, a, b), lookups),
+            perCall(lambda p: opponents(t, p), players))
+        with Session(commit=False):
+            print '%-12s %10s %10s %14.1f %14.1f' % (
+                'SQL', '', '',
+                perCall(lambda a, b: havePlayed(t, a, b), lookups[:args.queries]),
+                perCall(lambda p: opponents(t, p), players[:args.queries]))
+    finally:
+        with Session() as session:
+            deleteTournaments(t)
+            session.cursor().execute('DELETE FROM players WHERE id = ANY(%s)', (ids,))
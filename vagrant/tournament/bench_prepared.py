@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+'''bench_prepared.py -- latency of reportMatch and playerStandings with and
+without prepared statements
+
+Registers a synthetic tournament, then times single calls of reportMatch
+and playerStandings (the read cache is off) on a one-connection pool with
+prepared statements disabled and on one with them enabled. The pool's
+health check is off, so that each call makes one round trip. Modes
+alternate over --repeat runs. The tournaments and players are removed at
+the end.
+
+Usage:
+    ./bench_prepared.py [--players 200] [--calls 2000] [--repeat 2]
+
+'''
+
+import argparse
+import time
+
+from tournament import (Session,
+                        configurePool,
+                        deleteTournaments,
+                        playerStandings,
+                        registerPlayers,
+                        registerTournament,
+                        reportMatch)
+
+
+def timeCalls(call, args):
+    '''Return the sorted latencies, in microseconds, of call(*a) for a in args'''
+    latencies = []
+    for a in args:
+        start = time.time()
+        call(*a)
+        latencies.append((time.time() - start) * 1e6)
+    return sorted(latencies)
+
+
+def summary(latencies):
+    n = len(latencies)
+    return '%8.0f %8.0f %8.0f' % (sum(latencies) / n,
+                                  latencies[n // 2],
+                                  latencies[int(n * 0.95)])
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=200)
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=2)
+    args = parser.parse_args()
+
+    tournaments = []
+    player_ids = []
+    try:
+        print '%-28s %8s %8s %8s' % ('call (microseconds)', 'mean', 'median', 'p95')
+        for prepared in [False, True] * args.repeat:
+            # One connection, so that every call reuses its statements
+            configurePool(minconn=1, maxconn=1, health_check=False,
+                          prepared_statements=prepared)
+            t = registerTournament('bench_prepared')
+            tournaments.append(t)
+            ids = registerPlayers(['Player %d' % i for i in xrange(args.players)], (t,))
+            player_ids.extend(ids)
+            pairs = [(a, b, a, t) for i, a in enumerate(ids) for b in ids[i + 1:]]
+            label = 'prepared' if prepared else 'unprepared'
+            print '%-28s %s' % ('reportMatch, ' + label,
+                                summary(timeCalls(reportMatch, pairs[:args.calls])))
+            print '%-28s %s' % ('playerStandings, ' + label,
+                                summary(timeCalls(playerStandings, [(t,)] * args.calls)))
+    finally:
+        with Session() as session:
+            for t in tournaments:
+                deleteTournaments(t)
+            session.cursor().execute('DELETE FROM players WHERE id = ANY(%s)', (player_ids,))
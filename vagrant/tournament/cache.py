@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''cache.py -- thread-safe LRU cache with hit/miss statistics
+
+'''
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    '''Bounded mapping that evicts the least recently used entry
+
+    Args:
+        maxsize: maximum number of entries kept.
+    '''
+
+    def __init__(self, maxsize=128):
+        if maxsize < 1:
+            raise ValueError('Invalid cache size %s' % maxsize)
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation, so that values loaded concurrently
+        # with a write are not stored after the write invalidated them.
+        self._epoch = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_load(self, key, load):
+        '''Return the value cached for key, calling load() on a miss'''
+        with self._lock:
+            if key in self._data:
+                value = self._data.pop(key)
+                self._data[key] = value
+                self.hits += 1
+                return value
+            self.misses += 1
+            epoch = self._epoch
+
+        value = load()
+
+        with self._lock:
+            if epoch == self._epoch:
+                self._data[key] = value
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def discard(self, *keys):
+        '''Remove keys from the cache, if present'''
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                self._data.pop(key, None)
+
+    def clear(self):
+        '''Remove all entries'''
+        with self._lock:
+            self._epoch += 1
+            self._data.clear()
+
+    def stats(self):
+        '''Return a dict with the hits, misses, evictions and current size'''
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self._data),
+                    'maxsize': self.maxsize}
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+'''explain_queries.py -- EXPLAIN ANALYZE the queries issued by tournament.py
+
+Loads a synthetic tournament (by default 20,000 players over 10 rounds,
+i.e. 100,000 matches) into the database used by tournament.py, then prints
+the plan and timing of each statement the module issues. Statements that
+modify data are analyzed inside a transaction that is rolled back.
+
+The synthetic tournament and its players are removed at the end unless
+--keep is given. Other data in the database is left alone.
+
+Usage:
+    ./explain_queries.py [--players 20000] [--rounds 10] [--seed 1] [--keep]
+
+'''
+
+import argparse
+import random
+import re
+import time
+
+from tournament import (_BULK_DELETE,
+                        _COUNT_PLAYERS,
+                        _DELETE_TOURNAMENT,
+                        _HAD_BYE_QUERY,
+                        _HAVE_PLAYED_QUERY,
+                        _INSERT_BYE,
+                        _INSERT_MATCH,
+                        _MATCH_COUNT_QUERY,
+                        _OPPONENTS_QUERY,
+                        _PAIRING_QUERY,
+                        _PLAYED_BY_QUERY,
+                        _PLAYED_PAIRS_QUERY,
+                        _RANK_QUERY,
+                        _REGISTERED_QUERY,
+                        _ROUND_STANDINGS_QUERY,
+                        _SNAPSHOT_STANDINGS,
+                        _STANDINGS_DIFF_QUERY,
+                        _STANDINGS_PAGE_QUERY,
+                        _STANDINGS_QUERY,
+                        _TIEBREAKS_QUERY,
+                        _TOURNAMENT_PLAYERS_QUERY,
+                        Session,
+                        closeRound,
+                        deleteTournaments,
+                        registerPlayers,
+                        registerTournament,
+                        reportBye,
+                        reportMatches,
+                        startRound,
+                        swissPairings)
+
+
+# (label, statement, parameters) for the queries of tournament.py.
+# Parameters name samples: t is the tournament, r a closed round, open the
+# open last round, batch a list of player ids, a and b two registered
+# players who haven't played each other, null None. They are a tuple of
+# sample names for positional statements, a dict of parameter name to
+# sample name for named ones. The TRUNCATEs of the delete functions can't
+# be explained and are left out.
+QUERIES = [
+    ('countPlayers', _COUNT_PLAYERS, ()),
+    ('tournamentPlayers', _TOURNAMENT_PLAYERS_QUERY, ('t',)),
+    ('playerStandings', _STANDINGS_QUERY, ('t',)),
+    ('playerStandings (top 20)', _STANDINGS_PAGE_QUERY, ('t', 'limit', 'offset')),
+    ('playerRank', _RANK_QUERY, {'t': 't', 'p': 'a'}),
+    ('playerStandings (tie-breaks)', _TIEBREAKS_QUERY, {'t': 't'}),
+    ('roundStandings', _ROUND_STANDINGS_QUERY, ('t', 'r')),
+    ('closeRound (snapshot)', _SNAPSHOT_STANDINGS, ('open', 't')),
+    ('rebuildStandings(t)', _STANDINGS_DIFF_QUERY, {'t': 't'}),
+    ('rebuildStandings()', _STANDINGS_DIFF_QUERY, {'t': 'null'}),
+    ('swissPairings (order)', _PAIRING_QUERY, ('t',)),
+    ('swissPairings (played pairs)', _PLAYED_PAIRS_QUERY, ('t',)),
+    ('swissPairings (index check)', _MATCH_COUNT_QUERY, ('t',)),
+    ('swissPairings (byes)', _HAD_BYE_QUERY, ('t',)),
+    ('havePlayed', _HAVE_PLAYED_QUERY, {'t': 't', 'a': 'a', 'b': 'b'}),
+    ('opponents', _OPPONENTS_QUERY, {'t': 't', 'p': 'a'}),
+    ('reportMatches (registration check)', _REGISTERED_QUERY, {'t': 't', 'players': 'batch'}),
+    ('reportMatches (rematch check)', _PLAYED_BY_QUERY, {'t': 't', 'players': 'batch'}),
+    ('reportMatch', _INSERT_MATCH, ('t', 'a', 'b', 'a')),
+    ('reportBye', _INSERT_BYE, ('t', 'a')),
+    ('deleteMatches(t)', _DELETE_TOURNAMENT['matches'][1], {'t': 't'}),
+    ('deleteTournamentPlayers(t)', _DELETE_TOURNAMENT['tournament_players'][1], {'t': 't'}),
+    ('deleteTournaments(t)', _DELETE_TOURNAMENT['tournaments'][1], {'t': 't'}),
+]
+
+
+def bind(parameters, samples):
+    '''Return the parameters of a QUERIES entry with the samples' values'''
+    if isinstance(parameters, dict):
+        return dict((name, samples[sample]) for name, sample in parameters.items())
+    return tuple(samples[sample] for sample in parameters)
+
+
+def load(players, rounds, rng):
+    '''Create and play a synthetic tournament through the module API'''
+    tournament = registerTournament('explain_queries')
+    ids = registerPlayers(['Player %d' % i for i in xrange(players)], (tournament,))
+    for round_number in xrange(rounds):
+        start = time.time()
+        startRound(tournament)
+        results = []
+        for (id1, _, id2, _) in swissPairings(tournament):
+            if id2 is None:
+                reportBye(id1, tournament)
+                continue
+            r = rng.random()
+            results.append((id1, id2, id1 if r < 0.45 else id2 if r < 0.9 else None))
+        reportMatches(tournament, results)
+        # The last round stays open, for the closeRound statement
+        if round_number < rounds - 1:
+            closeRound(tournament)
+        print 'round %d: %d matches in %.2fs' % (round_number + 1, len(results),
+                                                 time.time() - start)
+    # Two players without matches, for the statements that insert one
+    extra = registerPlayers(['Explain A', 'Explain B'], (tournament,))
+    return tournament, ids + extra
+
+
+def explain(label, statement, params):
+    '''Print the analyzed plan of statement, rolled back. Returns ms.'''
+    with Session(commit=False) as session:
+        cur = session.cursor()
+        # As set by the delete functions; it only changes DELETEs
+        cur.execute(_BULK_DELETE)
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + statement, params)
+        plan = [row[0] for row in cur.fetchall()]
+    print '=' * 78
+    print label
+    print '-' * 78
+    print '\n'.join(plan)
+    for line in plan:
+        match = re.match(r'\s*(?:Total runtime|Execution time): ([\d.]+) ms', line, re.I)
+        if match:
+            return float(match.group(1))
+    return None
+
+
+def cleanup(tournament, player_ids):
+    deleteTournaments(tournament)
+    with Session() as session:
+        cur = session.cursor()
+        cur.execute('DELETE FROM players WHERE id = ANY(%s)', (player_ids,))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--players', type=int, default=20000)
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the synthetic tournament in the database')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    tournament, player_ids = load(args.players, args.rounds, rng)
+    with Session() as session:
+        session.cursor().execute('ANALYZE')
+
+    samples = {'t': tournament,
+               'r': max(1, args.rounds // 2),
+               'open': args.rounds,
+               'batch': rng.sample(player_ids[:-2], min(1000, len(player_ids) - 2)),
+               'a': player_ids[-2],
+               'b': player_ids[-1],
+               'limit': 20,
+               'offset': 0,
+               'null': None}
+    try:
+        timings = [(label, explain(label, statement, bind(parameters, samples)))
+                   for label, statement, parameters in QUERIES]
+    finally:
+        if not args.keep:
+            cleanup(tournament, player_ids)
+
+    print '=' * 78
+    print '%-50s %12s' % ('query', 'time (ms)')
+    for label, ms in timings:
+        print '%-50s %12s' % (label, '?' if ms is None else '%.3f' % ms)
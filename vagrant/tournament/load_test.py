@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+'''load_test.py -- concurrent clients playing out a full event day
+
+Registers --tournaments tournaments of --players players each and plays
+--rounds Swiss rounds in all of them at once, with --clients client
+threads in each of --processes processes. Tournaments are split between
+the processes. Clients take operations from a shared queue:
+
+    swissPairings     once per round, when the previous round is complete
+    reportMatch       once per pairing, reportBye for the bye
+    playerStandings   --reads of them per reported match, as spectators
+                      refreshing the standings while the round is played
+
+so that, as on the day of an event, reads and writes of every tournament
+interleave and the next round is paired as soon as its last result is in.
+Results are drawn at random, --draws of them drawn.
+
+Prints, as JSON, the configuration, the git revision of the tree, the wall
+time and, per operation and in total, the number of calls, calls per
+second, errors by type and the mean, p50, p95, p99 and maximum latency in
+milliseconds, so that runs on different versions can be compared. Exits
+with status 1 if any call failed. The tournaments and players are removed
+at the end.
+
+Usage:
+    ./load_test.py [--tournaments 4] [--players 64] [--rounds 6]
+                   [--clients 8] [--processes 1] [--reads 4] [--draws 0.1]
+                   [--cache 0] [--memory] [--output FILE] [--seed 1]
+
+'''
+
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+from Queue import Queue
+
+import tournament
+from tournament import (Session,
+                        closePool,
+                        configureCache,
+                        configurePool,
+                        deleteTournaments,
+                        registerPlayers,
+                        registerTournament)
+
+OPERATIONS = ('swissPairings', 'reportMatch', 'reportBye', 'playerStandings')
+
+
+def setUp(tournaments, players):
+    '''Register the tournaments and their players
+
+    Returns:
+        List of the tournament ids and list of the player ids.
+    '''
+    ids = []
+    player_ids = []
+    for i in xrange(tournaments):
+        t = registerTournament('load_test %d' % i)
+        ids.append(t)
+        player_ids.extend(registerPlayers(['Player %d.%d' % (i, k) for k in xrange(players)],
+                                          (t,)))
+    return ids, player_ids
+
+
+class EventDay(object):
+    '''Operations of the rounds of some tournaments, and their timings
+
+    Args:
+        tournaments: ids of the tournaments to play.
+        rounds: number of rounds to play in each.
+        reads: playerStandings calls per reported match.
+        draws: probability that a match is drawn.
+        seed: seed of the random results.
+    '''
+
+    def __init__(self, tournaments, rounds, reads, draws, seed):
+        self.rounds = rounds
+        self.reads = reads
+        self.draws = draws
+        self._rng = random.Random(seed)
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._played = dict((t, 0) for t in tournaments)    # rounds paired
+        self._pending = dict((t, 0) for t in tournaments)   # reports left in the round
+        self._active = len(tournaments)
+        self.latencies = dict((op, []) for op in OPERATIONS)
+        self.errors = dict((op, {}) for op in OPERATIONS)
+        self._clients = 0
+        for t in tournaments:
+            self._queue.put(('swissPairings', t, (t,)))
+
+    def run(self, clients):
+        '''Play all rounds with clients threads, returning when done'''
+        if not self._active:
+            return
+        self._clients = clients
+        threads = [threading.Thread(target=self._client) for _ in xrange(clients)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def _client(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            op, t, args = task
+            start = time.time()
+            try:
+                result = getattr(tournament, op)(*args)
+            except Exception as e:
+                self._record(op, time.time() - start, type(e).__name__)
+                result = None
+            else:
+                self._record(op, time.time() - start)
+            if op == 'swissPairings':
+                self._startRound(t, result or [])
+            elif op in ('reportMatch', 'reportBye'):
+                self._reported(t)
+
+    def _record(self, op, seconds, error=None):
+        with self._lock:
+            self.latencies[op].append(seconds)
+            if error is not None:
+                self.errors[op][error] = self.errors[op].get(error, 0) + 1
+
+    def _startRound(self, t, pairings):
+        '''Queue the reports of a round, shuffled with the standings reads'''
+        with self._lock:
+            tasks = []
+            for a, _, b, _ in pairings:
+                if b is None:
+                    tasks.append(('reportBye', t, (a, t)))
+                    continue
+                roll = self._rng.random()
+                winner = None if roll < self.draws else (a if roll < (1 + self.draws) / 2 else b)
+                tasks.append(('reportMatch', t, (a, b, winner, t)))
+                tasks.extend([('playerStandings', t, (t,))] * self.reads)
+            self._rng.shuffle(tasks)
+            self._played[t] += 1
+            self._pending[t] = len(pairings)
+            # Queued under the lock, so that the clients can't be told to
+            # stop before the last reads of the round
+            for task in tasks:
+                self._queue.put(task)
+            if not pairings:
+                self._finish()
+
+    def _reported(self, t):
+        '''Count a report of t, pairing the next round after the last one'''
+        with self._lock:
+            self._pending[t] -= 1
+            if self._pending[t]:
+                return
+            if self._played[t] < self.rounds:
+                self._queue.put(('swissPairings', t, (t,)))
+            else:
+                self._finish()
+
+    def _finish(self):
+        # Called with the lock held. Queued reads of finished tournaments
+        # are still served before the clients stop.
+        self._active -= 1
+        if not self._active:
+            for _ in xrange(self._clients):
+                self._queue.put(None)
+
+    def timings(self):
+        return {'latencies': self.latencies, 'errors': self.errors}
+
+
+def play(tournaments, args, seed, results=None):
+    '''Play tournaments with args.clients threads
+
+    Puts the timings in the results queue if given, else returns them.
+    '''
+    if args.cache:
+        configureCache(args.cache)
+    if not args.memory:
+        configurePool(minconn=1, maxconn=args.clients)
+    day = EventDay(tournaments, args.rounds, args.reads, args.draws, seed)
+    day.run(args.clients)
+    if not args.memory:
+        closePool()
+    if results is None:
+        return day.timings()
+    results.put(day.timings())
+
+
+def percentile(latencies, q):
+    '''Return the q-quantile of sorted latencies, by the nearest rank'''
+    return latencies[max(0, int(math.ceil(q * len(latencies))) - 1)]
+
+
+def summary(latencies, errors, seconds):
+    '''Return the JSON figures of one operation, latencies in milliseconds'''
+    latencies = sorted(latencies)
+    figures = {'calls': len(latencies),
+               'calls_per_second': round(len(latencies) / seconds, 1),
+               'errors': sum(errors.values()),
+               'error_types': errors}
+    if not latencies:
+        # Same keys as with calls, so that reports can be compared
+        figures.update(dict.fromkeys(('mean_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms')))
+        return figures
+    ms = lambda s: round(s * 1e3, 3)
+    figures.update({'mean_ms': ms(sum(latencies) / len(latencies)),
+                    'p50_ms': ms(percentile(latencies, 0.50)),
+                    'p95_ms': ms(percentile(latencies, 0.95)),
+                    'p99_ms': ms(percentile(latencies, 0.99)),
+                    'max_ms': ms(latencies[-1])})
+    return figures
+
+
+def revision():
+    '''Return the git revision of this tree, None if unknown'''
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'describe', '--always', '--dirty'],
+                cwd=os.path.dirname(os.path.abspath(__file__)), stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def tearDown(tournaments, player_ids):
+    with Session() as session:
+        for t in tournaments:
+            deleteTournaments(t)
+        session.cursor().execute('DELETE FROM players WHERE id = ANY(%s)', (player_ids,))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tournaments', type=int, default=4)
+    parser.add_argument('--players', type=int, default=64)
+    parser.add_argument('--rounds', type=int, default=6)
+    parser.add_argument('--clients', type=int, default=8,
+                        help='client threads per process')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--reads', type=int, default=4,
+                        help='playerStandings calls per reported match')
+    parser.add_argument('--draws', type=float, default=0.1,
+                        help='fraction of drawn matches')
+    parser.add_argument('--cache', type=int, default=0,
+                        help='size of the read cache, 0 for none')
+    parser.add_argument('--memory', action='store_true',
+                        help='use the in-memory backend')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+    if args.memory and args.processes > 1:
+        parser.error('--memory keeps tournaments in one process, use --processes 1')
+
+    if args.memory:
+        from memory_backend import MemoryBackend
+        tournament.useBackend(MemoryBackend())
+    tournaments, player_ids = setUp(args.tournaments, args.players)
+    try:
+        start = time.time()
+        if args.processes > 1:
+            # Children open connections of their own
+            closePool()
+            results = multiprocessing.Queue()
+            processes = [multiprocessing.Process(target=play,
+                                                 args=(tournaments[k::args.processes], args,
+                                                       args.seed + k, results))
+                         for k in xrange(args.processes)]
+            for process in processes:
+                process.start()
+            timings = [results.get() for _ in processes]
+            for process in processes:
+                process.join()
+        else:
+            timings = [play(tournaments, args, args.seed)]
+        seconds = time.time() - start
+    finally:
+        if not args.memory:
+            tearDown(tournaments, player_ids)
+
+    operations = {}
+    everything = ([], {})
+    for op in OPERATIONS:
+        latencies = [s for t in timings for s in t['latencies'][op]]
+        errors = {}
+        for t in timings:
+            for error, count in t['errors'][op].items():
+                errors[error] = errors.get(error, 0) + count
+                everything[1][error] = everything[1].get(error, 0) + count
+        everything[0].extend(latencies)
+        operations[op] = summary(latencies, errors, seconds)
+
+    report = {'revision': revision(),
+              'backend': 'memory' if args.memory else 'postgresql',
+              'config': vars(args),
+              'seconds': round(seconds, 3),
+              'operations': operations,
+              'total': summary(everything[0], everything[1], seconds)}
+    text = json.dumps(report, indent=2, sort_keys=True, separators=(',', ': '))
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print text
+    sys.exit(1 if report['total']['errors'] else 0)
@@ -0,0 +1,597 @@
+#!/usr/bin/env python
+'''memory_backend.py -- in-memory storage engine for tournament.py
+
+Keeps players, tournaments, registrations, matches and byes in indexed
+Python dictionaries, with running standings updated on every result, and
+reproduces the results and errors of the PostgreSQL schema. Use it for
+simulations, what-if pairings and tests:
+
+    import tournament
+    from memory_backend import MemoryBackend
+
+    tournament.useBackend(MemoryBackend())
+
+'''
+
+import copy
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from psycopg2 import IntegrityError
+
+from pairing import pairKey, pairPlayers
+from tournament import (DuplicateRegistrationError,
+                        ELO_INITIAL,
+                        ELO_K,
+                        ELO_SCALE,
+                        MatchReportError,
+                        PairingError,
+                        _MATCH_CONSTRAINT_ERRORS,
+                        _withTiebreaks)
+
+
+# Indices into the running standings lists
+_WINS, _DRAWS, _LOSSES, _MATCHES, _POINTS = range(5)
+
+# Saved value of an entry that didn't exist, see MemoryBackend._touch
+_MISSING = object()
+
+
+class MemoryBackend(object):
+    '''Tournament storage held in process memory
+
+    All methods are thread-safe. Each public method is atomic, as the
+    corresponding PostgreSQL statements are.
+    '''
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._next_id = {'players': 1, 'tournaments': 1, 'matches': 1, 'byes': 1}
+        self._players = {}          # player id -> name
+        self._ratings = {}          # player id -> [rating, games]
+        self._tournaments = {}      # tournament id -> name
+        # tournament id -> OrderedDict(player id -> running standings list),
+        # in registration order
+        self._standings = {}
+        self._player_tournaments = {}   # player id -> set of tournament ids
+        self._matches = {}          # match id -> (tournament, a, b, winner)
+        self._tournament_matches = {}   # tournament id -> {pairKey: match id}
+        self._byes = {}             # bye id -> (tournament, player)
+        self._tournament_byes = {}  # tournament id -> {player id: [bye ids]}
+        # tournament id -> list with, per round, None while it's open and
+        # the standings snapshot {player id: standings list} once closed
+        self._rounds = {}
+        # Undo log of the running transaction, None outside of one:
+        # (state dict name, key) -> copy of the entry before the
+        # transaction, and state dict name -> copy of the whole dict
+        self._saved = None
+        self._saved_all = None
+
+    @contextmanager
+    def transaction(self, commit=True):
+        '''Run a block atomically, rolling it back if it raises
+
+        Other threads are blocked until the block ends. If commit is False
+        the changes are always rolled back. Only the entries the block
+        changes are copied, when first changed (see _touch).
+        '''
+        with self._lock:
+            if self._saved is not None:
+                # Part of the transaction already running in this thread
+                yield self
+                return
+            self._saved, self._saved_all = {}, {}
+            try:
+                yield self
+                if not commit:
+                    self._rollback()
+            except BaseException:
+                self._rollback()
+                raise
+            finally:
+                self._saved = self._saved_all = None
+
+    def _touch(self, name, key):
+        '''Save entry key of the state dict name before it changes, if in
+        a transaction and not saved yet'''
+        saved = self._saved
+        if saved is None or (name, key) in saved or name in self._saved_all:
+            return
+        value = getattr(self, name).get(key, _MISSING)
+        saved[name, key] = value if value is _MISSING else copy.deepcopy(value)
+
+    def _touchAll(self, name):
+        '''Save the whole state dict name before it changes, if in a
+        transaction and not saved yet'''
+        if self._saved is not None and name not in self._saved_all:
+            self._saved_all[name] = copy.deepcopy(getattr(self, name))
+
+    def _rollback(self):
+        for name, value in self._saved_all.items():
+            setattr(self, name, value)
+        # Entries saved before their whole dict hold older values
+        for (name, key), value in self._saved.items():
+            state = getattr(self, name)
+            if value is _MISSING:
+                state.pop(key, None)
+            else:
+                state[key] = value
+        self._saved, self._saved_all = {}, {}
+
+    def _newId(self, table):
+        self._touch('_next_id', table)
+        new_id = self._next_id[table]
+        self._next_id[table] += 1
+        return new_id
+
+    # Results
+
+    def _apply(self, tournament, a, b, winner, sign):
+        '''Add (sign = 1) or remove (sign = -1) a match from the standings'''
+        self._touch('_standings', tournament)
+        standings = self._standings[tournament]
+        for player in (a, b):
+            row = standings.get(player)
+            if row is None:
+                continue
+            row[_MATCHES] += sign
+            if winner is None:
+                row[_DRAWS] += sign
+                row[_POINTS] += sign
+            elif winner == player:
+                row[_WINS] += sign
+                row[_POINTS] += 2 * sign
+            else:
+                row[_LOSSES] += sign
+
+    def _applyBye(self, tournament, player, sign):
+        self._touch('_standings', tournament)
+        row = self._standings[tournament].get(player)
+        if row is not None:
+            row[_WINS] += sign
+            row[_POINTS] += 2 * sign
+
+    def _checkMatch(self, tournament, a, b, winner):
+        '''Raise the error the matches constraints would raise'''
+        if tournament is None or a is None or b is None:
+            raise IntegrityError('null value in matches violates not-null constraint')
+        if a == b:
+            raise IntegrityError('new row for relation "matches" violates check constraint')
+        if winner not in (a, b, None):
+            raise IntegrityError('new row for relation "matches" violates check constraint')
+        if pairKey(a, b) in self._tournament_matches.get(tournament, ()):
+            raise ValueError(_MATCH_CONSTRAINT_ERRORS['matches_pairing_unique']
+                             % {'a': a, 'b': b, 't': tournament})
+        standings = self._standings.get(tournament, ())
+        if a not in standings or b not in standings:
+            raise ValueError(_MATCH_CONSTRAINT_ERRORS['matches_player_a_registered']
+                             % {'a': a, 'b': b, 't': tournament})
+
+    def _insertMatch(self, tournament, a, b, winner):
+        match_id = self._newId('matches')
+        self._touch('_matches', match_id)
+        self._touch('_tournament_matches', tournament)
+        self._matches[match_id] = (tournament, a, b, winner)
+        self._tournament_matches[tournament][pairKey(a, b)] = match_id
+        self._apply(tournament, a, b, winner, 1)
+        self._rate(a, b, winner)
+        return match_id
+
+    def _rate(self, a, b, winner):
+        '''Elo update of the ratings of a and b, as matches_update_ratings'''
+        self._touch('_ratings', a)
+        self._touch('_ratings', b)
+        rating_a, rating_b = self._ratings[a], self._ratings[b]
+        score = 1.0 if winner == a else 0.5 if winner is None else 0.0
+        delta = ELO_K * (score - 1.0 / (1 + 10 ** ((rating_b[0] - rating_a[0]) / ELO_SCALE)))
+        rating_a[0] += delta
+        rating_b[0] -= delta
+        rating_a[1] += 1
+        rating_b[1] += 1
+
+    def _deleteMatchesOf(self, tournament, players=None):
+        '''Delete the matches and byes of a tournament
+
+        If players is given, only those involving one of them are deleted.
+        '''
+        players = None if players is None else set(players)
+        self._touch('_tournament_matches', tournament)
+        self._touch('_tournament_byes', tournament)
+        pairs = self._tournament_matches.get(tournament, {})
+        for key, match_id in list(pairs.items()):
+            if players is None or key[0] in players or key[1] in players:
+                self._touch('_matches', match_id)
+                self._apply(*self._matches.pop(match_id) + (-1,))
+                del pairs[key]
+        byes = self._tournament_byes.get(tournament, {})
+        for player, bye_ids in list(byes.items()):
+            if players is None or player in players:
+                for bye_id in bye_ids:
+                    self._touch('_byes', bye_id)
+                    del self._byes[bye_id]
+                    self._applyBye(tournament, player, -1)
+                del byes[player]
+
+    def _unregister(self, tournament, players):
+        self._deleteMatchesOf(tournament, players)
+        self._touch('_standings', tournament)
+        self._touch('_rounds', tournament)
+        standings = self._standings[tournament]
+        for player in players:
+            self._touch('_player_tournaments', player)
+            del standings[player]
+            self._player_tournaments[player].discard(tournament)
+            for snapshot in self._rounds.get(tournament, ()):
+                if snapshot is not None:
+                    snapshot.pop(player, None)
+
+    # Public API, see tournament.py for documentation
+
+    def deleteTournaments(self, tournament=None):
+        with self._lock:
+            tournaments = list(self._tournaments) if tournament is None else [tournament]
+            for t in tournaments:
+                if t not in self._tournaments:
+                    continue
+                self._unregister(t, list(self._standings[t]))
+                for state in ('_tournaments', '_standings', '_tournament_matches',
+                              '_tournament_byes', '_rounds'):
+                    self._touch(state, t)
+                del self._tournaments[t]
+                del self._standings[t]
+                del self._tournament_matches[t]
+                del self._tournament_byes[t]
+                self._rounds.pop(t, None)
+
+    def deleteMatches(self, tournament=None):
+        with self._lock:
+            tournaments = list(self._tournaments) if tournament is None else [tournament]
+            for t in tournaments:
+                self._deleteMatchesOf(t)
+                self._touch('_rounds', t)
+                self._rounds.pop(t, None)
+
+    def deleteTournamentPlayers(self, tournament=None):
+        with self._lock:
+            tournaments = list(self._tournaments) if tournament is None else [tournament]
+            for t in tournaments:
+                if t in self._standings:
+                    self._unregister(t, list(self._standings[t]))
+
+    def deletePlayers(self):
+        with self._lock:
+            for tournament, standings in self._standings.items():
+                self._unregister(tournament, list(standings))
+            for state in ('_players', '_ratings', '_player_tournaments'):
+                self._touchAll(state)
+            self._players.clear()
+            self._ratings.clear()
+            self._player_tournaments.clear()
+
+    def resetAll(self):
+        with self._lock:
+            self.deleteTournaments()
+            self.deletePlayers()
+
+    def countPlayers(self):
+        return len(self._players)
+
+    def registerTournament(self, name):
+        if name is None:
+            raise IntegrityError('null value in column "name" violates not-null constraint')
+        with self._lock:
+            tournament = self._newId('tournaments')
+            for state in ('_tournaments', '_standings', '_tournament_matches',
+                          '_tournament_byes'):
+                self._touch(state, tournament)
+            self._tournaments[tournament] = name
+            self._standings[tournament] = OrderedDict()
+            self._tournament_matches[tournament] = {}
+            self._tournament_byes[tournament] = {}
+            return tournament
+
+    def _insertPlayer(self, name):
+        if name is None:
+            raise IntegrityError('null value in column "name" violates not-null constraint')
+        player = self._newId('players')
+        for state in ('_players', '_ratings', '_player_tournaments'):
+            self._touch(state, player)
+        self._players[player] = name
+        self._ratings[player] = [float(ELO_INITIAL), 0]
+        self._player_tournaments[player] = set()
+        return player
+
+    def registerPlayer(self, name, tournaments=()):
+        with self._lock:
+            player = self._insertPlayer(name)
+        for tournament in tournaments:
+            self.registerPlayerToTournament(player, tournament)
+        return player
+
+    def registerPlayers(self, names, tournaments=()):
+        names = list(names)
+        tournaments = list(tournaments)
+        with self._lock:
+            # Validate everything first, so that nothing is stored on error
+            if None in names:
+                raise IntegrityError('null value in column "name" violates not-null constraint')
+            if names:
+                repeated = set(t for t in tournaments if tournaments.count(t) > 1)
+                if repeated:
+                    # Player ids that would have been assigned, as in SQL
+                    first = self._next_id['players']
+                    raise DuplicateRegistrationError(sorted(
+                        (first + i, t) for i in xrange(len(names)) for t in repeated))
+                for tournament in tournaments:
+                    if tournament not in self._tournaments:
+                        raise IntegrityError('insert on table "tournament_players" '
+                                             'violates foreign key constraint')
+            player_ids = [self._insertPlayer(name) for name in names]
+            for tournament in tournaments:
+                for player in player_ids:
+                    self._register(player, tournament)
+            return player_ids
+
+    def tournamentName(self, tournament):
+        return self._tournaments.get(tournament)
+
+    def tournamentPlayers(self, tournament):
+        with self._lock:
+            return tuple(self._standings.get(tournament, ()))
+
+    def tournamentMatches(self, tournament):
+        with self._lock:
+            match_ids = sorted(self._tournament_matches.get(tournament, {}).values())
+            return [self._matches[m][1:] for m in match_ids]
+
+    def tournamentByes(self, tournament):
+        with self._lock:
+            byes = [(bye_id, player)
+                    for player, bye_ids in self._tournament_byes.get(tournament, {}).items()
+                    for bye_id in bye_ids]
+            return [player for _, player in sorted(byes)]
+
+    def havePlayed(self, tournament, player_a, player_b):
+        return pairKey(player_a, player_b) in self._tournament_matches.get(tournament, {})
+
+    def opponents(self, tournament, player):
+        with self._lock:
+            return sorted(b if a == player else a
+                          for a, b in self._tournament_matches.get(tournament, {})
+                          if player in (a, b))
+
+    def _checkRegistration(self, player, tournament):
+        if player not in self._players or tournament not in self._tournaments:
+            raise IntegrityError('insert on table "tournament_players" violates foreign key constraint')
+
+    def _register(self, player, tournament):
+        self._touch('_standings', tournament)
+        self._touch('_player_tournaments', player)
+        self._standings[tournament][player] = [0, 0, 0, 0, 0]
+        self._player_tournaments[player].add(tournament)
+
+    def registerPlayerToTournament(self, player_id, tournament_id):
+        with self._lock:
+            self._checkRegistration(player_id, tournament_id)
+            if player_id in self._standings[tournament_id]:
+                raise IntegrityError('duplicate key value violates unique constraint '
+                                     '"tournament_players_pkey"')
+            self._register(player_id, tournament_id)
+
+    def registerPlayersToTournament(self, player_ids, tournament_id):
+        player_ids = list(player_ids)
+        if not player_ids:
+            return
+        with self._lock:
+            registered = self._standings.get(tournament_id, {})
+            seen = set()
+            duplicates = set()
+            for player in player_ids:
+                if player in seen or player in registered:
+                    duplicates.add((player, tournament_id))
+                seen.add(player)
+            if duplicates:
+                raise DuplicateRegistrationError(sorted(duplicates))
+            for player in player_ids:
+                self._checkRegistration(player, tournament_id)
+            for player in player_ids:
+                self._register(player, tournament_id)
+
+    def _sortedStandings(self, tournament):
+        rows = self._standings.get(tournament, {})
+        order = sorted(rows, key=lambda p: (-rows[p][_POINTS], -rows[p][_WINS], p))
+        return [(p, rows[p]) for p in order]
+
+    def playerStandings(self, tournament, limit=None, offset=0, tiebreaks=()):
+        with self._lock:
+            ranked = [(p, self._players[p], row[_WINS], row[_DRAWS], row[_MATCHES], row[_POINTS])
+                      for p, row in self._sortedStandings(tournament)]
+            if tiebreaks:
+                ranked = _withTiebreaks(ranked, self._tiebreaks(tournament), tiebreaks)
+            end = None if limit is None else offset + limit
+            return ranked[offset:end]
+
+    def _tiebreaks(self, tournament):
+        '''Every tie-break of every player with matches, as _TIEBREAKS_QUERY'''
+        points = dict((p, row[_POINTS]) for p, row in self._standings.get(tournament, {}).items())
+        games = {}
+        for match_id in self._tournament_matches.get(tournament, {}).values():
+            _, a, b, winner = self._matches[match_id]
+            for player, opponent in ((a, b), (b, a)):
+                score = 1 if winner is None else 2 if winner == player else 0
+                games.setdefault(player, []).append((points[opponent], score))
+        values = {}
+        for player, played in games.items():
+            opponents = [o for o, _ in played]
+            buchholz = sum(opponents)
+            median = buchholz - (max(opponents) + min(opponents) if len(opponents) >= 3 else 0)
+            sonneborn_berger = sum(o * score for o, score in played) / 2.0
+            head_to_head = sum(score for o, score in played if o == points[player])
+            values[player] = (buchholz, median, sonneborn_berger, head_to_head)
+        return values
+
+    def playerRank(self, tournament, player_id):
+        with self._lock:
+            if player_id not in self._standings.get(tournament, {}):
+                return None
+            ranked = [p for p, _ in self._sortedStandings(tournament)]
+            return ranked.index(player_id) + 1
+
+    def iterStandings(self, tournament, chunk_size=None):
+        # Nothing to stream from: the standings are already in memory
+        return iter(self.playerStandings(tournament))
+
+    def _recomputeStandings(self, tournament):
+        '''Standings of a tournament computed from scratch'''
+        # Saved before _apply would save fresh in its place
+        self._touch('_standings', tournament)
+        fresh = dict((p, [0, 0, 0, 0, 0]) for p in self._standings[tournament])
+        saved = self._standings[tournament]
+        self._standings[tournament] = fresh
+        try:
+            for match_id in self._tournament_matches[tournament].values():
+                self._apply(*self._matches[match_id] + (1,))
+            for player, bye_ids in self._tournament_byes[tournament].items():
+                for _ in bye_ids:
+                    self._applyBye(tournament, player, 1)
+        finally:
+            self._standings[tournament] = saved
+        return fresh
+
+    def rebuildStandings(self, tournament=None, check_only=False):
+        with self._lock:
+            tournaments = list(self._tournaments) if tournament is None else [tournament]
+            mismatches = []
+            for t in tournaments:
+                if t not in self._standings:
+                    continue
+                fresh = self._recomputeStandings(t)
+                stale = [(t, p) for p, row in self._standings[t].items() if row != fresh[p]]
+                if stale and not check_only:
+                    for p in self._standings[t]:
+                        self._standings[t][p] = fresh[p]
+                mismatches.extend(stale)
+            return sorted(mismatches)
+
+    def reportMatch(self, player_a, player_b, winner=None, tournament=None):
+        with self._lock:
+            self._checkMatch(tournament, player_a, player_b, winner)
+            return self._insertMatch(tournament, player_a, player_b, winner)
+
+    def reportMatches(self, tournament, results):
+        results = [tuple(r) for r in results]
+        with self._lock:
+            registered = self._standings.get(tournament, {})
+            played = set(self._tournament_matches.get(tournament, ()))
+            failures = []
+            for i, entry in enumerate(results):
+                player_a, player_b, winner = entry
+                pair = pairKey(player_a, player_b)
+                if player_a == player_b:
+                    reason = 'player %s paired with self' % player_a
+                elif winner not in (player_a, player_b, None):
+                    reason = 'winner %s is not one of the players' % winner
+                elif player_a not in registered or player_b not in registered:
+                    reason = ("at least one of players %s, %s isn't registered"
+                              % (player_a, player_b))
+                elif pair in played:
+                    reason = 'pairing %s, %s already played' % (player_a, player_b)
+                else:
+                    played.add(pair)
+                    continue
+                failures.append((i, entry, reason))
+            if failures:
+                raise MatchReportError(failures)
+            return [self._insertMatch(tournament, *r) for r in results]
+
+    def reportBye(self, player, tournament):
+        with self._lock:
+            if player not in self._standings.get(tournament, ()):
+                raise IntegrityError('insert on table "byes" violates foreign key constraint')
+            bye_id = self._newId('byes')
+            self._touch('_byes', bye_id)
+            self._touch('_tournament_byes', tournament)
+            self._byes[bye_id] = (tournament, player)
+            self._tournament_byes[tournament].setdefault(player, []).append(bye_id)
+            self._applyBye(tournament, player, 1)
+            return bye_id
+
+    def playerRatings(self, tournament):
+        with self._lock:
+            return dict((p, tuple(self._ratings[p])) for p in self._standings.get(tournament, ()))
+
+    def rebuildRatings(self):
+        from ratings import eloRatings
+        with self._lock:
+            matches = [self._matches[m][1:] for m in sorted(self._matches)]
+            ratings = eloRatings(list(self._ratings), matches)
+            self._touchAll('_ratings')
+            for player, value in ratings.items():
+                self._ratings[player] = list(value)
+            return len(matches)
+
+    def startRound(self, tournament):
+        with self._lock:
+            if tournament not in self._tournaments:
+                raise IntegrityError('insert on table "rounds" violates foreign key constraint')
+            self._touch('_rounds', tournament)
+            rounds = self._rounds.setdefault(tournament, [])
+            if rounds and rounds[-1] is None:
+                raise ValueError('A round of tournament %s is already open' % tournament)
+            rounds.append(None)
+            return len(rounds)
+
+    def closeRound(self, tournament):
+        with self._lock:
+            rounds = self._rounds.get(tournament)
+            if not rounds or rounds[-1] is not None:
+                raise ValueError('No round of tournament %s is open' % tournament)
+            self._touch('_rounds', tournament)
+            rounds[-1] = dict((p, list(row)) for p, row in self._standings[tournament].items())
+            return len(rounds)
+
+    def tournamentRounds(self, tournament):
+        with self._lock:
+            return [(i + 1, snapshot is not None)
+                    for i, snapshot in enumerate(self._rounds.get(tournament, ()))]
+
+    def roundStandings(self, tournament, round):
+        with self._lock:
+            rounds = self._rounds.get(tournament, ())
+            snapshot = rounds[round - 1] if 0 < round <= len(rounds) else None
+            if not snapshot:
+                return []
+            order = sorted(snapshot, key=lambda p: (-snapshot[p][_POINTS],
+                                                     -snapshot[p][_WINS], p))
+            return [(p, self._players[p], snapshot[p][_WINS], snapshot[p][_DRAWS],
+                     snapshot[p][_MATCHES], snapshot[p][_POINTS]) for p in order]
+
+    def swissPairings(self, tournament):
+        with self._lock:
+            rows = self._standings.get(tournament, {})
+            ranked = sorted(rows, key=lambda p: (-rows[p][_POINTS], -self._ratings[p][0], p))
+            played = set(self._tournament_matches.get(tournament, ()))
+            had_bye = set(self._tournament_byes.get(tournament, ()))
+        pairs, bye = pairPlayers(ranked, played, had_bye)
+        pairings = [(a, self._players[a], b, self._players[b]) for a, b in pairs]
+        if bye is not None:
+            pairings.append((bye, self._players[bye], None, None))
+        return pairings
+
+    def playerStandingsMany(self, tournament_ids):
+        with self._lock:
+            return dict((t, self.playerStandings(t)) for t in tournament_ids)
+
+    def swissPairingsMany(self, tournament_ids, workers=None):
+        # Pairing runs in this process: the state isn't shared with others
+        pairings = {}
+        failures = {}
+        for t in tournament_ids:
+            try:
+                pairings[t] = self.swissPairings(t)
+            except ValueError as e:
+                failures[t] = str(e)
+        if failures:
+            raise PairingError(failures, pairings)
+        return pairings
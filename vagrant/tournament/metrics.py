@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+'''metrics.py -- thread-safe counters and latency histograms of SQL statements
+
+Statements are grouped by the public function that issued them and by
+their text with literals replaced by '?', so that the rows of a multi-row
+INSERT or the ids of a query don't each get an entry of their own.
+
+'''
+
+import bisect
+import re
+import threading
+
+# Upper bounds, in seconds, of the latency histogram buckets. A last
+# bucket counts everything slower.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_ROWS = re.compile(r'(\([?, ]*\))(?:\s*,\s*\([?, ]*\))+')
+_SPACE = re.compile(r'\s+')
+
+
+def normalize(statement):
+    '''Return statement with literals replaced by ? and whitespace collapsed
+
+    Repeated VALUES rows collapse to the first one followed by ", ...".
+    '''
+    statement = _NUMBER.sub('?', _STRING.sub('?', statement))
+    statement = _ROWS.sub(r'\1, ...', statement)
+    return _SPACE.sub(' ', statement).strip()
+
+
+class _Series(object):
+    '''Count, total, maximum and histogram of a set of durations'''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.histogram = [0] * (len(buckets) + 1)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+
+    def stats(self):
+        return {'count': self.count,
+                'total': self.total,
+                'max': self.max,
+                'histogram': list(self.histogram)}
+
+
+class QueryMetrics(object):
+    '''Latencies of statements, per issuing function, and of connections
+
+    Args:
+        buckets: increasing upper bounds, in seconds, of the histogram
+                 buckets.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        if list(buckets) != sorted(buckets):
+            raise ValueError('Histogram buckets must be increasing')
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def record(self, function, statement, seconds):
+        '''Record a statement issued by function (None outside the API)
+
+        Returns:
+            The normalized statement the duration was recorded under.
+        '''
+        key = (function, normalize(statement))
+        with self._lock:
+            series = self._queries.get(key)
+            if series is None:
+                series = self._queries[key] = _Series(self.buckets)
+            series.add(seconds)
+        return key[1]
+
+    def record_connect(self, seconds):
+        '''Record the time taken to open a connection'''
+        with self._lock:
+            self._connections.add(seconds)
+
+    def reset(self):
+        with self._lock:
+            self._queries = {}
+            self._connections = _Series(self.buckets)
+
+    def snapshot(self):
+        '''Return a dict with the current figures
+
+        Keys are 'buckets', 'connections' with the stats of connection
+        opens, and 'queries' mapping (function, statement) to the stats of
+        that statement. Stats are dicts of count, total and max seconds,
+        and histogram, the counts per bucket.
+        '''
+        with self._lock:
+            return {'buckets': self.buckets,
+                    'connections': self._connections.stats(),
+                    'queries': dict((key, series.stats())
+                                    for key, series in self._queries.items())}
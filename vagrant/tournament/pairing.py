@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+'''pairing.py -- Swiss pairing engine
+
+Pairs players ranked by score so that every pair is made of players close
+in the ranking, no pair has met before, and, for odd fields, one player
+gets a bye.
+
+The engine works on a sparse graph whose edges join players at most
+`window` places apart in the ranking and who haven't played each other.
+A greedy pass pairs every player with the closest available player below
+in the ranking, which keeps pairs within score groups and floats the odd
+player of a group down to the next one. Players left over because of
+rematch conflicts are then paired by searching for augmenting paths
+(Edmonds' blossom algorithm) in the same graph, which re-pairs a few
+nearby players instead of backtracking over the whole field. If that
+fails, the window is doubled and the search resumes from the current
+pairing. The cost is roughly linear in the field size for the usual
+case where conflicts are rare.
+
+'''
+
+from collections import deque
+
+from played_pairs import PlayedPairs
+
+try:
+    xrange
+except NameError:  # Python 3, for async_tournament.py
+    xrange = range
+
+# Initial number of ranking places a player may be paired across.
+DEFAULT_WINDOW = 8
+
+
+def pairKey(a, b):
+    '''Return a hashable key identifying the unordered pair of players a, b'''
+    return (a, b) if a < b else (b, a)
+
+
+def _neighbours(n, window, allowed):
+    '''Adjacency lists of the pairing graph restricted to window places'''
+    adj = [[] for _ in xrange(n)]
+    for i in xrange(n):
+        for j in xrange(i + 1, min(n, i + window + 1)):
+            if allowed(i, j):
+                adj[i].append(j)
+                adj[j].append(i)
+    return adj
+
+
+def _augment(adj, match, root):
+    '''Search an augmenting path from unmatched root and apply it
+
+    Edmonds' blossom algorithm for general graphs: one breadth-first
+    search, contracting odd cycles as they are found.
+
+    Returns:
+        True if root was matched.
+    '''
+    n = len(adj)
+    parent = [-1] * n
+    base = list(range(n))
+    outer = [False] * n
+    outer[root] = True
+    tree = [root]
+    queue = deque([root])
+
+    def lca(a, b):
+        seen = set()
+        while True:
+            a = base[a]
+            seen.add(a)
+            if match[a] == -1:
+                break
+            a = parent[match[a]]
+        while True:
+            b = base[b]
+            if b in seen:
+                return b
+            b = parent[match[b]]
+
+    def markPath(v, b, child, blossom):
+        while base[v] != b:
+            blossom.add(base[v])
+            blossom.add(base[match[v]])
+            parent[v] = child
+            child = match[v]
+            v = parent[match[v]]
+
+    while queue:
+        v = queue.popleft()
+        for u in adj[v]:
+            if base[v] == base[u] or match[v] == u:
+                continue
+            if u == root or (match[u] != -1 and parent[match[u]] != -1):
+                # Odd cycle: contract it into a blossom based at b
+                b = lca(v, u)
+                blossom = set()
+                markPath(v, b, u, blossom)
+                markPath(u, b, v, blossom)
+                for i in tree:
+                    if base[i] in blossom:
+                        base[i] = b
+                        if not outer[i]:
+                            outer[i] = True
+                            queue.append(i)
+            elif parent[u] == -1:
+                parent[u] = v
+                tree.append(u)
+                if match[u] == -1:
+                    while u != -1:
+                        pv = parent[u]
+                        ppv = match[pv]
+                        match[u] = pv
+                        match[pv] = u
+                        u = ppv
+                    return True
+                w = match[u]
+                outer[w] = True
+                tree.append(w)
+                queue.append(w)
+    return False
+
+
+def _pairRanked(n, allowed, window):
+    '''Pair players 0..n-1, ranked best first, along allowed edges
+
+    Returns:
+        list mapping each player to its partner, or None if some player
+        can't be paired.
+    '''
+    window = max(1, min(window, n - 1))
+    match = [-1] * n
+    for i in xrange(n):
+        if match[i] != -1:
+            continue
+        for j in xrange(i + 1, min(n, i + window + 1)):
+            if match[j] == -1 and allowed(i, j):
+                match[i], match[j] = j, i
+                break
+
+    while True:
+        unmatched = [i for i in xrange(n) if match[i] == -1]
+        if not unmatched:
+            return match
+        adj = _neighbours(n, window, allowed)
+        for i in unmatched:
+            if match[i] == -1:
+                _augment(adj, match, i)
+        if window >= n - 1 and -1 in match:
+            return None
+        window = min(2 * window, n - 1)
+
+
+def pairPlayers(ranked, played=(), had_bye=(), window=DEFAULT_WINDOW):
+    '''Compute Swiss pairings for the next round
+
+    Args:
+        ranked: sequence of player ids, best ranked first.
+        played: collection of pairKey(a, b) for the pairs that already met,
+                or a played_pairs.PlayedPairs.
+        had_bye: collection of ids of players that already had a bye.
+        window: initial number of ranking places players may be paired
+                across. It is widened automatically when needed.
+
+    Returns:
+        Tuple (pairs, bye): pairs is a list of (id1, id2) tuples where id1
+        is ranked above id2, ordered by ranking. bye is the id of the
+        player who sits out this round, or None for even fields.
+
+    Raises:
+        ValueError if every possible pairing includes a rematch.
+    '''
+    ranked = list(ranked)
+    if not isinstance(played, (set, frozenset, PlayedPairs)):
+        played = set(played)
+
+    def attempt(players):
+        def allowed(i, j):
+            return pairKey(players[i], players[j]) not in played
+        match = _pairRanked(len(players), allowed, window)
+        if match is None:
+            return None
+        return [(players[i], players[j])
+                for i, j in enumerate(match) if i < j]
+
+    if len(ranked) % 2 == 0:
+        pairs = attempt(ranked)
+        bye = None
+    else:
+        # The bye goes to the lowest ranked player who hasn't had one yet
+        # and without whom the rest of the field can still be paired.
+        # Players get a second bye only if there is no other way.
+        had_bye = set(had_bye)
+        bottom_up = list(reversed(xrange(len(ranked))))
+        candidates = ([i for i in bottom_up if ranked[i] not in had_bye] +
+                      [i for i in bottom_up if ranked[i] in had_bye])
+        pairs = None
+        for i in candidates:
+            pairs = attempt(ranked[:i] + ranked[i + 1:])
+            if pairs is not None:
+                bye = ranked[i]
+                break
+
+    if pairs is None:
+        raise ValueError('No pairing of %d players avoids rematches' % len(ranked))
+    return pairs, bye
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+'''played_pairs.py -- in-memory index of the pairs of players who have met
+
+PlayedPairs holds the pairs of one tournament as a set of 64-bit integers,
+the smaller player id in the high 32 bits, so that "have A and B met?" is
+one hash lookup without building a tuple per pair, and the opponents of
+each player as a compact array. PlayedPairsIndex keeps one PlayedPairs
+per tournament, loaded on first use and updated as matches are reported.
+
+A Swiss field is sparse, each player meeting one opponent per round, so
+the hash set takes less memory than a bitset of the whole field per
+player would for any field beyond a few hundred players.
+
+'''
+
+import threading
+from array import array
+
+
+def packPair(a, b):
+    '''Return the 64-bit integer key of the unordered pair of players a, b'''
+    return (a << 32 | b) if a < b else (b << 32 | a)
+
+
+def unpackPair(key):
+    '''Return the pairKey of a packPair key'''
+    return key >> 32, key & 0xffffffff
+
+
+class PlayedPairs(object):
+    '''Pairs of players who have met in one tournament
+
+    Supports `pairKey(a, b) in played`, so that it can be passed to
+    pairing.pairPlayers as is, and iterates over pairKeys.
+
+    Args:
+        pairs: iterable of (player_a, player_b) of the matches played.
+    '''
+
+    def __init__(self, pairs=()):
+        self._keys = set()
+        self._opponents = {}    # player id -> array of opponent ids
+        for a, b in pairs:
+            self.add(a, b)
+
+    def add(self, a, b):
+        '''Record a match between players a and b'''
+        key = packPair(a, b)
+        if key in self._keys:
+            return
+        self._keys.add(key)
+        for player, opponent in ((a, b), (b, a)):
+            opponents = self._opponents.get(player)
+            if opponents is None:
+                opponents = self._opponents[player] = array('i')
+            opponents.append(opponent)
+
+    def havePlayed(self, a, b):
+        '''Return True if players a and b have met'''
+        return packPair(a, b) in self._keys
+
+    def opponents(self, player):
+        '''Return the sorted list of the opponents of player'''
+        return sorted(self._opponents.get(player, ()))
+
+    def __contains__(self, pair):
+        return packPair(*pair) in self._keys
+
+    def __iter__(self):
+        # list() copies the set at once, even while another thread adds
+        return iter([unpackPair(key) for key in list(self._keys)])
+
+    def __len__(self):
+        return len(self._keys)
+
+
+class PlayedPairsIndex(object):
+    '''Thread-safe PlayedPairs of several tournaments, loaded on demand
+
+    Args:
+        load: load(tournament) returns the (player_a, player_b) pairs of
+              the matches of tournament.
+    '''
+
+    def __init__(self, load):
+        self._load = load
+        self._tournaments = {}
+        self._lock = threading.Lock()
+        # Changes to each tournament, and discards of all, counted so that
+        # pairs loaded concurrently with a report are not stored after the
+        # report was recorded.
+        self._changes = {}
+        self._epoch = 0
+        self.loads = 0
+
+    def get(self, tournament):
+        '''Return the PlayedPairs of tournament, loading it if needed
+
+        The returned object is updated in place by add, and must not be
+        modified otherwise.
+        '''
+        with self._lock:
+            played = self._tournaments.get(tournament)
+            if played is not None:
+                return played
+            version = self._version(tournament)
+        played = PlayedPairs(self._load(tournament))
+        with self._lock:
+            self.loads += 1
+            if version == self._version(tournament):
+                self._tournaments[tournament] = played
+        return played
+
+    def _version(self, tournament):
+        return self._epoch, self._changes.get(tournament, 0)
+
+    def _changed(self, tournament):
+        self._changes[tournament] = self._changes.get(tournament, 0) + 1
+
+    def loaded(self, tournament):
+        '''Return the PlayedPairs of tournament if loaded, else None'''
+        with self._lock:
+            return self._tournaments.get(tournament)
+
+    def add(self, tournament, pairs):
+        '''Record committed matches of tournament, if it is loaded'''
+        with self._lock:
+            self._changed(tournament)
+            played = self._tournaments.get(tournament)
+            if played is not None:
+                for a, b in pairs:
+                    played.add(a, b)
+
+    def discard(self, tournament=None):
+        '''Drop the pairs of tournament, or of all if None'''
+        with self._lock:
+            if tournament is None:
+                self._epoch += 1
+                self._tournaments.clear()
+            else:
+                self._changed(tournament)
+                self._tournaments.pop(tournament, None)
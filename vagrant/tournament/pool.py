@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+'''pool.py -- thread-safe pool of PostgreSQL connections
+
+Connections are opened lazily up to a maximum size, checked for health when
+they are handed out and closed when they have been idle for too long.
+ReplicaPools spreads checkouts over the pools of several read replicas and
+skips those that fail.
+
+'''
+
+import threading
+import time
+
+import psycopg2
+
+
+class PoolError(Exception):
+    '''Raised when no connection can be checked out of the pool'''
+    pass
+
+
+class ConnectionPool(object):
+    '''Pool of psycopg2 connections to a single database
+
+    Args:
+        dsn: libpq connection string used to open new connections.
+        minconn: number of connections kept open even when idle.
+        maxconn: maximum number of connections open at the same time.
+        idle_timeout: seconds after which an idle connection above minconn
+                      is closed. None disables idle expiry.
+        health_check: if True, run a trivial query on every checkout and
+                      replace connections that fail it.
+        checkout_timeout: seconds to wait for a free connection when the
+                          pool is exhausted. None waits forever.
+        connect: function opening a connection given the dsn.
+    '''
+
+    def __init__(self, dsn, minconn=1, maxconn=10, idle_timeout=300,
+                 health_check=True, checkout_timeout=30, connect=psycopg2.connect):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError('Invalid pool size min=%s max=%s' % (minconn, maxconn))
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.checkout_timeout = checkout_timeout
+        self._connect = connect
+        self._idle = []      # list of (connection, time returned to pool)
+        self._used = set()
+        self._opening = 0
+        self._closed = False
+        self._cond = threading.Condition(threading.Lock())
+        for _ in range(minconn):
+            self._idle.append((self._open(), time.time()))
+
+    def _open(self):
+        return self._connect(self.dsn)
+
+    @staticmethod
+    def _discard(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def _healthy(self, conn):
+        '''Check that an idle connection can still be used'''
+        if conn.closed:
+            return False
+        if not self.health_check:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute('SELECT 1')
+            cur.close()
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def _expire_idle(self, now):
+        '''Close idle connections above minconn older than idle_timeout'''
+        if self.idle_timeout is None:
+            return
+        keep = []
+        for conn, since in self._idle:
+            if (now - since > self.idle_timeout
+                    and len(keep) + len(self._used) + self._opening >= self.minconn):
+                self._discard(conn)
+            else:
+                keep.append((conn, since))
+        self._idle = keep
+
+    def _take(self, deadline):
+        '''Pop an idle connection, or reserve a slot for a new one
+
+        Must be called with the pool lock held. Returns an idle connection
+        marked as used, or None if the caller may open a new connection.
+        '''
+        while True:
+            if self._closed:
+                raise PoolError('Connection pool is closed')
+            self._expire_idle(time.time())
+            if self._idle:
+                # Most recently returned first: it is the least likely
+                # to have been dropped by the server.
+                conn, _ = self._idle.pop()
+                self._used.add(conn)
+                return conn
+            if len(self._used) + self._opening < self.maxconn:
+                self._opening += 1
+                return None
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise PoolError('No connection available after %ss'
+                                % self.checkout_timeout)
+            self._cond.wait(remaining)
+
+    def getconn(self):
+        '''Check a connection out of the pool
+
+        Raises:
+            PoolError if the pool is closed or no connection became
+            available within checkout_timeout seconds.
+        '''
+        deadline = (None if self.checkout_timeout is None
+                    else time.time() + self.checkout_timeout)
+        while True:
+            with self._cond:
+                conn = self._take(deadline)
+            if conn is None:
+                # Connect outside the lock so other checkouts aren't blocked
+                try:
+                    conn = self._open()
+                finally:
+                    with self._cond:
+                        self._opening -= 1
+                        if conn is not None:
+                            self._used.add(conn)
+                        self._cond.notify()
+                return conn
+            if self._healthy(conn):
+                return conn
+            with self._cond:
+                self._used.discard(conn)
+                self._discard(conn)
+                self._cond.notify()
+
+    def putconn(self, conn, close=False):
+        '''Return a connection to the pool
+
+        Any open transaction is rolled back. Broken connections, and all
+        connections when close is True, are closed instead of being kept.
+        '''
+        keep = not close and not conn.closed
+        if keep:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        with self._cond:
+            self._used.discard(conn)
+            if keep and not self._closed:
+                self._idle.append((conn, time.time()))
+            else:
+                self._discard(conn)
+            self._cond.notify()
+
+    def closeall(self):
+        '''Close every idle connection and refuse further checkouts
+
+        Connections still checked out are closed when they are returned.
+        '''
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._discard(conn)
+            self._idle = []
+            self._cond.notify_all()
+
+    def stats(self):
+        '''Return a dict with the number of idle and checked out connections'''
+        with self._cond:
+            return {'idle': len(self._idle), 'used': len(self._used)}
+
+
+class ReplicaPools(object):
+    '''Connection pools of several read replicas, used in turn
+
+    Each checkout goes to the next replica in round-robin order. A replica
+    whose connection fails, or whose pool can't hand one out, is marked
+    down and skipped until retry_interval seconds have passed. Replica
+    connections are read-only.
+
+    Args:
+        dsns: libpq connection strings of the replicas.
+        retry_interval: seconds a replica marked down is skipped.
+        **pool_args: arguments of the ConnectionPool of each replica. No
+                     connection is opened before the first checkout.
+    '''
+
+    def __init__(self, dsns, retry_interval=30, **pool_args):
+        if not dsns:
+            raise ValueError('No replica connection strings')
+        self.retry_interval = retry_interval
+        pool_args['minconn'] = 0
+        pool_args['connect'] = self._readOnly(pool_args.get('connect', psycopg2.connect))
+        self.pools = [ConnectionPool(dsn, **pool_args) for dsn in dsns]
+        self._down_until = [0] * len(self.pools)
+        self._checkouts = [0] * len(self.pools)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _readOnly(connect):
+        def connectReadOnly(dsn):
+            conn = connect(dsn)
+            conn.set_session(readonly=True)
+            return conn
+        return connectReadOnly
+
+    def getconn(self):
+        '''Check a connection out of the next replica that is up
+
+        Returns:
+            (pool, connection) tuple, or None if every replica is down.
+            The connection must be returned with pool.putconn.
+        '''
+        with self._lock:
+            now = time.time()
+            start = self._next
+            self._next = (self._next + 1) % len(self.pools)
+        for i in range(len(self.pools)):
+            index = (start + i) % len(self.pools)
+            if self._down_until[index] > now:
+                continue
+            pool = self.pools[index]
+            try:
+                conn = pool.getconn()
+            except (psycopg2.OperationalError, PoolError):
+                self.markDown(pool)
+                continue
+            with self._lock:
+                self._checkouts[index] += 1
+            return pool, conn
+        return None
+
+    def markDown(self, pool):
+        '''Skip the replica of pool for retry_interval seconds'''
+        index = self.pools.index(pool)
+        with self._lock:
+            self._down_until[index] = time.time() + self.retry_interval
+
+    def closeall(self):
+        for pool in self.pools:
+            pool.closeall()
+
+    def stats(self):
+        '''Return a list with, for every replica, a dict of its dsn, the
+        idle and checked out connections of its pool, its number of
+        checkouts and whether it is marked down'''
+        now = time.time()
+        with self._lock:
+            return [dict(pool.stats(), dsn=pool.dsn, checkouts=checkouts,
+                         down=down_until > now)
+                    for pool, checkouts, down_until
+                    in zip(self.pools, self._checkouts, self._down_until)]
@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+'''ratings.py -- Elo ratings replayed over a whole match history with NumPy
+
+The ratings kept by the database are updated one match at a time, in the
+order matches are reported. eloRatings computes the same ratings from
+scratch. Matches are split into waves in which no player appears twice,
+each match going in the wave after the last one of either of its players,
+so that the updates of a whole wave can be applied at once with NumPy and
+still give the result of replaying the matches one by one.
+
+Requires NumPy.
+
+'''
+
+import numpy as np
+
+from tournament import ELO_INITIAL, ELO_K, ELO_SCALE
+
+
+def expectedScore(rating, opponent_rating, scale=ELO_SCALE):
+    '''Elo expected score, between 0 and 1, of a player against an opponent'''
+    return 1.0 / (1 + 10 ** ((opponent_rating - rating) / float(scale)))
+
+
+def _waves(a, b, n):
+    '''Wave of each match: 1 + the last wave of either of its players'''
+    last = [0] * n
+    waves = [0] * len(a)
+    for i, (p, q) in enumerate(zip(a, b)):
+        wave = max(last[p], last[q]) + 1
+        waves[i] = last[p] = last[q] = wave
+    return np.array(waves, dtype=np.int64)
+
+
+def eloRatings(player_ids, matches, initial=ELO_INITIAL, k=ELO_K, scale=ELO_SCALE):
+    """Replay matches in order and return the Elo ratings they lead to.
+
+    Args:
+        player_ids: ids of every player to rate, including those in
+                    matches.
+        matches: sequence of (player_a, player_b, winner) in the order
+                 they were played, winner None for a draw.
+        initial: rating of a player without games.
+        k: K-factor, the most a rating can change in one match.
+        scale: rating difference at which the stronger player is expected
+               to score ten times as much.
+
+    Returns:
+        dict of player id to a (rating, games) tuple
+    """
+    player_ids = np.asarray(player_ids, dtype=np.int64)
+    n = len(player_ids)
+    ratings = np.full(n, float(initial))
+    if not len(matches):
+        return dict((int(p), (float(initial), 0)) for p in player_ids)
+
+    order = np.argsort(player_ids)
+    ids = np.array([m[:2] + (0 if m[2] is None else m[2],) for m in matches],
+                   dtype=np.int64)
+    a = order[np.searchsorted(player_ids, ids[:, 0], sorter=order)]
+    b = order[np.searchsorted(player_ids, ids[:, 1], sorter=order)]
+    score = np.where(ids[:, 2] == ids[:, 0], 1.0, np.where(ids[:, 2] == 0, 0.5, 0.0))
+
+    waves = _waves(a.tolist(), b.tolist(), n)
+    by_wave = np.argsort(waves, kind='mergesort')
+    bounds = np.searchsorted(waves[by_wave], np.arange(1, waves.max() + 2))
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        m = by_wave[start:end]
+        delta = k * (score[m] - expectedScore(ratings[a[m]], ratings[b[m]], scale))
+        ratings[a[m]] += delta
+        ratings[b[m]] -= delta
+
+    games = np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+    return dict((int(p), (float(r), int(g)))
+                for p, r, g in zip(player_ids, ratings, games))
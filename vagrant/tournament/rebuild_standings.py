@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+'''rebuild_standings.py -- check and repair the tournament_standings table
+
+Compares the incrementally maintained tournament_standings table with the
+standings view and rewrites the tournaments whose rows differ.
+
+Usage:
+    ./rebuild_standings.py [--check] [tournament_id ...]
+
+'''
+
+import argparse
+import sys
+
+from tournament import rebuildStandings
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('tournaments', metavar='tournament_id', type=int, nargs='*',
+                        help='tournaments to check (default: all)')
+    parser.add_argument('--check', action='store_true',
+                        help='only report differences, do not rewrite')
+    args = parser.parse_args()
+
+    mismatches = []
+    for tournament in args.tournaments or [None]:
+        mismatches.extend(rebuildStandings(tournament, check_only=args.check))
+
+    for tournament_id, player_id in mismatches:
+        print 'tournament %s player %s: stored standings differ from view' % (
+            tournament_id, player_id)
+    print '%d mismatching row(s)%s' % (
+        len(mismatches), '' if args.check or not mismatches else ', rebuilt')
+
+    sys.exit(1 if args.check and mismatches else 0)
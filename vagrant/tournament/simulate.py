@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+'''simulate.py -- Monte Carlo simulation of the remaining rounds of a tournament
+
+Loads the current standings and match history of a tournament once, then
+plays the remaining rounds many times over with NumPy: every simulation
+has its own vector of points, results are drawn in batches for all boards
+of all simulations at once and the Swiss pairing of each round is done for
+all simulations with one sort. Batches of simulations can be spread over
+a process pool.
+
+The vectorized pairing pairs adjacent players in each simulated ranking
+(ties broken at random) and then swaps opponents between neighbouring
+boards to avoid rematches. Unlike pairing.py it doesn't guarantee that
+no rematch is left: about one board in a thousand in a 64-player field
+over 7 rounds, but many more in small fields that play nearly a round
+robin, where the odds are only approximate.
+
+Requires NumPy.
+
+Usage:
+    ./simulate.py tournament_id rounds [--simulations 10000] [--top 8]
+
+'''
+
+import argparse
+import multiprocessing
+
+import numpy as np
+
+from tournament import playerStandings, tournamentByes, tournamentMatches
+
+# Maximum number of history entries (simulations x players x rounds)
+# held at once by one batch of simulations.
+BATCH_BUDGET = 20 * 1000 * 1000
+
+# Passes of neighbouring-board swaps made to avoid rematches.
+REPAIR_PASSES = 4
+
+
+def loadState(tournament):
+    '''Snapshot of a tournament used to seed the simulations
+
+    Returns:
+        dict with the player ids, in standings order, and arrays indexed
+        like them of points, wins, byes received and opponents played
+        (padded with -1).
+    '''
+    standings = playerStandings(tournament)
+    player_ids = [row[0] for row in standings]
+    index = dict((p, i) for i, p in enumerate(player_ids))
+    n = len(player_ids)
+
+    opponents = [[] for _ in xrange(n)]
+    for a, b, _ in tournamentMatches(tournament):
+        opponents[index[a]].append(index[b])
+        opponents[index[b]].append(index[a])
+    history = np.full((n, max([len(o) for o in opponents] + [0])), -1, dtype=np.int32)
+    for i, o in enumerate(opponents):
+        history[i, :len(o)] = o
+
+    had_bye = np.zeros(n, dtype=bool)
+    for p in tournamentByes(tournament):
+        had_bye[index[p]] = True
+
+    return {'player_ids': player_ids,
+            'points': np.array([row[5] for row in standings], dtype=np.int32),
+            'wins': np.array([row[2] for row in standings], dtype=np.int32),
+            'had_bye': had_bye,
+            'history': history}
+
+
+def _rank(points, wins, rng):
+    '''Order players of every simulation by points, wins, then at random'''
+    # One float key is much faster to sort than lexsort's three keys: wins
+    # never exceed points, so points * (max wins + 1) + wins orders like
+    # (points, wins) and random noise below 1 breaks the remaining ties.
+    key = points * (wins.max() + 1.0) + wins + rng.random_sample(points.shape)
+    return np.argsort(-key, axis=1)
+
+
+def _repairRematches(a, b, history, depth):
+    '''Swap opponents between neighbouring boards to avoid rematches
+
+    Only the first depth columns of history, the rounds played so far,
+    are checked.
+    '''
+    simulations, n, width = history.shape
+    boards = a.shape[1]
+    flat = history.reshape(simulations * n, width)
+    rows = (np.arange(simulations)[:, None] * n + a).ravel()
+    for p in xrange(REPAIR_PASSES):
+        conflict = (flat[rows, :depth].reshape(simulations, boards, depth)
+                    == b[:, :, None]).any(axis=2)
+        if not conflict.any():
+            return
+        # Boards k and k + 1 swap their second players if either has a
+        # conflict. Blocks start at even boards on even passes and at odd
+        # boards on odd passes, so swaps within a pass never overlap.
+        first = np.arange(p % 2, boards - 1, 2)
+        swap = conflict[:, first] | conflict[:, first + 1]
+        s, k = np.nonzero(swap)
+        k = first[k]
+        b[s, k], b[s, k + 1] = b[s, k + 1], b[s, k].copy()
+
+
+def _simulateBatch(args):
+    '''Simulate one batch of tournaments
+
+    Returns:
+        Array counting, for every player, the simulations in which it
+        finished in each of the first max_position places.
+    '''
+    state, rounds, simulations, p_draw, ratings, max_position, seed = args
+    rng = np.random.RandomState(seed)
+    n = len(state['player_ids'])
+    played = state['history'].shape[1]
+    sims = np.arange(simulations)[:, None]
+
+    points = np.tile(state['points'], (simulations, 1))
+    wins = np.tile(state['wins'], (simulations, 1))
+    had_bye = np.tile(state['had_bye'], (simulations, 1))
+    history = np.full((simulations, n, played + rounds), -1, dtype=np.int32)
+    history[:, :, :played] = state['history']
+
+    for r in xrange(rounds):
+        order = _rank(points, wins, rng)
+        if n % 2:
+            # Bye for the lowest ranked player who hasn't had one
+            ranked_had_bye = had_bye[sims, order]
+            bye_pos = n - 1 - np.argmax(~ranked_had_bye[:, ::-1], axis=1)
+            bye = order[sims[:, 0], bye_pos]
+            points[sims[:, 0], bye] += 2
+            wins[sims[:, 0], bye] += 1
+            had_bye[sims[:, 0], bye] = True
+            keep = np.ones(order.shape, dtype=bool)
+            keep[sims[:, 0], bye_pos] = False
+            order = order[keep].reshape(simulations, n - 1)
+
+        a = order[:, 0::2]
+        b = order[:, 1::2].copy()
+        _repairRematches(a, b, history, played + r)
+
+        if ratings is None:
+            p_a = (1.0 - p_draw) / 2
+        else:
+            p_a = (1.0 - p_draw) / (1 + 10 ** ((ratings[b] - ratings[a]) / 400.0))
+        u = rng.random_sample(a.shape)
+        a_wins = u < p_a
+        draws = (u >= p_a) & (u < p_a + p_draw)
+        b_wins = ~(a_wins | draws)
+        points[sims, a] += 2 * a_wins + draws
+        points[sims, b] += 2 * b_wins + draws
+        wins[sims, a] += a_wins
+        wins[sims, b] += b_wins
+        history[sims, a, played + r] = b
+        history[sims, b, played + r] = a
+
+    order = _rank(points, wins, rng)[:, :max_position]
+    cells = (order * max_position + np.arange(max_position)).ravel()
+    return np.bincount(cells, minlength=n * max_position).reshape(n, max_position)
+
+
+def simulateTournament(tournament, rounds, simulations=10000, p_draw=0.1,
+                       ratings=None, max_position=None, workers=1, seed=None):
+    """Simulate the remaining rounds of a tournament.
+
+    Args:
+        tournament: id of the tournament.
+        rounds: number of rounds still to be played.
+        simulations: number of simulated tournaments.
+        p_draw: probability that a match is drawn.
+        ratings: optional dict of player id to Elo rating. Decisive games
+                 are then won with the Elo expected probability, otherwise
+                 both players are equally likely to win.
+        max_position: only compute the odds of the first max_position
+                      places. Defaults to all places.
+        workers: number of processes to spread the simulations over.
+        seed: seed of the random generator, for reproducible results.
+
+    Returns:
+        Tuple (player_ids, odds): player_ids lists the players in current
+        standings order and odds[i, k] is the probability that player_ids[i]
+        finishes in place k + 1.
+    """
+    state = loadState(tournament)
+    n = len(state['player_ids'])
+    max_position = n if max_position is None else min(max_position, n)
+    if ratings is not None:
+        ratings = np.array([ratings[p] for p in state['player_ids']], dtype=float)
+
+    per_batch = BATCH_BUDGET // max(1, n * (state['history'].shape[1] + rounds))
+    per_batch = max(1, min(simulations, per_batch))
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1,
+                                                size=-(-simulations // per_batch))
+    batches = [(state, rounds, min(per_batch, simulations - i * per_batch),
+                p_draw, ratings, max_position, s)
+               for i, s in enumerate(seeds)]
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            counts = pool.map(_simulateBatch, batches)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        counts = [_simulateBatch(b) for b in batches]
+
+    return state['player_ids'], sum(counts) / float(simulations)
+
+
+def topProbabilities(player_ids, odds, top):
+    '''Return dict of player id to probability of finishing in the top places'''
+    return dict(zip(player_ids, odds[:, :top].sum(axis=1)))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('tournament', type=int)
+    parser.add_argument('rounds', type=int, help='rounds still to be played')
+    parser.add_argument('--simulations', type=int, default=10000)
+    parser.add_argument('--draw', type=float, default=0.1,
+                        help='probability of a draw')
+    parser.add_argument('--top', type=int, default=8)
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count())
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    player_ids, odds = simulateTournament(args.tournament, args.rounds,
+                                          simulations=args.simulations,
+                                          p_draw=args.draw,
+                                          max_position=args.top,
+                                          workers=args.workers,
+                                          seed=args.seed)
+    names = dict((row[0], row[1]) for row in playerStandings(args.tournament))
+    top = topProbabilities(player_ids, odds, args.top)
+    print '%-30s %8s' % ('player', 'top %d' % args.top)
+    for p in sorted(player_ids, key=lambda p: -top[p]):
+        print '%-30s %7.1f%%' % (names[p], 100 * top[p])
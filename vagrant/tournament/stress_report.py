@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+'''stress_report.py -- concurrent match reports racing on the same pairings
+
+Registers a tournament and picks distinct pairings of its players, then
+has --threads threads report them all. Every pairing is submitted --copies
+times in a row, so that the copies are picked up by different threads at
+the same moment, like scorekeepers entering the same result at once. With
+--batch N, the submissions are shuffled instead, so that copies end up in
+different batches, and threads submit N results at a time with
+reportMatches, falling back to reportMatch for the batches it rejects.
+
+Checks that every pairing was stored exactly once, that every other copy
+was rejected with ValueError and that the running standings agree with
+those computed from scratch, then prints the throughput. Exits with
+status 1 if a check fails. The tournament and players are removed at the
+end.
+
+Usage:
+    ./stress_report.py [--threads 16] [--players 200] [--matches 5000]
+                       [--copies 2] [--batch 0] [--seed 1]
+
+'''
+
+import argparse
+import random
+import sys
+import threading
+import time
+from Queue import Empty, Queue
+
+from pairing import pairKey
+from tournament import (MatchReportError,
+                        Session,
+                        configurePool,
+                        deleteTournaments,
+                        rebuildStandings,
+                        registerPlayers,
+                        registerTournament,
+                        reportMatch,
+                        reportMatches,
+                        tournamentMatches)
+
+
+def setUp(players, matches, rng):
+    '''Register a tournament and draw distinct (a, b, winner) results'''
+    t = registerTournament('stress_report')
+    ids = registerPlayers(['Player %d' % i for i in xrange(players)], (t,))
+    pairs = rng.sample([(a, b) for i, a in enumerate(ids) for b in ids[i + 1:]], matches)
+    results = [(a, b, rng.choice((a, b, None))) for a, b in pairs]
+    return t, ids, results
+
+
+def worker(t, queue, batch, counts, lock):
+    '''Report results from queue until it is empty, counting outcomes'''
+    stored = rejected = 0
+    unexpected = []
+    while True:
+        chunk = []
+        try:
+            for _ in xrange(max(1, batch)):
+                chunk.append(queue.get_nowait())
+        except Empty:
+            pass
+        if not chunk:
+            break
+        if batch:
+            try:
+                reportMatches(t, chunk)
+                stored += len(chunk)
+                continue
+            except MatchReportError:
+                pass
+            except Exception as e:
+                unexpected.append(repr(e))
+                continue
+        for a, b, w in chunk:
+            try:
+                reportMatch(a, b, w, t)
+                stored += 1
+            except ValueError:
+                rejected += 1
+            except Exception as e:
+                unexpected.append(repr(e))
+    with lock:
+        counts['stored'] += stored
+        counts['rejected'] += rejected
+        counts['unexpected'].extend(unexpected)
+
+
+def tearDown(t, ids):
+    with Session() as session:
+        deleteTournaments(t)
+        session.cursor().execute('DELETE FROM players WHERE id = ANY(%s)', (ids,))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--players', type=int, default=200)
+    parser.add_argument('--matches', type=int, default=5000)
+    parser.add_argument('--copies', type=int, default=2)
+    parser.add_argument('--batch', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    configurePool(minconn=args.threads, maxconn=args.threads)
+    t, ids, results = setUp(args.players, args.matches, rng)
+    try:
+        submissions = [result for result in results for _ in xrange(args.copies)]
+        if args.batch:
+            rng.shuffle(submissions)
+        queue = Queue()
+        for result in submissions:
+            queue.put(result)
+        counts = {'stored': 0, 'rejected': 0, 'unexpected': []}
+        lock = threading.Lock()
+        threads = [threading.Thread(target=worker, args=(t, queue, args.batch, counts, lock))
+                   for _ in xrange(args.threads)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        seconds = time.time() - start
+
+        stored = [pairKey(a, b) for a, b, _ in tournamentMatches(t)]
+        submitted = len(submissions)
+        failures = []
+        if len(stored) != len(set(stored)):
+            failures.append('%d duplicate matches stored' % (len(stored) - len(set(stored))))
+        if set(stored) != set(pairKey(a, b) for a, b, _ in results):
+            failures.append('stored pairings differ from the submitted ones')
+        if counts['stored'] != len(results) or counts['rejected'] != submitted - len(results):
+            failures.append('%(stored)d reports accepted and %(rejected)d rejected' % counts)
+        if counts['unexpected']:
+            failures.append('%d unexpected errors, e.g. %s'
+                            % (len(counts['unexpected']), counts['unexpected'][0]))
+        if rebuildStandings(t, check_only=True):
+            failures.append('running standings disagree with the standings view')
+
+        print '%d submissions of %d pairings by %d threads in %.2fs: %.0f submissions/s' % (
+            submitted, len(results), args.threads, seconds, submitted / seconds)
+        for failure in failures:
+            print 'FAILED:', failure
+        if not failures:
+            print 'OK: every pairing stored once, every copy rejected'
+    finally:
+        tearDown(t, ids)
+    sys.exit(1 if failures else 0)
@@ -7,36 +7,1006 @@ Author: Juan Palacios
 
 '''
 
+import atexit
+import functools
+import inspect
+import itertools
+import logging
+import multiprocessing
+import random
+import re
+import threading
+import time
+
 import psycopg2
+import psycopg2.extensions
 from psycopg2 import IntegrityError
-from itertools import izip_longest
 
-DBNAME = 'tournament'
+from cache import LRUCache
+from metrics import DEFAULT_BUCKETS, QueryMetrics
+from pairing import pairKey, pairPlayers
+from played_pairs import PlayedPairsIndex
+from pool import ConnectionPool, ReplicaPools
+from write_buffer import ResultBuffer
 
+try:
+    xrange
+except NameError:  # Python 3, for async_tournament.py
+    xrange = range
 
-def connect(database_name=DBNAME):
+DBNAME = 'tournament'
+
+# Default connection pool settings. See configurePool.
+POOL_MINCONN = 1
+POOL_MAXCONN = 10
+POOL_IDLE_TIMEOUT = 300
+POOL_HEALTH_CHECK = True
+# Run the hot-path statements as prepared statements, see configurePool.
+PREPARED_STATEMENTS = True
+# Read replicas, see configurePool: seconds during which a thread reads
+# from the primary after it wrote, seconds a failed replica is skipped,
+# and seconds to wait for a replica connection before skipping it.
+READ_YOUR_WRITES = 5
+REPLICA_RETRY_INTERVAL = 30
+REPLICA_CONNECT_TIMEOUT = 2
+REPLICA_CHECKOUT_TIMEOUT = 1
+
+# Attempts made at a report that loses a deadlock or serialization
+# conflict, and the base of the exponential backoff between them, in
+# seconds. See _retried.
+TRANSIENT_RETRIES = 5
+RETRY_BACKOFF = 0.01
+
+# Maximum number of rows sent in a single multi-row INSERT.
+BULK_CHUNK_SIZE = 1000
+
+# Rows fetched at a time by iterStandings.
+STREAM_CHUNK_SIZE = 2000
+
+# Default settings of buffered match reporting, see configureWriteBuffer.
+WRITE_BUFFER_SIZE = 500
+WRITE_BUFFER_DELAY = 0.5
+
+# Elo rating of new players, K-factor, the most a rating moves in one
+# match, and rating difference at which the stronger player is expected
+# to score ten times as much. The PostgreSQL backend reads its own from
+# the elo_settings table of tournament.sql, which has the same values.
+ELO_INITIAL = 1500
+ELO_K = 32
+ELO_SCALE = 400
+
+# Tie-breaks playerStandings can add, in the order _TIEBREAKS_QUERY
+# returns them. All are in the same 2/1/0 point units as points:
+#   buchholz: sum of the opponents' points.
+#   median_buchholz: buchholz without the best and worst opponents, if
+#       there were at least three.
+#   sonneborn_berger: points of beaten opponents plus half the points of
+#       drawn ones.
+#   head_to_head: points scored against opponents now on equal points.
+# Byes count for none of them.
+TIEBREAKS = ('buchholz', 'median_buchholz', 'sonneborn_berger', 'head_to_head')
+
+# Violations of these matches constraints (see tournament.sql) are
+# reported by reportMatch as ValueError with the corresponding message.
+_REGISTRATION_ERROR = "At least one of players %(a)s, %(b)s isn't registered in tournament %(t)s"
+_MATCH_CONSTRAINT_ERRORS = {
+    'matches_player_a_registered': _REGISTRATION_ERROR,
+    'matches_player_b_registered': _REGISTRATION_ERROR,
+    'matches_pairing_unique': 'Pairing %(a)s, %(b)s already played in tournament %(t)s',
+}
+
+# Statements shared with async_tournament.py
+_INSERT_PLAYER = 'INSERT INTO players(name) VALUES (%s) RETURNING id'
+_INSERT_REGISTRATION = 'INSERT INTO tournament_players(player_id, tournament_id) VALUES (%s, %s)'
+# Class of the advisory locks on the match reports of a tournament: a
+# shared one taken by _INSERT_MATCH and an exclusive one by reportMatches,
+# whose checks must not be overtaken by another report.
+_REPORT_LOCK = 7201
+_INSERT_MATCH = '''
+INSERT INTO matches(tournament_id, player_a_id, player_b_id, winner_id)
+SELECT v.t, v.a, v.b, v.w
+FROM (VALUES (%%s::int, %%s::int, %%s::int, %%s::int)) AS v(t, a, b, w),
+     pg_advisory_xact_lock_shared(%d, v.t)
+RETURNING id
+''' % _REPORT_LOCK
+_STANDINGS_QUERY = '''
+SELECT players.id, players.name, s.wins, s.draws, s.matches, s.points
+FROM tournament_standings AS s JOIN players ON players.id = s.player_id
+WHERE s.tournament_id = %s
+ORDER BY s.points DESC, s.wins DESC, s.player_id
+'''
+_STANDINGS_PAGE_QUERY = _STANDINGS_QUERY + 'LIMIT %s OFFSET %s'
+# Every tie-break of every player of a tournament, in one pass over
+# its matches. Players without matches have no row.
+_TIEBREAKS_QUERY = '''
+WITH games AS (
+    SELECT player_a_id AS player_id, player_b_id AS opponent_id,
+           CASE winner_id WHEN player_a_id THEN 2 WHEN player_b_id THEN 0 ELSE 1 END AS score
+    FROM matches WHERE tournament_id = %(t)s
+    UNION ALL
+    SELECT player_b_id, player_a_id,
+           CASE winner_id WHEN player_b_id THEN 2 WHEN player_a_id THEN 0 ELSE 1 END
+    FROM matches WHERE tournament_id = %(t)s
+)
+SELECT g.player_id,
+       SUM(o.points),
+       SUM(o.points) - CASE WHEN COUNT(*) >= 3 THEN MAX(o.points) + MIN(o.points) ELSE 0 END,
+       SUM(o.points * g.score) / 2.0::float,
+       SUM(CASE WHEN o.points = me.points THEN g.score ELSE 0 END)
+FROM games AS g
+JOIN tournament_standings AS o
+  ON o.tournament_id = %(t)s AND o.player_id = g.opponent_id
+JOIN tournament_standings AS me
+  ON me.tournament_id = %(t)s AND me.player_id = g.player_id
+GROUP BY g.player_id
+'''
+# Players ahead of player %(p)s in the standings of tournament %(t)s, plus
+# one. No row if the player isn't registered.
+_RANK_QUERY = '''
+SELECT 1 + (SELECT COUNT(*) FROM tournament_standings AS s
+            WHERE s.tournament_id = me.tournament_id
+              AND s.points >= me.points
+              AND (s.points > me.points OR s.wins > me.wins
+                   OR (s.wins = me.wins AND s.player_id < me.player_id)))
+FROM tournament_standings AS me
+WHERE me.tournament_id = %(t)s AND me.player_id = %(p)s
+'''
+# Order in which swissPairings ranks players: by points, then rating
+_PAIRING_QUERY = '''
+SELECT players.id, players.name
+FROM tournament_standings AS s JOIN players ON players.id = s.player_id
+JOIN player_ratings AS r ON r.player_id = s.player_id
+WHERE s.tournament_id = %s
+ORDER BY s.points DESC, r.rating DESC, s.player_id
+'''
+_RATINGS_QUERY = '''
+SELECT r.player_id, r.rating, r.games
+FROM tournament_players AS tp JOIN player_ratings AS r ON r.player_id = tp.player_id
+WHERE tp.tournament_id = %s
+'''
+_PLAYED_PAIRS_QUERY = 'SELECT player_a_id, player_b_id FROM matches WHERE tournament_id = %s'
+_ELO_SETTINGS_QUERY = 'SELECT initial, k, scale FROM elo_settings'
+_MATCH_COUNT_QUERY = 'SELECT count(*) FROM matches WHERE tournament_id = %s'
+_HAD_BYE_QUERY = 'SELECT player_id FROM byes WHERE tournament_id = %s'
+_HAVE_PLAYED_QUERY = '''
+SELECT EXISTS (
+    SELECT 1 FROM matches
+    WHERE tournament_id = %(t)s
+          AND LEAST(player_a_id, player_b_id) = LEAST(%(a)s, %(b)s)
+          AND GREATEST(player_a_id, player_b_id) = GREATEST(%(a)s, %(b)s))
+'''
+_OPPONENTS_QUERY = '''
+SELECT player_b_id FROM matches WHERE tournament_id = %(t)s AND player_a_id = %(p)s
+UNION ALL
+SELECT player_a_id FROM matches WHERE tournament_id = %(t)s AND player_b_id = %(p)s
+ORDER BY 1
+'''
+_TOURNAMENT_PLAYERS_QUERY = 'SELECT player_id FROM tournament_players WHERE tournament_id = %s'
+_COUNT_PLAYERS = 'SELECT COUNT(*) from players'
+_INSERT_BYE = 'INSERT INTO byes(tournament_id, player_id) VALUES (%s, %s) RETURNING id'
+# Checks of reportMatches: which of %(players)s are registered in
+# tournament %(t)s, and the matches they played in it
+_REGISTERED_QUERY = '''
+SELECT player_id FROM tournament_players
+WHERE tournament_id = %(t)s AND player_id = ANY(%(players)s)
+'''
+_PLAYED_BY_QUERY = '''
+SELECT player_a_id, player_b_id FROM matches
+WHERE tournament_id = %(t)s AND player_a_id = ANY(%(players)s)
+UNION ALL
+SELECT player_a_id, player_b_id FROM matches
+WHERE tournament_id = %(t)s AND player_b_id = ANY(%(players)s)
+'''
+# Players whose stored standings differ from the standings view, in
+# tournament %(t)s or in all if NULL, see rebuildStandings
+_STANDINGS_DIFF_QUERY = '''
+(SELECT tournament_id, id, wins, draws, losses, matches, points
+ FROM standings WHERE %(t)s::int IS NULL OR tournament_id = %(t)s
+ EXCEPT
+ SELECT tournament_id, player_id, wins, draws, losses, matches, points
+ FROM tournament_standings WHERE %(t)s::int IS NULL OR tournament_id = %(t)s)
+UNION
+(SELECT tournament_id, player_id, wins, draws, losses, matches, points
+ FROM tournament_standings WHERE %(t)s::int IS NULL OR tournament_id = %(t)s
+ EXCEPT
+ SELECT tournament_id, id, wins, draws, losses, matches, points
+ FROM standings WHERE %(t)s::int IS NULL OR tournament_id = %(t)s)
+'''
+# Versions of the above for a list of tournaments, see swissPairingsMany
+_STANDINGS_MANY_QUERY = '''
+SELECT s.tournament_id, players.id, players.name, s.wins, s.draws, s.matches, s.points
+FROM tournament_standings AS s JOIN players ON players.id = s.player_id
+WHERE s.tournament_id = ANY(%s)
+ORDER BY s.tournament_id, s.points DESC, s.wins DESC, s.player_id
+'''
+_PAIRING_MANY_QUERY = '''
+SELECT s.tournament_id, players.id, players.name
+FROM tournament_standings AS s JOIN players ON players.id = s.player_id
+JOIN player_ratings AS r ON r.player_id = s.player_id
+WHERE s.tournament_id = ANY(%s)
+ORDER BY s.tournament_id, s.points DESC, r.rating DESC, s.player_id
+'''
+_PLAYED_PAIRS_MANY_QUERY = 'SELECT tournament_id, player_a_id, player_b_id FROM matches WHERE tournament_id = ANY(%s)'
+_HAD_BYE_MANY_QUERY = 'SELECT tournament_id, player_id FROM byes WHERE tournament_id = ANY(%s)'
+# Standings snapshot of round %s of tournament %s, see closeRound
+_SNAPSHOT_STANDINGS = '''
+INSERT INTO round_standings(tournament_id, round, player_id, wins, draws,
+                            losses, matches, points)
+SELECT tournament_id, %s, player_id, wins, draws, losses, matches, points
+FROM tournament_standings WHERE tournament_id = %s
+'''
+_ROUND_STANDINGS_QUERY = '''
+SELECT players.id, players.name, s.wins, s.draws, s.matches, s.points
+FROM round_standings AS s JOIN players ON players.id = s.player_id
+WHERE s.tournament_id = %s AND s.round = %s
+ORDER BY s.points DESC, s.wins DESC, s.player_id
+'''
+# Statements of the delete functions, run in one transaction, for all
+# tournaments or for the one passed as %(t)s. Whole tables are emptied
+# with TRUNCATE, CASCADE following the same foreign keys as a DELETE
+# would. A single tournament's rows are deleted, cascading to those
+# referencing them, so that the other tournaments are not locked. Neither
+# TRUNCATE nor, with tournament.bulk_delete set (see tournament.sql), a
+# DELETE runs the standings triggers: the standings the deleted matches
+# and byes contributed to are reset explicitly.
+_RESET_STANDINGS = ('UPDATE tournament_standings '
+                    'SET wins = 0, draws = 0, losses = 0, matches = 0, points = 0')
+_BULK_DELETE = "SET LOCAL tournament.bulk_delete = 'on'"
+_DELETE_ALL = {
+    'tournaments': ['TRUNCATE tournaments CASCADE'],
+    'players': ['TRUNCATE players CASCADE'],
+    'tournament_players': ['TRUNCATE tournament_players CASCADE'],
+    'matches': ['TRUNCATE matches, byes, rounds CASCADE', _RESET_STANDINGS],
+    'everything': ['TRUNCATE players, tournaments CASCADE'],
+}
+_DELETE_TOURNAMENT = {
+    'tournaments': [_BULK_DELETE,
+                    'DELETE FROM tournaments WHERE id = %(t)s'],
+    'tournament_players': [_BULK_DELETE,
+                           'DELETE FROM tournament_players WHERE tournament_id = %(t)s'],
+    'matches': [_BULK_DELETE,
+                'DELETE FROM matches WHERE tournament_id = %(t)s',
+                'DELETE FROM byes WHERE tournament_id = %(t)s',
+                'DELETE FROM rounds WHERE tournament_id = %(t)s',
+                _RESET_STANDINGS + ' WHERE tournament_id = %(t)s'],
+}
+
+# Statements run with PREPARE/EXECUTE, by name. Each connection prepares
+# them on first use.
+_PREPARED_NAMES = {
+    _INSERT_MATCH: 'tournament_insert_match',
+    _STANDINGS_QUERY: 'tournament_standings',
+    _PAIRING_QUERY: 'tournament_pairing_order',
+    _TOURNAMENT_PLAYERS_QUERY: 'tournament_players',
+    _PLAYED_PAIRS_QUERY: 'tournament_played_pairs',
+    _MATCH_COUNT_QUERY: 'tournament_match_count',
+    _HAD_BYE_QUERY: 'tournament_had_bye',
+}
+
+_pool = None
+_pool_lock = threading.Lock()
+_use_prepared = PREPARED_STATEMENTS
+# ReplicaPools of the read replicas, None without replicas.
+_replicas = None
+_read_your_writes = READ_YOUR_WRITES
+_local = threading.local()
+# Names of the server-side cursors opened by iterStandings
+_cursor_names = itertools.count()
+
+# Cache of playerStandings and tournamentPlayers results, keyed by
+# (tournament id, kind). Disabled until configureCache is called.
+_CACHED_KINDS = ('standings', 'players', 'tiebreaks')
+_cache = None
+_invalidation_listeners = []
+
+# Pairs of players who have met, per tournament, loaded on first use by
+# havePlayed and opponents and updated by the reports made outside a
+# Session. Other writes drop them. Enabled with the cache, under the same
+# invalidation contract, by configureCache.
+_played_pairs = None
+
+# Statement and connection timings. Disabled until configureMetrics is
+# called. Slow statements are logged here.
+_metrics = None
+_slow_query_threshold = None
+_metrics_exporters = []
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# Buffer of reportMatch results. Disabled until configureWriteBuffer is
+# called.
+_write_buffer = None
+
+
+def connect(database_name=DBNAME, dsn=None):
     """Connect to the PostgreSQL database.
 
+    Note:
+        This opens a new, unpooled connection. Module functions use
+        the connection pool instead (see configurePool and Session).
+
+    Args:
+        database_name: name of the database to connect to.
+        dsn: libpq connection string, such as that of a replica, used
+             instead of database_name.
+
     Returns:
         Tuple of database connection, cursor.
     """
-    db = psycopg2.connect("dbname=%s" % database_name)
+    db = _connect(dsn or "dbname=%s" % database_name)
     return db, db.cursor()
 
 
-def _query(query, vals=(), commit=False, post_exec=None):
+class _Connection(psycopg2.extensions.connection):
+    '''Connection remembering which statements it has prepared'''
+
+    def __init__(self, *args, **kwargs):
+        super(_Connection, self).__init__(*args, **kwargs)
+        self.prepared = set()
+
+
+class _InstrumentedCursor(psycopg2.extensions.cursor):
+    '''Cursor timing its statements while metrics are enabled'''
+
+    def execute(self, query, vars=None):
+        if _metrics is None:
+            return super(_InstrumentedCursor, self).execute(query, vars)
+        start = time.time()
+        try:
+            return super(_InstrumentedCursor, self).execute(query, vars)
+        finally:
+            _recordQuery(query, vars, time.time() - start)
+
+
+def _connect(dsn, **kwargs):
+    '''Open a connection with instrumented cursors, timing it
+
+    kwargs are connection parameters added to those of dsn.
+    '''
+    start = time.time()
+    db = psycopg2.connect(dsn, connection_factory=_Connection,
+                          cursor_factory=_InstrumentedCursor, **kwargs)
+    metrics = _metrics
+    if metrics is not None:
+        seconds = time.time() - start
+        metrics.record_connect(seconds)
+        for exporter in _metrics_exporters:
+            exporter('connect', None, None, seconds)
+    return db
+
+
+def _recordQuery(query, vals, seconds):
+    metrics = _metrics
+    if metrics is None:
+        return
+    function = getattr(_local, 'function', None)
+    statement = metrics.record(function, query, seconds)
+    if _slow_query_threshold is not None and seconds >= _slow_query_threshold:
+        _log.warning('Slow query in %s (%.3fs): %s %r', function, seconds, query, vals)
+    for exporter in _metrics_exporters:
+        exporter('query', function, statement, seconds)
+
+
+def configurePool(database_name=DBNAME,
+                  minconn=POOL_MINCONN,
+                  maxconn=POOL_MAXCONN,
+                  idle_timeout=POOL_IDLE_TIMEOUT,
+                  health_check=POOL_HEALTH_CHECK,
+                  prepared_statements=PREPARED_STATEMENTS,
+                  dsn=None,
+                  replicas=(),
+                  read_your_writes=READ_YOUR_WRITES):
+    """(Re)create the connection pool used by all module functions.
+
+    Any existing pool is closed. If this is never called, a pool with
+    the default settings is created on first use.
+
+    Reads made outside a Session, and the read-only sessions of
+    swissPairings, swissPairingsMany and iterStandings, go to the
+    replicas in turn, each with a pool of its own with the same
+    settings. A replica that can't be connected to within
+    REPLICA_CONNECT_TIMEOUT seconds, or whose pool has no free connection
+    within REPLICA_CHECKOUT_TIMEOUT seconds, is skipped for
+    REPLICA_RETRY_INTERVAL seconds; reads go to the primary while every
+    replica is down. Results loaded into the cache (see configureCache)
+    and everything in a Session are read from the primary.
+
+    Args:
+        database_name: name of the database to connect to.
+        minconn: number of connections kept open when idle.
+        maxconn: maximum number of simultaneous connections.
+        idle_timeout: seconds after which idle connections above minconn
+                      are closed. None keeps them open forever.
+        health_check: check connections with a trivial query on checkout.
+        prepared_statements: run the most frequent statements with
+                             PREPARE/EXECUTE, saving their parsing and
+                             planning on every call. Disable it behind a
+                             pooler that doesn't keep server sessions,
+                             such as PgBouncer in transaction mode.
+        dsn: libpq connection string of the primary server, used
+             instead of database_name.
+        replicas: libpq connection strings of read replicas of the
+                  primary.
+        read_your_writes: seconds during which a thread that wrote reads
+                          from the primary, so that it sees its writes
+                          despite replication lag. None or 0 always
+                          reads from replicas.
+
+    Returns:
+        The new ConnectionPool of the primary
+    """
+    global _pool, _use_prepared, _replicas, _read_your_writes
+    with _pool_lock:
+        _use_prepared = prepared_statements
+        _read_your_writes = read_your_writes
+        if _pool is not None:
+            _pool.closeall()
+        if _replicas is not None:
+            _replicas.closeall()
+        settings = dict(maxconn=maxconn,
+                        idle_timeout=idle_timeout,
+                        health_check=health_check,
+                        connect=_connect)
+        _pool = ConnectionPool(dsn or "dbname=%s" % database_name,
+                               minconn=minconn, **settings)
+        settings.update(checkout_timeout=REPLICA_CHECKOUT_TIMEOUT,
+                        connect=lambda dsn: _connect(dsn, connect_timeout=REPLICA_CONNECT_TIMEOUT))
+        _replicas = (ReplicaPools(list(replicas), REPLICA_RETRY_INTERVAL, **settings)
+                     if replicas else None)
+    return _pool
+
+
+def closePool():
+    """Close all pooled connections. A new pool is created on next use."""
+    global _pool, _replicas
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+        if _replicas is not None:
+            _replicas.closeall()
+        _pool = None
+        _replicas = None
+
+
+def replicaStats():
+    """Return the state of the read replicas set by configurePool.
+
+    Returns:
+        List with, for every replica, a dict with its dsn, the number of
+        'idle' and 'used' connections of its pool, the number of
+        'checkouts' made from it and whether it is marked 'down'.
+    """
+    replicas = _replicas
+    return [] if replicas is None else replicas.stats()
+
+
+def configureCache(maxsize=128):
+    """Enable, resize or disable the in-process read cache.
+
+    playerStandings and tournamentPlayers results are cached per
+    tournament and invalidated by this module's write functions. Writes
+    made by other processes are only seen after invalidateCache is called
+    (see addInvalidationListener). The cache includes the played-pairs
+    index that answers havePlayed and opponents, and spares swissPairings
+    and the write buffer (see configureWriteBuffer) reading the pairs
+    played unless other processes reported matches.
+
+    Args:
+        maxsize: maximum number of cached results, with least recently
+                 used eviction. 0 or None disables the cache.
+    """
+    global _cache, _played_pairs
+    _cache = LRUCache(maxsize) if maxsize else None
+    _played_pairs = PlayedPairsIndex(_loadPlayedPairs) if maxsize else None
+
+
+def cacheStats():
+    """Return a dict of cache hits, misses, evictions and size, or None if
+    the cache is disabled."""
+    return None if _cache is None else _cache.stats()
+
+
+def configureMetrics(enabled=True, slow_query_threshold=None,
+                     buckets=DEFAULT_BUCKETS):
+    """Enable or disable timing of SQL statements and connection opens.
+
+    Statements are counted, and their latencies kept in histograms, per
+    public function that issued them (the outermost one for functions
+    calling each other) and per statement text with literals replaced by
+    '?'. Enabling resets the figures.
+
+    Args:
+        enabled: False stops collecting and drops the figures.
+        slow_query_threshold: statements taking at least this many seconds
+                              are logged as warnings, with their
+                              parameters, by the 'tournament' logger.
+                              None disables the log.
+        buckets: increasing upper bounds, in seconds, of the histogram
+                 buckets.
+    """
+    global _metrics, _slow_query_threshold
+    _slow_query_threshold = slow_query_threshold
+    _metrics = QueryMetrics(buckets) if enabled else None
+
+
+def queryStats():
+    """Return a snapshot of the statement and connection timings, or None
+    if metrics are disabled. See metrics.QueryMetrics.snapshot."""
+    return None if _metrics is None else _metrics.snapshot()
+
+
+def resetQueryStats():
+    """Zero the statement and connection timings."""
+    if _metrics is not None:
+        _metrics.reset()
+
+
+def addMetricsExporter(callback):
+    """Call callback(kind, function, statement, seconds) after each timing.
+
+    kind is 'query' or 'connect'. For queries, function is the public
+    function that issued the statement (None outside one) and statement
+    its normalized text; both are None for connections. Use it to forward
+    timings to a monitoring system.
+    """
+    _metrics_exporters.append(callback)
+
+
+def configureWriteBuffer(journal=None, max_size=WRITE_BUFFER_SIZE,
+                         max_delay=WRITE_BUFFER_DELAY, sync=True):
+    """Enable or disable buffered reporting of match results.
+
+    While enabled, reportMatch called outside a Session checks the result
+    against the registrations and the pairs already played, buffered ones
+    included, appends it to the journal file and returns without writing
+    it. Buffered results are written with one commit when max_size of them
+    have accumulated, when the oldest has waited max_delay seconds, or
+    when flush is called. Every other public function flushes first, so
+    standings and pairings always include them.
+
+    Results left in the journal by a process that stopped before writing
+    them are written by the first flush. The buffer is flushed when the
+    interpreter exits.
+
+    Note:
+        Buffered results are written on a pooled connection of their own,
+        which must be available even if the flushing thread holds one in
+        a Session.
+
+    Args:
+        journal: path of the journal file. None flushes and disables
+                 buffering.
+        max_size: number of buffered results that triggers a write.
+        max_delay: seconds a result may wait before it is written. None
+                   only writes by size and on flush.
+        sync: fsync the journal after each result. Without it, buffered
+              results survive a crash of the process but not of the
+              machine.
+    """
+    global _write_buffer
+    old, _write_buffer = _write_buffer, None
+    if old is not None:
+        old.close()
+    if journal is not None:
+        _write_buffer = ResultBuffer(journal, _bufferedState, _writeBuffered,
+                                     max_size=max_size, max_delay=max_delay,
+                                     sync=sync)
+
+
+atexit.register(configureWriteBuffer)
+
+
+def flush():
+    """Write the buffered match results now, see configureWriteBuffer.
+
+    Returns:
+        List of (tournament, (player_a, player_b, winner), reason) of the
+        buffered results rejected when written, which are dropped. This
+        happens if a pair was also reported by another process, or a
+        player was unregistered meanwhile. Empty if buffering is disabled.
+    """
+    return [] if _write_buffer is None else _write_buffer.flush()
+
+
+def _bufferedState(tournament):
+    '''Registered players and played pairs of a tournament, for the buffer'''
+    # From the primary: results are checked against this state
+    indexed = _indexedPairs(tournament)
+    with Session(commit=False):
+        registered = _select(_TOURNAMENT_PLAYERS_QUERY, (tournament,), replica=False)
+        played = _playedPairs(tournament, indexed, replica=False)
+    return [row[0] for row in registered], list(played)
+
+
+def _loadPlayedPairs(tournament):
+    '''Load the played pairs of tournament for _played_pairs, from the
+    primary, which every later report will be added to'''
+    return _select(_PLAYED_PAIRS_QUERY, (tournament,), replica=False)
+
+
+def _indexedPairs(tournament):
+    '''The PlayedPairs of tournament if the index is enabled and this
+    thread is outside a Session, else None'''
+    played_pairs = _played_pairs
+    if played_pairs is None or getattr(_local, 'session', None) is not None:
+        return None
+    return played_pairs.get(tournament)
+
+
+def _playedPairs(tournament, indexed=None, replica=True):
+    '''The pairKeys of the matches of tournament, as a set or PlayedPairs
+
+    indexed is the result of _indexedPairs, taken before the caller's
+    Session. It is used unless the database has more matches than it,
+    which means another process reported some: the pairs are then read
+    from the database and the index of tournament dropped.
+    '''
+    if indexed is not None:
+        (count,), = _select(_MATCH_COUNT_QUERY, (tournament,), replica=replica)
+        if count <= len(indexed):
+            return indexed
+        played_pairs = _played_pairs
+        if played_pairs is not None:
+            played_pairs.discard(tournament)
+    return set(pairKey(a, b) for a, b in
+               _select(_PLAYED_PAIRS_QUERY, (tournament,), replica=replica))
+
+
+def _writeBuffered(groups):
+    '''Write the results of the buffer in a transaction of their own
+
+    Returns:
+        List of (tournament, entry, reason) of the rejected results.
+    '''
+    # Detached from the Session of this thread, if any, so that the
+    # results don't depend on its outcome
+    session = getattr(_local, 'session', None)
+    function = getattr(_local, 'function', None)
+    _local.session = _local.function = None
+    rejected = []
+    try:
+        with Session():
+            for tournament, results in sorted(groups.items()):
+                try:
+                    reportMatches(tournament, results)
+                except MatchReportError as e:
+                    # Nothing was written: retry without the rejected results
+                    failed = set(f[0] for f in e.failures)
+                    rejected.extend((tournament, entry, reason)
+                                    for _, entry, reason in e.failures)
+                    reportMatches(tournament, [r for i, r in enumerate(results)
+                                               if i not in failed])
+    finally:
+        _local.session = session
+        _local.function = function
+    return rejected
+
+
+def invalidateCache(tournament=None):
+    """Drop cached results for a tournament, or for all if it is None.
+
+    This is the hook for invalidations coming from other processes that
+    share the database. It doesn't call the invalidation listeners. The
+    played-pairs index, and the registrations and pairs loaded by the
+    write buffer, are dropped too.
+    """
+    if _played_pairs is not None:
+        _played_pairs.discard(tournament)
+    _discardCached(tournament)
+
+
+def _discardCached(tournament):
+    '''Drop the cached results and write buffer state of tournament'''
+    if _write_buffer is not None:
+        _write_buffer.forget(tournament)
+    if _cache is None:
+        return
+    if tournament is None:
+        _cache.clear()
+    else:
+        _cache.discard(*[(tournament, kind) for kind in _CACHED_KINDS])
+
+
+def addInvalidationListener(callback):
+    """Call callback(tournament) after each committed write.
+
+    tournament is the id of the modified tournament, or None if the write
+    may have affected all tournaments. Use it to broadcast invalidations
+    to other processes, which then call invalidateCache.
+    """
+    _invalidation_listeners.append(callback)
+
+
+def _notifyListeners(tournament):
+    for callback in _invalidation_listeners:
+        callback(tournament)
+
+
+def _invalidate(tournament=None, played=()):
+    '''Drop cached results after a write to tournament (all if None)
+
+    played lists the (player_a, player_b) of the matches the write added.
+    Outside a Session, where the write is committed, they are added to
+    the played-pairs index, if enabled, rather than dropping it.
+
+    Inside a Session, the invalidation is repeated, and listeners are
+    notified, when the session ends, so that nothing read before the
+    commit stays cached.
+    '''
+    session = getattr(_local, 'session', None)
+    if played and session is None and _played_pairs is not None:
+        _played_pairs.add(tournament, played)
+        _discardCached(tournament)
+    else:
+        invalidateCache(tournament)
+    if session is not None:
+        session.dirty.add(tournament)
+    else:
+        _notifyListeners(tournament)
+
+
+def _cached(tournament, kind, load):
+    '''Return load() through the cache, bypassing it inside a Session'''
+    if _cache is None or getattr(_local, 'session', None) is not None:
+        return load()
+    return _cache.get_or_load((tournament, kind), functools.partial(_onPrimary, load))
+
+
+def _onPrimary(load):
+    '''Return load(), reading from the primary
+
+    A result read from a lagging replica would stay cached after the
+    invalidation of the write it missed.
+    '''
+    with Session(commit=False):
+        return load()
+
+
+# Storage backend of the public API, see useBackend. None means the
+# PostgreSQL implementation in this module.
+_backend = None
+_BACKEND_API = ['transaction']
+
+
+def useBackend(backend):
+    """Route the public API to another storage backend.
+
+    Args:
+        backend: object with a method for every public function of this
+                 module that accesses storage, taking the same arguments
+                 and raising the same errors, plus a transaction(commit)
+                 context manager used by Session. See
+                 memory_backend.MemoryBackend. None restores PostgreSQL.
+
+    Raises:
+        TypeError if backend lacks part of the API.
+    """
+    global _backend
+    if backend is not None:
+        missing = [name for name in _BACKEND_API
+                   if not callable(getattr(backend, name, None))]
+        if missing:
+            raise TypeError('Backend lacks %s' % ', '.join(missing))
+    _backend = backend
+
+
+def getBackend():
+    """Return the backend set with useBackend, or None for PostgreSQL."""
+    return _backend
+
+
+def _dispatch(func):
+    '''Decorator routing a public function to the active backend'''
+    _BACKEND_API.append(func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _backend is not None:
+            return getattr(_backend, func.__name__)(*args, **kwargs)
+        if _write_buffer is not None and func.__name__ != 'reportMatch':
+            # Everything but buffering itself sees the buffered results.
+            # A thread holding a Session's connection doesn't wait for
+            # another thread's write, which may be waiting for one.
+            _write_buffer.flush(wait=getattr(_local, 'session', None) is None)
+        if inspect.isgeneratorfunction(func):
+            # The body runs as the generator is consumed, after this returns
+            return _attributed(func.__name__, func(*args, **kwargs))
+        # Statements are attributed to the outermost public function
+        if getattr(_local, 'function', None) is not None:
+            return func(*args, **kwargs)
+        _local.function = func.__name__
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.function = None
+    return wrapper
+
+
+def _attributed(name, generator):
+    '''Yield from generator, attributing the statements of each step to
+    name unless made within another public function'''
+    try:
+        while True:
+            outer = getattr(_local, 'function', None)
+            if outer is None:
+                _local.function = name
+            try:
+                item = next(generator)
+            except StopIteration:
+                return
+            finally:
+                if outer is None:
+                    _local.function = None
+            yield item
+    finally:
+        # Releases the generator's connection when this one is closed
+        generator.close()
+
+
+def _getPool():
+    '''Return the module connection pool, creating it if needed'''
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool("dbname=%s" % DBNAME,
+                                       minconn=POOL_MINCONN,
+                                       maxconn=POOL_MAXCONN,
+                                       idle_timeout=POOL_IDLE_TIMEOUT,
+                                       health_check=POOL_HEALTH_CHECK,
+                                       connect=_connect)
+    return _pool
+
+
+def _checkout(replica=False):
+    """Check a connection out of a replica, or of the primary.
+
+    Args:
+        replica: use a replica if any is up, unless the thread wrote
+                 less than read_your_writes seconds ago.
+
+    Returns:
+        (pool, connection) tuple. The connection must be returned with
+        pool.putconn.
+    """
+    replicas = _replicas
+    if (replica and replicas is not None and
+            time.time() - getattr(_local, 'last_write', 0) >= (_read_your_writes or 0)):
+        checkout = replicas.getconn()
+        if checkout is not None:
+            return checkout
+    pool = _getPool()
+    return pool, pool.getconn()
+
+
+class Session(object):
+    """Run several module operations on one pooled connection.
+
+    While a session is active in a thread, every module function called
+    from that thread uses the session's connection, and all statements
+    form a single transaction. It is committed when the block exits
+    normally and rolled back if it raises. Nested sessions join the
+    outermost one.
+
+    A session runs on the primary, unless replica is True and read
+    replicas are configured (see configurePool): it then runs on a
+    replica, or on the primary while none is up or the thread has just
+    written, and is read-only. Nested sessions join the outermost one
+    whatever their replica argument.
+    Once a session commits on the primary, the thread reads from the
+    primary for read_your_writes seconds.
+
+    Note:
+        After a statement fails inside a session the transaction is
+        aborted, so the error should be allowed to leave the block.
+
+        With a backend other than PostgreSQL (see useBackend), the session
+        is a transaction of that backend and has no connection.
+
+    Example:
+        with Session():
+            p1 = registerPlayer('Alice', (t,))
+            p2 = registerPlayer('Bob', (t,))
+            reportMatch(p1, p2, p1, t)
+    """
+
+    def __init__(self, commit=True, replica=False):
+        self.commit = commit
+        self.replica = replica
+        self.connection = None
+        self.dirty = set()
+        self._pool = None
+        self._transaction = None
+        self._owner = False
+
+    def __enter__(self):
+        current = getattr(_local, 'session', None)
+        if current is not None:
+            self.connection = current.connection
+            return self
+        if _backend is not None:
+            self._transaction = _backend.transaction(self.commit)
+            self._transaction.__enter__()
+        else:
+            self._pool, self.connection = _checkout(self.replica)
+            if self.replica and _replicas is not None and not self._onReplica():
+                # Replica connections are read-only, and so is the
+                # session when it falls back to the primary
+                try:
+                    self.connection.cursor().execute('SET TRANSACTION READ ONLY')
+                except psycopg2.Error:
+                    self._pool.putconn(self.connection)
+                    raise
+        self._owner = True
+        _local.session = self
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not self._owner:
+            return False
+        _local.session = None
+        committed = False
+        try:
+            if self._transaction is not None:
+                self._transaction.__exit__(exc_type, exc, tb)
+                committed = exc_type is None and self.commit
+            elif exc_type is None and self.commit:
+                self.connection.commit()
+                committed = True
+                if not self._onReplica():
+                    _local.last_write = time.time()
+        finally:
+            if self.connection is not None:
+                if isinstance(exc, psycopg2.OperationalError) and self._onReplica():
+                    _replicas.markDown(self._pool)
+                # putconn rolls back anything left uncommitted
+                self._pool.putconn(self.connection)
+                self.connection = None
+            for tournament in self.dirty:
+                invalidateCache(tournament)
+                if committed:
+                    _notifyListeners(tournament)
+        return False
+
+    def _onReplica(self):
+        return _replicas is not None and self._pool in _replicas.pools
+
+    def cursor(self):
+        '''Return a new cursor on the session's connection'''
+        if self.connection is None:
+            raise NotImplementedError('Session has no connection with this backend')
+        return self.connection.cursor()
+
+
+def _query(query, vals=(), commit=False, post_exec=None, replica=False):
     '''Generic configurable query
 
+    Runs on the current thread's Session if there is one, otherwise on a
+    connection checked out of the pool for this statement only, of a
+    replica if replica is True.
+
     Returns:
         Result of the query
     '''
-    c, cur = connect()
-    cur.execute(query, vals)
-    if commit:
-        c.commit()
-    res = None if post_exec is None else post_exec(cur)
-    c.close()
-    return res
+    with Session(commit=commit, replica=replica) as session:
+        cur = session.cursor()
+        name = _PREPARED_NAMES.get(query) if _use_prepared else None
+        if name is None:
+            cur.execute(query, vals)
+        else:
+            _executePrepared(cur, name, query, vals)
+        return None if post_exec is None else post_exec(cur)
+
+
+def _executePrepared(cur, name, query, vals):
+    '''Execute query as the prepared statement name, preparing it if needed'''
+    if name not in cur.connection.prepared:
+        # PREPARE takes $n placeholders. It isn't undone by a rollback.
+        placeholders = itertools.count(1)
+        cur.execute('PREPARE %s AS %s'
+                    % (name, re.sub('%s', lambda m: '$%d' % next(placeholders), query)))
+        cur.connection.prepared.add(name)
+    cur.execute('EXECUTE %s (%s)' % (name, ', '.join(['%s'] * len(vals))), vals)
 
 
 def _insert(query, vals=()):
@@ -44,59 +1014,155 @@ def _insert(query, vals=()):
     return _query(query, vals, commit=True, post_exec=lambda c: c.fetchone()[0])
 
 
-def _select(query, vals=()):
-    '''Select a row and return it'''
-    return _query(query, vals, post_exec=lambda c: c.fetchall())
+def _select(query, vals=(), replica=True):
+    '''Select rows and return them, from a replica outside a Session'''
+    return _query(query, vals, post_exec=lambda c: c.fetchall(), replica=replica)
 
 
-def _delete(query, vals=()):
-    '''Delete a row'''
-    _query(query, vals, commit=True)
+def _delete(statements, tournament=None):
+    '''Run the statements of a delete function in one transaction'''
+    with Session() as session:
+        cur = session.cursor()
+        for statement in statements:
+            cur.execute(statement, {'t': tournament})
 
 
-def deleteTournaments():
-    '''Remove all the tournaments from the database.'''
-    _delete('DELETE FROM tournaments')
+def _chunks(seq, size=BULK_CHUNK_SIZE):
+    '''Split a sequence into consecutive slices of at most size elements'''
+    for i in xrange(0, len(seq), size):
+        yield seq[i:i + size]
 
 
+def _values(cur, template, rows):
+    '''Render rows as the body of a multi-row VALUES clause'''
+    values = [cur.mogrify(template, row) for row in rows]
+    if not isinstance(template, bytes):
+        # Python 3: mogrify returns bytes, the statement is text
+        encoding = psycopg2.extensions.encodings[cur.connection.encoding]
+        values = [v.decode(encoding) for v in values]
+    return ','.join(values)
+
+
+class DuplicateRegistrationError(ValueError):
+    '''Raised when a bulk registration contains players already registered
+
+    Attributes:
+        duplicates: sorted list of offending (player_id, tournament_id) pairs
+    '''
+
+    def __init__(self, duplicates):
+        ValueError.__init__(
+            self,
+            'Players already registered: %s'
+            % ', '.join('%s in tournament %s' % d for d in duplicates))
+        self.duplicates = duplicates
+
+
+class MatchReportError(ValueError):
+    '''Raised when a batch of match results contains invalid entries
+
+    Attributes:
+        failures: list of (index, entry, reason) for every rejected entry,
+                  where index is the entry's position in the batch.
+    '''
+
+    def __init__(self, failures):
+        ValueError.__init__(
+            self,
+            '%d invalid match result(s): %s'
+            % (len(failures),
+               '; '.join('#%d %s: %s' % f for f in failures)))
+        self.failures = failures
+
+
+class PairingError(ValueError):
+    '''Raised when some tournaments passed to swissPairingsMany can't be paired
+
+    Attributes:
+        failures: dict of tournament id to the reason it couldn't be paired.
+        pairings: dict of tournament id to the pairings of the others.
+    '''
+
+    def __init__(self, failures, pairings):
+        ValueError.__init__(
+            self,
+            '%d tournament(s) could not be paired: %s'
+            % (len(failures),
+               '; '.join('%s: %s' % f for f in sorted(failures.items()))))
+        self.failures = failures
+        self.pairings = pairings
+
+
+@_dispatch
+def deleteTournaments(tournament=None):
+    """Remove tournaments, with their registrations, matches, byes and
+    rounds, from the database.
+
+    Args:
+        tournament: id of the tournament to remove. If None, all
+                    tournaments are removed.
+    """
+    if tournament is not None:
+        _delete(_DELETE_TOURNAMENT['tournaments'], tournament)
+    else:
+        _delete(_DELETE_ALL['tournaments'])
+    _invalidate(tournament)
+
+
+@_dispatch
 def deleteMatches(tournament=None):
-    """Remove match records from the database.
+    """Remove match records, byes and rounds from the database.
 
     Args:
         tournament: id of tournament whose matches must be deleted. If
                     None, all matches are deleted.
     """
     if tournament is not None:
-        _delete('DELETE FROM matches WHERE tournament_id = %s',
-                (tournament,))
+        _delete(_DELETE_TOURNAMENT['matches'], tournament)
     else:
-        _delete('DELETE FROM matches')
+        _delete(_DELETE_ALL['matches'])
+    _invalidate(tournament)
 
 
+@_dispatch
 def deleteTournamentPlayers(tournament=None):
     """Remove tournamend player registries from the database.
 
+    Matches between the unregistered players are deleted with them.
+
     Args:
         tournament: id of tournament whose matches player registry will be deleted.
                     If None, all registries are deleted.
     """
     if tournament is not None:
-        _delete('DELETE FROM tournament_players WHERE tournament_id = %s',
-                (tournament,))
+        _delete(_DELETE_TOURNAMENT['tournament_players'], tournament)
     else:
-        _delete('DELETE FROM tournament_players')
+        _delete(_DELETE_ALL['tournament_players'])
+    _invalidate(tournament)
 
 
+@_dispatch
 def deletePlayers():
     """Remove all the player records from the database."""
-    _delete('DELETE FROM players')
+    _delete(_DELETE_ALL['players'])
+    _invalidate()
+
 
+@_dispatch
+def resetAll():
+    """Remove all players and tournaments, and everything about them,
+    from the database, in one transaction."""
+    _delete(_DELETE_ALL['everything'])
+    _invalidate()
 
+
+@_dispatch
 def countPlayers():
     """Returns the number of players currently registered."""
-    return _select('SELECT COUNT(*) from players;')[0][0]
+    return _select(_COUNT_PLAYERS)[0][0]
 
 
+@_dispatch
 def registerTournament(name):
     """Adds a tournament to the tournament database.
 
@@ -109,6 +1175,7 @@ def registerTournament(name):
     return _insert('INSERT INTO tournaments(name) VALUES (%s) RETURNING id', (name,))
 
 
+@_dispatch
 def registerPlayer(name, tournaments=()):
     """Adds a player to the global tournament database.
 
@@ -124,20 +1191,107 @@ def registerPlayer(name, tournaments=()):
     Returns:
         ID of registered player
     """
-    player_id = _insert('INSERT INTO players(name) VALUES (%s) RETURNING id', (name,))
+    player_id = _insert(_INSERT_PLAYER, (name,))
     for tournament_id in tournaments:
         registerPlayerToTournament(player_id, tournament_id)
 
     return player_id
 
 
+@_dispatch
+def registerPlayers(names, tournaments=()):
+    """Adds many players to the global tournament database at once.
+
+    All players are inserted, and registered to the tournaments, in a
+    single transaction using multi-row inserts.
+
+    Args:
+      names: iterable with the players' full names.
+      tournaments(optional): Iterable with IDs of tournaments to which all
+      these players should be registered.
+
+    Returns:
+        List of IDs of the registered players, in the same order as names
+
+    Raises:
+        DuplicateRegistrationError if tournaments contains repeated IDs.
+        Nothing is stored in that case.
+    """
+    names = list(names)
+    player_ids = []
+    with Session() as session:
+        cur = session.cursor()
+        for chunk in _chunks(names):
+            cur.execute('INSERT INTO players(name) VALUES %s RETURNING id'
+                        % _values(cur, '(%s)', [(name,) for name in chunk]))
+            player_ids.extend(row[0] for row in cur.fetchall())
+        for tournament_id in tournaments:
+            registerPlayersToTournament(player_ids, tournament_id)
+
+    return player_ids
+
+
+@_dispatch
+def tournamentName(tournament):
+    '''Return the name of tournament, or None if it doesn't exist'''
+    res = _select('SELECT name FROM tournaments WHERE id = %s', (tournament,))
+    return res[0][0] if res else None
+
+
+@_dispatch
 def tournamentPlayers(tournament):
     '''Return tuple of player IDs of players registered in tournament'''
-    res = _select('SELECT player_id FROM tournament_players WHERE tournament_id = %s',
+    def load():
+        res = _select(_TOURNAMENT_PLAYERS_QUERY, (tournament,))
+        return tuple(p[0] for p in res)
+
+    return _cached(tournament, 'players', load)
+
+
+@_dispatch
+def tournamentMatches(tournament):
+    '''Return list of (player_a, player_b, winner) of the matches played in
+    tournament, in the order they were reported. winner is None for draws.'''
+    return _select('SELECT player_a_id, player_b_id, winner_id FROM matches '
+                   'WHERE tournament_id = %s ORDER BY id', (tournament,))
+
+
+@_dispatch
+def tournamentByes(tournament):
+    '''Return list of IDs of the players given a bye in tournament, once per
+    bye, in the order they were reported.'''
+    res = _select('SELECT player_id FROM byes WHERE tournament_id = %s ORDER BY id',
                   (tournament,))
-    return tuple(p[0] for p in res)
+    return [p[0] for p in res]
+
+
+@_dispatch
+def havePlayed(tournament, player_a, player_b):
+    """Returns whether two players have met in a tournament.
+
+    With the cache enabled (see configureCache) and outside a Session, the
+    answer comes from the tournament's played-pairs index, held in memory:
+    it is loaded with one query on first use and kept up to date by the
+    reports of this module. Other processes' writes are seen once they
+    call invalidateCache. Otherwise the database is queried.
+    """
+    played = _indexedPairs(tournament)
+    if played is not None:
+        return played.havePlayed(player_a, player_b)
+    return _select(_HAVE_PLAYED_QUERY, {'t': tournament, 'a': player_a, 'b': player_b})[0][0]
+
+
+@_dispatch
+def opponents(tournament, player):
+    """Returns the sorted list of ids of the players a player has met in a
+    tournament. Answered from the played-pairs index, as havePlayed."""
+    played = _indexedPairs(tournament)
+    if played is not None:
+        return played.opponents(player)
+    return [row[0] for row in _select(_OPPONENTS_QUERY, {'t': tournament, 'p': player})]
 
 
+@_dispatch
 def registerPlayerToTournament(player_id, tournament_id):
     '''Register an existing player to a tournament
 
@@ -147,19 +1301,64 @@ def registerPlayerToTournament(player_id, tournament_id):
     Raises:
         IntegrityError if registration failed.
     '''
-    return _query('INSERT INTO tournament_players(player_id, tournament_id) VALUES (%s, %s)',
-                  (player_id, tournament_id),
-                  commit=True)
+    res = _query(_INSERT_REGISTRATION, (player_id, tournament_id), commit=True)
+    _invalidate(tournament_id)
+    return res
+
 
+@_dispatch
+def registerPlayersToTournament(player_ids, tournament_id):
+    '''Register many existing players to a tournament in one transaction
+
+    Note:
+        All duplicate registrations, whether repeated in player_ids or
+        already stored in the database, are reported together and nothing
+        is registered.
 
-def playerStandings(tournament):
+    Raises:
+        DuplicateRegistrationError if any player is registered twice.
+        IntegrityError if a player or the tournament doesn't exist.
+    '''
+    player_ids = list(player_ids)
+    if not player_ids:
+        return
+
+    seen = set()
+    duplicates = set()
+    for player_id in player_ids:
+        if player_id in seen:
+            duplicates.add((player_id, tournament_id))
+        seen.add(player_id)
+
+    with Session() as session:
+        cur = session.cursor()
+        cur.execute('SELECT player_id FROM tournament_players '
+                    'WHERE tournament_id = %s AND player_id = ANY(%s)',
+                    (tournament_id, list(seen)))
+        duplicates.update((row[0], tournament_id) for row in cur.fetchall())
+        if duplicates:
+            raise DuplicateRegistrationError(sorted(duplicates))
+        for chunk in _chunks(player_ids):
+            cur.execute('INSERT INTO tournament_players(tournament_id, player_id) VALUES %s'
+                        % _values(cur, '(%s, %s)', [(tournament_id, p) for p in chunk]))
+        _invalidate(tournament_id)
+
+
+@_dispatch
+def playerStandings(tournament, limit=None, offset=0, tiebreaks=()):
     """Returns a list of the players and their win records, sorted by wins.
 
     The first entry in the list should be the player in first place, or a player
-    tied for first place if there is currently a tie.
+    tied for first place if there is currently a tie. Players tied on points
+    are ordered by the requested tie-breaks, then wins, then id.
 
     Args:
         tournament: id of the torunament whose standings are to be calculated
+        limit: maximum number of entries returned. None returns them all.
+        offset: number of leading entries skipped, for pages of the
+                standings starting below first place.
+        tiebreaks: names from TIEBREAKS, in order of precedence. Their
+                   values are appended to each tuple.
 
     Returns:
       A list of tuples, each of which contains
@@ -170,65 +1369,446 @@ def playerStandings(tournament):
         draws: Number of games drawn in this tournament
         matches: the number of matches played by the player in this tournament
         points: the number of points scored by the player has scored in this tournament
+
+    Raises:
+        ValueError if a tie-break is unknown.
     """
+    if tiebreaks:
+        # All tie-breaks come from one query over the tournament's matches,
+        # cached like the standings, and the ranking is redone here.
+        values = _cached(tournament, 'tiebreaks',
+                         lambda: dict((row[0], row[1:]) for row in
+                                      _select(_TIEBREAKS_QUERY, {'t': tournament})))
+        return _withTiebreaks(playerStandings(tournament), values, tiebreaks)[
+            offset:None if limit is None else offset + limit]
+    if limit is not None or offset:
+        # Pages are read straight from the rank index, bypassing the cache
+        return _select(_STANDINGS_PAGE_QUERY, (tournament, limit, offset))
+    # Copy, so that callers can't modify the cached list
+    return list(_cached(tournament, 'standings',
+                        lambda: _select(_STANDINGS_QUERY, (tournament,))))
+
+
+def _withTiebreaks(standings, values, tiebreaks):
+    '''Append tie-breaks to standings rows and sort them accordingly
 
-    standings_query = '''
-    SELECT id, name, wins, draws, matches, points FROM standings WHERE tournament_id = %s
+    Args:
+        standings: rows of playerStandings, without tie-breaks.
+        values: dict of player id to a tuple of every tie-break in TIEBREAKS
+                order. Players without matches may be missing.
+        tiebreaks: names of the tie-breaks to append, in order of precedence.
     '''
-    return _select(standings_query, (tournament,))
+    try:
+        columns = [TIEBREAKS.index(name) for name in tiebreaks]
+    except ValueError:
+        raise ValueError('Unknown tie-break in %s, choose from %s'
+                         % (', '.join(tiebreaks), ', '.join(TIEBREAKS)))
+    none = (0,) * len(TIEBREAKS)
+    rows = [row + tuple(values.get(row[0], none)[c] for c in columns)
+            for row in standings]
+    # (id, name, wins, draws, matches, points, tie-breaks...)
+    rows.sort(key=lambda row: (-row[5],) + tuple(-v for v in row[6:]) + (-row[2], row[0]))
+    return rows
+
+
+@_dispatch
+def playerRank(tournament, player_id):
+    """Returns the place of a player in the standings of a tournament.
+
+    Args:
+        tournament: id of the tournament
+        player_id: id of the player
+
+    Returns:
+        1-based position of the player in playerStandings(tournament), or
+        None if the player isn't registered in the tournament.
+    """
+    rows = _select(_RANK_QUERY, {'t': tournament, 'p': player_id})
+    return rows[0][0] if rows else None
+
+
+@_dispatch
+def iterStandings(tournament, chunk_size=STREAM_CHUNK_SIZE):
+    """Generates the rows of playerStandings(tournament) one at a time.
 
+    Rows are fetched chunk_size at a time from a server-side cursor, so
+    memory use doesn't grow with the size of the tournament. The cursor
+    holds a pooled connection, or the current Session's, until the
+    generator is exhausted or closed.
 
+    Args:
+        tournament: id of the tournament
+        chunk_size: number of rows fetched per round trip
+    """
+    session = getattr(_local, 'session', None)
+    if session is not None:
+        pool, conn = None, session.connection
+    else:
+        pool, conn = _checkout(replica=True)
+    try:
+        cur = conn.cursor('standings_%d' % next(_cursor_names))
+        cur.itersize = chunk_size
+        cur.execute(_STANDINGS_QUERY, (tournament,))
+        for row in cur:
+            yield row
+        cur.close()
+    finally:
+        if pool is not None:
+            # putconn rolls back, which also closes the cursor
+            pool.putconn(conn)
+
+
+@_dispatch
+def rebuildStandings(tournament=None, check_only=False):
+    """Check the tournament_standings table against the standings view.
+
+    tournament_standings is maintained incrementally by triggers. This
+    compares it with the standings computed from scratch by the view and,
+    unless check_only is True, rewrites the rows of the affected
+    tournaments from the view.
+
+    Args:
+        tournament: id of the tournament to check. If None, all
+                    tournaments are checked.
+        check_only: if True, only report differences.
+
+    Returns:
+        Sorted list of (tournament_id, player_id) whose stored standings
+        differed from the view.
+    """
+    with Session() as session:
+        cur = session.cursor()
+        cur.execute(_STANDINGS_DIFF_QUERY, {'t': tournament})
+        mismatches = sorted(set((row[0], row[1]) for row in cur.fetchall()))
+        stale = sorted(set(m[0] for m in mismatches))
+        if stale and not check_only:
+            cur.execute('DELETE FROM tournament_standings WHERE tournament_id = ANY(%s)',
+                        (stale,))
+            cur.execute('''
+            INSERT INTO tournament_standings(tournament_id, player_id, wins, draws,
+                                             losses, matches, points)
+            SELECT tournament_id, id, wins, draws, losses, matches, points
+            FROM standings WHERE tournament_id = ANY(%s)
+            ''', (stale,))
+            for tournament_id in stale:
+                _invalidate(tournament_id)
+
+    return mismatches
+
+
+def _constraintName(error):
+    '''Name of the constraint an IntegrityError violated, without the
+    _p<n> suffix of partition indexes (see tournament.sql)'''
+    return re.sub(r'_p\d+$', '', error.diag.constraint_name or '')
+
+
+def _retried(func):
+    '''Decorator retrying a write that lost a deadlock or serialization conflict
+
+    The write is attempted up to TRANSIENT_RETRIES times, with randomized
+    exponential backoff. Inside a Session the error is raised at once:
+    the whole transaction is lost, and only its owner can redo it.
+    '''
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in itertools.count(1):
+            try:
+                return func(*args, **kwargs)
+            except psycopg2.extensions.TransactionRollbackError as e:
+                if attempt >= TRANSIENT_RETRIES or getattr(_local, 'session', None) is not None:
+                    raise
+                _log.info('%s retried after %s', func.__name__, e.pgcode)
+                time.sleep(random.uniform(0, RETRY_BACKOFF * 2 ** attempt))
+    return wrapper
+
+
+@_dispatch
+@_retried
 def reportMatch(player_a, player_b, winner=None, tournament=None):
     """Records the outcome of a single match between two players.
 
+    The match is checked and stored by one statement, so of several
+    concurrent reports of the same pairing exactly one succeeds, and the
+    others raise ValueError. Deadlocks with other reports are retried.
+
     Args:
       player_a:  the id number of the first player
       player_b:  the id number of the second player
       winner: the id of the winner. None in case of draw.
       tournament: id of the torunament match is being played in.
 
+    Returns:
+        id of the match, or None if it was buffered (see
+        configureWriteBuffer).
+
     Raises:
         ValueError if players already played each other in this tournament.
-        ValueError if either player isn't registered in the tournament.
+        ValueError if either player isn't registered in the tournament,
+        or the tournament doesn't exist.
         IntegrityError if player_a == player_b.
         IntegrityError if winner is not player_a or player_b or None.
     """
+    if _write_buffer is not None and getattr(_local, 'session', None) is None:
+        _write_buffer.add(tournament, player_a, player_b, winner)
+        return None
+
+    try:
+        match_id = _insert(_INSERT_MATCH, (tournament, player_a, player_b, winner))
+    except IntegrityError as e:
+        message = _MATCH_CONSTRAINT_ERRORS.get(_constraintName(e))
+        if message is None:
+            raise
+        raise ValueError(message % {'a': player_a, 'b': player_b, 't': tournament})
+    _invalidate(tournament, [(player_a, player_b)])
+    return match_id
+
+
+@_dispatch
+@_retried
+def reportMatches(tournament, results):
+    """Records the outcomes of many matches in one transaction.
+
+    Registration and rematch checks are done for the whole batch with one
+    query each, and all matches are inserted with multi-row inserts. Either
+    every result is stored or none is. Other reports to the tournament
+    wait until the batch is stored, so that none can invalidate the checks.
+
+    Args:
+      tournament: id of the tournament the matches were played in.
+      results: iterable of (player_a, player_b, winner) tuples, where
+               winner is None in case of a draw.
+
+    Returns:
+        List of IDs of the recorded matches, in the same order as results
+
+    Raises:
+        MatchReportError listing every entry that is a self-match, has a
+        winner that isn't one of its players, pairs players that aren't
+        registered in the tournament, or repeats a pairing already played
+        in the tournament or earlier in the batch.
+    """
+    results = [tuple(r) for r in results]
+    if not results:
+        return []
+
+    players = set()
+    for player_a, player_b, _ in results:
+        players.update((player_a, player_b))
+
+    with Session() as session:
+        cur = session.cursor()
+        cur.execute('SELECT pg_advisory_xact_lock(%s, %s)', (_REPORT_LOCK, tournament))
+        checked = {'t': tournament, 'players': list(players)}
+        cur.execute(_REGISTERED_QUERY, checked)
+        registered = set(row[0] for row in cur.fetchall())
+        cur.execute(_PLAYED_BY_QUERY, checked)
+        played = set(frozenset(row) for row in cur.fetchall())
+
+        failures = []
+        for i, entry in enumerate(results):
+            player_a, player_b, winner = entry
+            pair = frozenset((player_a, player_b))
+            if player_a == player_b:
+                reason = 'player %s paired with self' % player_a
+            elif winner not in (player_a, player_b, None):
+                reason = 'winner %s is not one of the players' % winner
+            elif player_a not in registered or player_b not in registered:
+                reason = ("at least one of players %s, %s isn't registered"
+                          % (player_a, player_b))
+            elif pair in played:
+                reason = 'pairing %s, %s already played' % (player_a, player_b)
+            else:
+                played.add(pair)
+                continue
+            failures.append((i, entry, reason))
+        if failures:
+            raise MatchReportError(failures)
+
+        # The triggers of each inserted match lock the rows of its players,
+        # ratings first. Locking those of the whole batch up front, in the
+        # same order, keeps concurrent reports from deadlocking with it.
+        cur.execute('SELECT 1 FROM player_ratings WHERE player_id = ANY(%s) '
+                    'ORDER BY player_id FOR UPDATE', (list(players),))
+        cur.execute('SELECT 1 FROM tournament_standings '
+                    'WHERE tournament_id = %s AND player_id = ANY(%s) '
+                    'ORDER BY player_id FOR UPDATE', (tournament, list(players)))
+
+        match_ids = []
+        for chunk in _chunks(results):
+            cur.execute('INSERT INTO matches(tournament_id, player_a_id, player_b_id, winner_id) '
+                        'VALUES %s RETURNING id'
+                        % _values(cur, '(%s, %s, %s, %s)',
+                                  [(tournament,) + r for r in chunk]))
+            match_ids.extend(row[0] for row in cur.fetchall())
+    # After the commit, unless in an enclosing Session
+    _invalidate(tournament, [(a, b) for a, b, _ in results])
+    return match_ids
+
+
+@_dispatch
+def reportBye(player, tournament):
+    """Records that a player sat out a round with a bye.
+
+    A bye scores as a win (2 points), but doesn't count as a match played.
 
-    def _checkPlayersRegistered():
-        '''Check that both players are registered in the tournament'''
-        players = tournamentPlayers(tournament)
-        if player_a not in players or player_b not in players:
-            raise ValueError(
-                "At least one of players %s, %s isn't registered in tournament %s"
-                % (player_a, player_b, tournament))
+    Args:
+      player: the id of the player given the bye
+      tournament: id of the tournament
 
-    def _checkNewMatch():
-        '''Check that this match hasn't already been reported'''
-        q = '''
-        SELECT COUNT(*) FROM matches, tournaments
-        WHERE matches.tournament_id = tournaments.id AND tournaments.id = %s
-              AND (matches.player_a_id = %s AND matches.player_b_id = %s)
-              OR (matches.player_a_id = %s AND matches.player_b_id = %s);
-        '''
-        res = _select(q, (tournament, player_a, player_b, player_b, player_a))
-        if res[0][0] > 0:
-            raise ValueError('Pairing %s, %s already played in tournament %s'
-                             % (player_a, player_b, tournament))
+    Raises:
+        IntegrityError if the player isn't registered in the tournament.
+    """
+    bye_id = _insert(_INSERT_BYE, (tournament, player))
+    _invalidate(tournament)
+    return bye_id
 
-    _checkPlayersRegistered()
-    _checkNewMatch()
 
-    return _insert('INSERT INTO matches(tournament_id, player_a_id, player_b_id, winner_id) VALUES (%s, %s, %s, %s) RETURNING id',
-                   (tournament, player_a, player_b, winner))
+@_dispatch
+def playerRatings(tournament):
+    """Returns the Elo ratings of the players registered in a tournament.
+
+    Ratings count every match a player has reported, in any tournament.
+    Each new match updates them as it is recorded.
+
+    Returns:
+        dict of player id to a (rating, games) tuple, games being the
+        number of matches the rating is based on.
+    """
+    return dict((row[0], row[1:]) for row in _select(_RATINGS_QUERY, (tournament,)))
 
 
+@_dispatch
+def rebuildRatings():
+    """Recompute every rating from the whole match history.
+
+    Matches are replayed in the order they were reported, as the
+    incremental updates would, so the result only differs from the stored
+    ratings where matches were deleted since. Requires NumPy.
+
+    Returns:
+        Number of matches replayed.
+    """
+    from ratings import eloRatings
+
+    with Session() as session:
+        cur = session.cursor()
+        # Matches reported meanwhile wait for the rebuild
+        cur.execute('LOCK TABLE player_ratings IN SHARE ROW EXCLUSIVE MODE')
+        cur.execute('SELECT player_a_id, player_b_id, winner_id FROM matches ORDER BY id')
+        matches = cur.fetchall()
+        cur.execute('SELECT player_id FROM player_ratings')
+        player_ids = [row[0] for row in cur.fetchall()]
+        cur.execute(_ELO_SETTINGS_QUERY)
+        initial, k, scale = cur.fetchone()
+        ratings = eloRatings(player_ids, matches, initial, k, scale)
+        for chunk in _chunks(sorted(ratings.items())):
+            cur.execute('UPDATE player_ratings AS r SET rating = v.rating, games = v.games '
+                        'FROM (VALUES %s) AS v(player_id, rating, games) '
+                        'WHERE r.player_id = v.player_id'
+                        % _values(cur, '(%s, %s::float, %s)',
+                                  [(p,) + value for p, value in chunk]))
+    return len(matches)
+
+
+@_dispatch
+def startRound(tournament):
+    """Opens the next round of a tournament.
+
+    Matches and byes reported until the round is closed belong to it.
+    Results reported while no round is open belong to none.
+
+    Args:
+      tournament: id of the tournament
+
+    Returns:
+        Number of the new round, 1 for the first.
+
+    Raises:
+        ValueError if a round of the tournament is already open.
+        IntegrityError if the tournament doesn't exist.
+    """
+    try:
+        number = _insert('INSERT INTO rounds(tournament_id, number) '
+                         'SELECT %s, COALESCE(MAX(number), 0) + 1 FROM rounds '
+                         'WHERE tournament_id = %s RETURNING number',
+                         (tournament, tournament))
+    except IntegrityError as e:
+        # A concurrent startRound may also have taken the number first
+        if e.diag.constraint_name not in ('rounds_one_open', 'rounds_pkey'):
+            raise
+        raise ValueError('A round of tournament %s is already open' % tournament)
+    return number
+
+
+@_dispatch
+def closeRound(tournament):
+    """Closes the open round of a tournament.
+
+    The current standings are saved as the standings after that round,
+    see roundStandings.
+
+    Args:
+      tournament: id of the tournament
+
+    Returns:
+        Number of the closed round.
+
+    Raises:
+        ValueError if no round of the tournament is open.
+    """
+    with Session() as session:
+        cur = session.cursor()
+        # Waits for results being reported in the round, which lock it
+        cur.execute('UPDATE rounds SET closed = TRUE '
+                    'WHERE tournament_id = %s AND NOT closed RETURNING number',
+                    (tournament,))
+        row = cur.fetchone()
+        if row is None:
+            raise ValueError('No round of tournament %s is open' % tournament)
+        cur.execute(_SNAPSHOT_STANDINGS, (row[0], tournament))
+    return row[0]
+
+
+@_dispatch
+def tournamentRounds(tournament):
+    '''Return list of (number, closed) of the rounds of tournament, in order'''
+    return _select('SELECT number, closed FROM rounds WHERE tournament_id = %s '
+                   'ORDER BY number', (tournament,))
+
+
+@_dispatch
+def roundStandings(tournament, round):
+    """Returns the standings of a tournament as they were after a round.
+
+    They are read from the snapshot taken by closeRound, so the cost
+    doesn't grow with the number of rounds played. Players unregistered
+    since are left out.
+
+    Args:
+        tournament: id of the tournament
+        round: number of a closed round
+
+    Returns:
+      A list of (id, name, wins, draws, matches, points) tuples, like
+      playerStandings. Empty if the round isn't closed.
+    """
+    return _select(_ROUND_STANDINGS_QUERY, (tournament, round))
+
+
+@_dispatch
 def swissPairings(tournament):
     """Returns a list of pairs of players for the next round of a match.
 
-    Assuming that there are an even number of players registered, each player
-    appears exactly once in the pairings.  Each player is paired with another
-    player with an equal or nearly-equal win record, that is, a player adjacent
-    to him or her in the standings.
+    Each player appears exactly once in the pairings. Players are paired
+    with another player with an equal or nearly-equal score, that is, a
+    player close to him or her in the standings, and never with someone
+    they already played in this tournament. Within a score group players
+    are ranked by rating (see playerRatings). See pairing.py for details.
+
+    If an odd number of players is registered, the lowest ranked player
+    who hasn't had a bye yet sits out the round. That player appears in a
+    last tuple with None as opponent, and should be reported with
+    reportBye.
 
     Args:
         tournament: id of the tournament pairings are requested for.
@@ -237,37 +1817,117 @@ def swissPairings(tournament):
       A list of tuples, each of which contains (id1, name1, id2, name2)
         id1: the first player's unique id
         name1: the first player's name
-        id2: the second player's unique id
-        name2: the second player's name
+        id2: the second player's unique id, None for a bye
+        name2: the second player's name, None for a bye
 
     Raises:
-        ValueError if the number of players registered in tournamennt is odd.
+        ValueError if every possible pairing includes a rematch.
     """
+    # One transaction, on one replica, so that the reads agree. The
+    # played-pairs index, if enabled, only has to be checked for reports
+    # made by other processes.
+    indexed = _indexedPairs(tournament)
+    with Session(commit=False, replica=True):
+        standings = _select(_PAIRING_QUERY, (tournament,))
+        played = _playedPairs(tournament, indexed)
+        had_bye = set(row[0] for row in
+                      _select(_HAD_BYE_QUERY, (tournament,)))
+
+    pairs, bye = pairPlayers([row[0] for row in standings], played, had_bye)
+    return _formatPairings(standings, pairs, bye)
+
+
+def _formatPairings(standings, pairs, bye):
+    '''Return the swissPairings tuples of the output of pairPlayers'''
+    names = dict((row[0], row[1]) for row in standings)
+    pairings = [(a, names[a], b, names[b]) for a, b in pairs]
+    if bye is not None:
+        pairings.append((bye, names[bye], None, None))
+    return pairings
+
+
+def _pairOrError(args):
+    '''pairPlayers(*args), or the ValueError it raised
+
+    Runs in the worker processes of swissPairingsMany.
+    '''
+    try:
+        return pairPlayers(*args)
+    except ValueError as e:
+        return e
+
+
+@_dispatch
+def playerStandingsMany(tournament_ids):
+    """Returns the standings of several tournaments, read in one query.
 
-    # Standings lists players ordered by points, where 2 and 1 points
-    # are awarded for a win and draw respectively. We construct the
-    # swiss pairings from consecutive entries in the standings list. These have
-    # the closest number of points by definition.
-    # We use a grouper function to iterate over the standings list in groups
-    # of two consecutive elements without overlap.
+    Args:
+        tournament_ids: iterable of tournament ids
 
-    def grouper(iterable, n, fillvalue=None):
-        '''Collect data into fixed-length chunks or blocks
+    Returns:
+        dict of tournament id to its playerStandings list. Tournaments
+        without players map to an empty list.
+    """
+    tournament_ids = list(tournament_ids)
+    standings = dict((t, []) for t in tournament_ids)
+    for t, rows in itertools.groupby(_select(_STANDINGS_MANY_QUERY, (tournament_ids,)),
+                                     lambda row: row[0]):
+        standings[t] = [row[1:] for row in rows]
+    return standings
 
-        Taken from  itertools documentation:
-            https://docs.python.org/2/library/itertools.html
 
-        grouper('ABCDEFG', 3, 'x') --> ABC DEF Gxx
-        '''
-        args = [iter(iterable)] * n
-        return izip_longest(fillvalue=fillvalue, *args)
+@_dispatch
+def swissPairingsMany(tournament_ids, workers=None):
+    """Returns the next round's pairings of several tournaments.
 
-    standings = playerStandings(tournament)
+    Standings, played pairs and byes of all tournaments are read with one
+    query each, then the tournaments are paired in parallel.
 
-    if len(standings) % 2 != 0:
-        raise ValueError('Odd number of players not supported')
+    Args:
+        tournament_ids: iterable of tournament ids
+        workers: number of processes pairing tournaments. None uses one
+                 per CPU; 1 pairs them in this process.
 
-    pairings = [(a[0], a[1], b[0], b[1])
-                for a, b in grouper(standings, 2)]
+    Returns:
+        dict of tournament id to its swissPairings list
 
+    Raises:
+        PairingError if some tournaments can't be paired without a rematch.
+    """
+    tournament_ids = list(tournament_ids)
+    with Session(commit=False, replica=True):
+        standings = dict((t, []) for t in tournament_ids)
+        for t, rows in itertools.groupby(_select(_PAIRING_MANY_QUERY, (tournament_ids,)),
+                                         lambda row: row[0]):
+            standings[t] = [row[1:] for row in rows]
+        played = dict((t, set()) for t in tournament_ids)
+        for t, a, b in _select(_PLAYED_PAIRS_MANY_QUERY, (tournament_ids,)):
+            played[t].add(pairKey(a, b))
+        had_bye = dict((t, set()) for t in tournament_ids)
+        for t, player in _select(_HAD_BYE_MANY_QUERY, (tournament_ids,)):
+            had_bye[t].add(player)
+
+    jobs = [([row[0] for row in standings[t]], played[t], had_bye[t])
+            for t in tournament_ids]
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers == 1 or len(jobs) < 2:
+        results = [_pairOrError(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = pool.map(_pairOrError, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+    pairings = {}
+    failures = {}
+    for t, result in zip(tournament_ids, results):
+        if isinstance(result, ValueError):
+            failures[t] = str(result)
+        else:
+            pairings[t] = _formatPairings(standings[t], *result)
+    if failures:
+        raise PairingError(failures, pairings)
     return pairings
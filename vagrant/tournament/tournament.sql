@@ -2,6 +2,19 @@
 --
 -- WARNING: This script re-creates the database from scratch each time.
 --          Previously stored data will be lost!
+--
+-- Requires PostgreSQL 12 or later, for the partitioned tables and foreign
+-- keys referencing them.
+
+\set ON_ERROR_STOP on
+DO $$
+BEGIN
+    IF current_setting('server_version_num')::INT < 120000 THEN
+        RAISE EXCEPTION 'tournament.sql requires PostgreSQL 12 or later, not %',
+                        current_setting('server_version');
+    END IF;
+END
+$$;
 
 -- Disconnect all existing database connections before dropping.
 -- See http://stackoverflow.com/questions/5408156/how-to-drop-a-postgresql-database-if-there-are-active-connections-to-it
@@ -22,6 +35,32 @@ CREATE TABLE players (
 );
 
 
+-- Elo settings, in a single row: the rating of new players, the
+-- K-factor, the most a rating moves in one match, and the rating
+-- difference at which the stronger player is expected to score ten
+-- times as much. The triggers below and tournament.rebuildRatings read
+-- them; tournament.ELO_INITIAL, ELO_K and ELO_SCALE hold the same
+-- values for the in-memory backend.
+CREATE TABLE elo_settings (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    initial DOUBLE PRECISION NOT NULL,
+    k DOUBLE PRECISION NOT NULL,
+    scale DOUBLE PRECISION NOT NULL
+);
+
+INSERT INTO elo_settings(initial, k, scale) VALUES (1500, 32, 400);
+
+
+-- Elo rating of every player over all the matches reported, in any
+-- tournament, updated by the matches_ratings trigger below. Deleting
+-- matches doesn't undo their effect, see tournament.rebuildRatings.
+CREATE TABLE player_ratings (
+    player_id INT PRIMARY KEY REFERENCES players(id) ON DELETE CASCADE,
+    rating DOUBLE PRECISION NOT NULL,
+    games INT NOT NULL DEFAULT 0
+);
+
+
 CREATE TABLE tournaments (
     id SERIAL PRIMARY KEY,
     name VARCHAR(128) NOT NULL
@@ -29,47 +68,356 @@ CREATE TABLE tournaments (
 
 
 -- Store players registered in a certain tournament
+-- Partitioned by tournament, like matches: see the partitions below.
 CREATE TABLE tournament_players (
     tournament_id INT REFERENCES tournaments(id) ON DELETE CASCADE NOT NULL,
     player_id INT REFERENCES players(id) ON DELETE CASCADE NOT NULL,
     PRIMARY KEY (tournament_id, player_id)
+) PARTITION BY HASH (tournament_id);
+
+
+-- Cascading deletes of players look registrations up by player.
+CREATE INDEX tournament_players_player ON tournament_players (player_id);
+
+
+-- Rounds of a tournament, numbered from 1. At most one round per
+-- tournament is open; matches and byes inserted while it is open belong
+-- to it (see assign_open_round).
+CREATE TABLE rounds (
+    tournament_id INT REFERENCES tournaments(id) ON DELETE CASCADE NOT NULL,
+    number INT NOT NULL CHECK (number > 0),
+    closed BOOLEAN NOT NULL DEFAULT FALSE,
+    PRIMARY KEY (tournament_id, number)
 );
 
+CREATE UNIQUE INDEX rounds_one_open ON rounds (tournament_id) WHERE NOT closed;
+
 
 -- Store match information.
 -- Redundant IDs needed to support draws.
 -- winner_id is NULL if the match is a draw.
+-- round is NULL for matches reported while no round was open.
+-- Both players must be registered in the match's tournament. The
+-- constraint names are mapped to errors in tournament.reportMatch.
+-- Partitioned by tournament, see the partitions below; ids are still
+-- unique, as they all come from the same sequence.
 CREATE TABLE matches (
-    id SERIAL PRIMARY KEY,
-    tournament_id INT REFERENCES tournaments(id) ON DELETE CASCADE NOT NULL,
-    player_a_id INT REFERENCES players(id) ON DELETE CASCADE NOT NULL,
-    player_b_id INT REFERENCES players(id) ON DELETE CASCADE NOT NULL,
-    winner_id INT REFERENCES players(id),
+    id SERIAL NOT NULL,
+    tournament_id INT NOT NULL,
+    player_a_id INT NOT NULL,
+    player_b_id INT NOT NULL,
+    winner_id INT REFERENCES players(id) ON DELETE CASCADE,
+    round INT,
     CHECK (player_a_id <> player_b_id),
     CHECK (player_a_id = winner_id OR
         player_b_id = winner_id OR
-        winner_id is NULL)
+        winner_id is NULL),
+    CONSTRAINT matches_player_a_registered FOREIGN KEY (tournament_id, player_a_id)
+        REFERENCES tournament_players(tournament_id, player_id) ON DELETE CASCADE,
+    CONSTRAINT matches_player_b_registered FOREIGN KEY (tournament_id, player_b_id)
+        REFERENCES tournament_players(tournament_id, player_id) ON DELETE CASCADE,
+    FOREIGN KEY (tournament_id, round)
+        REFERENCES rounds(tournament_id, number) ON DELETE CASCADE,
+    PRIMARY KEY (tournament_id, id)
+) PARTITION BY HASH (tournament_id);
+
+
+-- No re-matches: a pair of players meets at most once per tournament,
+-- whatever the order in which they were reported.
+CREATE UNIQUE INDEX matches_pairing_unique
+ON matches (tournament_id, LEAST(player_a_id, player_b_id), GREATEST(player_a_id, player_b_id));
+
+-- Per-player match lookups: one index per side, which also serve the
+-- cascading deletes through the composite foreign keys above.
+CREATE INDEX matches_tournament_player_a ON matches (tournament_id, player_a_id);
+CREATE INDEX matches_tournament_player_b ON matches (tournament_id, player_b_id);
+CREATE INDEX matches_winner ON matches (winner_id);
+CREATE INDEX matches_round ON matches (tournament_id, round);
+
+
+-- tournament_players and matches are split into 16 partitions by a hash
+-- of the tournament id, tournament_players_p<n> and matches_p<n>, all
+-- created here: registering and deleting tournaments only insert and
+-- delete rows, without the table locks that creating or dropping
+-- partitions would take. Each partition index is named after the index
+-- of the parent table it is part of, with a _p<n> suffix, so that
+-- violations of matches_pairing_unique report matches_pairing_unique_p<n>.
+DO $$
+DECLARE
+    partitions CONSTANT INT := 16;
+    parent NAME;
+    partition NAME;
+    index RECORD;
+BEGIN
+    FOREACH parent IN ARRAY ARRAY['tournament_players', 'matches'] LOOP
+        FOR n IN 0 .. partitions - 1 LOOP
+            partition := parent || '_p' || n;
+            EXECUTE format('CREATE TABLE %I PARTITION OF %I '
+                           'FOR VALUES WITH (MODULUS %s, REMAINDER %s)',
+                           partition, parent, partitions, n);
+            FOR index IN
+                SELECT child.relname AS name, parent_index.relname AS parent_name
+                FROM pg_index
+                JOIN pg_class AS child ON child.oid = pg_index.indexrelid
+                JOIN pg_inherits ON pg_inherits.inhrelid = child.oid
+                JOIN pg_class AS parent_index ON parent_index.oid = pg_inherits.inhparent
+                WHERE pg_index.indrelid = to_regclass(partition)
+            LOOP
+                EXECUTE format('ALTER INDEX %I RENAME TO %I',
+                               index.name, index.parent_name || '_p' || n);
+            END LOOP;
+        END LOOP;
+    END LOOP;
+END;
+$$;
+
+
+-- Players who sat out a round of a tournament with an odd number of
+-- players. A bye scores as a win (2 points) but isn't a match played.
+CREATE TABLE byes (
+    id SERIAL PRIMARY KEY,
+    tournament_id INT NOT NULL,
+    player_id INT NOT NULL,
+    round INT,
+    FOREIGN KEY (tournament_id, player_id)
+        REFERENCES tournament_players(tournament_id, player_id) ON DELETE CASCADE,
+    FOREIGN KEY (tournament_id, round)
+        REFERENCES rounds(tournament_id, number) ON DELETE CASCADE
+);
+
+CREATE INDEX byes_tournament_player ON byes (tournament_id, player_id);
+CREATE INDEX byes_round ON byes (tournament_id, round);
+
+
+CREATE FUNCTION players_add_rating() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO player_ratings(player_id, rating)
+    SELECT NEW.id, initial FROM elo_settings;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER players_rating
+AFTER INSERT ON players
+FOR EACH ROW EXECUTE PROCEDURE players_add_rating();
+
+
+-- Elo update of the ratings of both players of a new match
+CREATE FUNCTION matches_update_ratings() RETURNS TRIGGER AS $$
+DECLARE
+    rating_a DOUBLE PRECISION;
+    rating_b DOUBLE PRECISION;
+    settings elo_settings;
+    delta DOUBLE PRECISION;
+BEGIN
+    -- Both rows are locked in id order, so that concurrent matches of
+    -- the same players don't deadlock
+    PERFORM 1 FROM player_ratings
+    WHERE player_id IN (NEW.player_a_id, NEW.player_b_id)
+    ORDER BY player_id FOR UPDATE;
+    SELECT rating INTO rating_a FROM player_ratings WHERE player_id = NEW.player_a_id;
+    SELECT rating INTO rating_b FROM player_ratings WHERE player_id = NEW.player_b_id;
+    SELECT * INTO settings FROM elo_settings;
+    delta := settings.k * (CASE WHEN NEW.winner_id = NEW.player_a_id THEN 1.0
+                                WHEN NEW.winner_id IS NULL THEN 0.5
+                                ELSE 0.0 END
+                           - 1 / (1 + 10 ^ ((rating_b - rating_a) / settings.scale)));
+    UPDATE player_ratings SET
+        rating = rating + CASE WHEN player_id = NEW.player_a_id THEN delta ELSE -delta END,
+        games = games + 1
+    WHERE player_id IN (NEW.player_a_id, NEW.player_b_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_ratings
+AFTER INSERT ON matches
+FOR EACH ROW EXECUTE PROCEDURE matches_update_ratings();
+
+
+-- Put new matches and byes in the open round of their tournament, if
+-- any. FOR SHARE waits for a concurrent closeRound, so that no result
+-- lands in a round after its snapshot was taken.
+CREATE FUNCTION assign_open_round() RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.round IS NULL THEN
+        SELECT number INTO NEW.round FROM rounds
+        WHERE tournament_id = NEW.tournament_id AND NOT closed
+        FOR SHARE;
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_round
+BEFORE INSERT ON matches
+FOR EACH ROW EXECUTE PROCEDURE assign_open_round();
+
+CREATE TRIGGER byes_round
+BEFORE INSERT ON byes
+FOR EACH ROW EXECUTE PROCEDURE assign_open_round();
+
+
+-- Running standings of every registered player, kept up to date by the
+-- triggers below as registrations, matches and byes are inserted and
+-- deleted.
+-- The standings view further down computes the same figures from scratch
+-- and is used to check this table (see tournament.rebuildStandings).
+CREATE TABLE tournament_standings (
+    tournament_id INT NOT NULL,
+    player_id INT NOT NULL,
+    wins INT NOT NULL DEFAULT 0,
+    draws INT NOT NULL DEFAULT 0,
+    losses INT NOT NULL DEFAULT 0,
+    matches INT NOT NULL DEFAULT 0,
+    points INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (tournament_id, player_id),
+    FOREIGN KEY (tournament_id, player_id)
+        REFERENCES tournament_players(tournament_id, player_id) ON DELETE CASCADE
 );
 
+-- Standings order, so that pages and top-K reads need no sort
+CREATE INDEX tournament_standings_rank
+ON tournament_standings (tournament_id, points DESC, wins DESC, player_id);
+
+
+-- Standings of every player as they were when each round closed,
+-- written by tournament.closeRound.
+CREATE TABLE round_standings (
+    tournament_id INT NOT NULL,
+    round INT NOT NULL,
+    player_id INT NOT NULL,
+    wins INT NOT NULL,
+    draws INT NOT NULL,
+    losses INT NOT NULL,
+    matches INT NOT NULL,
+    points INT NOT NULL,
+    PRIMARY KEY (tournament_id, round, player_id),
+    FOREIGN KEY (tournament_id, round)
+        REFERENCES rounds(tournament_id, number) ON DELETE CASCADE,
+    FOREIGN KEY (tournament_id, player_id)
+        REFERENCES tournament_players(tournament_id, player_id) ON DELETE CASCADE
+);
+
+CREATE INDEX round_standings_rank
+ON round_standings (tournament_id, round, points DESC, wins DESC, player_id);
+CREATE INDEX round_standings_player ON round_standings (tournament_id, player_id);
+
+
+CREATE FUNCTION tournament_players_add_standings() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO tournament_standings(tournament_id, player_id)
+    VALUES (NEW.tournament_id, NEW.player_id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tournament_players_standings
+AFTER INSERT ON tournament_players
+FOR EACH ROW EXECUTE PROCEDURE tournament_players_add_standings();
+
+
+-- Add (sign = 1) or remove (sign = -1) the result of one match
+CREATE FUNCTION apply_match_to_standings(t INT, a INT, b INT, w INT, sign INT)
+RETURNS VOID AS $$
+BEGIN
+    UPDATE tournament_standings SET
+        matches = matches + sign,
+        wins = wins + CASE WHEN player_id = w THEN sign ELSE 0 END,
+        draws = draws + CASE WHEN w IS NULL THEN sign ELSE 0 END,
+        losses = losses + CASE WHEN w IS NOT NULL AND player_id <> w THEN sign ELSE 0 END,
+        points = points + CASE WHEN player_id = w THEN 2 * sign
+                               WHEN w IS NULL THEN sign
+                               ELSE 0 END
+    WHERE tournament_id = t AND player_id IN (a, b)
+          -- Matches deleted by a cascade from tournament_players: the
+          -- standings rows are about to be deleted by the same cascade.
+          AND EXISTS (SELECT 1 FROM tournament_players
+                      WHERE tournament_players.tournament_id = t
+                            AND tournament_players.player_id = tournament_standings.player_id);
+END;
+$$ LANGUAGE plpgsql;
+
+-- The delete functions of tournament.py set tournament.bulk_delete for
+-- their transaction and reset the standings of the tournament at once,
+-- rather than have every deleted row update them.
+CREATE FUNCTION matches_update_standings() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND current_setting('tournament.bulk_delete', TRUE) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM apply_match_to_standings(OLD.tournament_id, OLD.player_a_id,
+                                         OLD.player_b_id, OLD.winner_id, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM apply_match_to_standings(NEW.tournament_id, NEW.player_a_id,
+                                         NEW.player_b_id, NEW.winner_id, 1);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER matches_standings
+AFTER INSERT OR UPDATE OR DELETE ON matches
+FOR EACH ROW EXECUTE PROCEDURE matches_update_standings();
+
+
+CREATE FUNCTION byes_update_standings() RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'DELETE' AND current_setting('tournament.bulk_delete', TRUE) = 'on' THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' THEN
+        UPDATE tournament_standings SET wins = wins + 1, points = points + 2
+        WHERE tournament_id = NEW.tournament_id AND player_id = NEW.player_id;
+    ELSE
+        UPDATE tournament_standings SET wins = wins - 1, points = points - 2
+        WHERE tournament_id = OLD.tournament_id AND player_id = OLD.player_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER byes_standings
+AFTER INSERT OR DELETE ON byes
+FOR EACH ROW EXECUTE PROCEDURE byes_update_standings();
+
 
 -- View of all match results
 -- Result score: 2, 1, 0 points for win, draw, loss respectively
+-- Every registered player has one row with no match_id and no points, so
+-- that players who haven't played yet appear in the standings. Each match
+-- then contributes one row per side, and byes a result of 2 points with
+-- no match_id. The sides are separate UNION ALL branches, rather than a
+-- join on player_a_id OR player_b_id, so that each can use its index.
 -- For CASE see http://www.postgresql.org/docs/9.3/static/plpgsql-control-structures.html
 CREATE VIEW results_table AS
 SELECT players.id AS player_id,
        players.name AS player_name,
        tournament_players.tournament_id,
-       matches.id AS match_id,
+       NULL::INT AS match_id,
+       0 AS result
+FROM players INNER JOIN tournament_players ON players.id = tournament_players.player_id
+UNION ALL
+SELECT players.id, players.name, matches.tournament_id, matches.id,
        CASE
-           WHEN matches.id IS NOT NULL AND players.id = matches.winner_id
-               THEN 2
-           WHEN matches.id IS NOT NULL AND matches.winner_id is NULL
-               THEN 1
+           WHEN matches.winner_id = players.id THEN 2
+           WHEN matches.winner_id IS NULL THEN 1
            ELSE 0
-       END AS result
-FROM players INNER JOIN tournament_players ON players.id = tournament_players.player_id
-     LEFT JOIN matches ON matches.tournament_id = tournament_players.tournament_id AND
-                          (players.id = matches.player_a_id OR players.id = matches.player_b_id);
+       END
+FROM players INNER JOIN matches ON players.id = matches.player_a_id
+UNION ALL
+SELECT players.id, players.name, matches.tournament_id, matches.id,
+       CASE
+           WHEN matches.winner_id = players.id THEN 2
+           WHEN matches.winner_id IS NULL THEN 1
+           ELSE 0
+       END
+FROM players INNER JOIN matches ON players.id = matches.player_b_id
+UNION ALL
+SELECT players.id, players.name, byes.tournament_id, NULL, 2
+FROM players INNER JOIN byes ON players.id = byes.player_id;
 
 
 -- Player standings, ordered by tournament id and points scored
@@ -79,7 +427,7 @@ CREATE VIEW standings AS
 SELECT player_id AS id,
        player_name AS name,
        SUM(CASE WHEN match_id IS NOT NULL THEN 1 ELSE 0 END) AS matches,
-       SUM(CASE WHEN match_id IS NOT NULL AND result = 2 THEN 1 ELSE 0 END) AS wins,
+       SUM(CASE WHEN result = 2 THEN 1 ELSE 0 END) AS wins,
        SUM(CASE WHEN match_id IS NOT NULL AND result = 1 THEN 1 ELSE 0 END) AS draws,
        SUM(CASE WHEN match_id IS NOT NULL AND result = 0 THEN 1 ELSE 0 END) AS losses,
        SUM(result) AS points,
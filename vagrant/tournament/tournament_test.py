@@ -2,6 +2,8 @@
 #
 # Test cases for tournament.py
 
+import sys
+
 from tournament import *
 from itertools import izip
 
@@ -176,7 +178,26 @@ def testPairings(tournament):
     print "8. After one match, players with one win are paired."
 
 
-def testOddNumberPairingsRaisesValueError(tournament):
+def testPairingsAvoidRematches(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    registerPlayers(["Player %d" % i for i in xrange(4)], (tournament,))
+
+    # Three rounds of four players is a full round robin: pairing adjacent
+    # players in the standings would repeat a match by the last round.
+    played = set()
+    for round_number in xrange(3):
+        for (id1, _, id2, _) in swissPairings(tournament):
+            pair = frozenset([id1, id2])
+            if pair in played:
+                raise ValueError("swissPairings paired a rematch")
+            played.add(pair)
+            reportMatch(id1, id2, min(id1, id2), tournament)
+    print "22. swissPairings never pairs a rematch"
+
+
+def testOddNumberPairingsGiveBye(tournament):
 
     deleteMatches(tournament)
     deletePlayers()
@@ -185,18 +206,22 @@ def testOddNumberPairingsRaisesValueError(tournament):
     registerPlayer("Fluttershy", (tournament,))
     registerPlayer("Applejack", (tournament,))
 
-    def try_odd():
-
-        try:
-            swissPairings(tournament)
-        except ValueError:
-            return True
-        return False
+    pairings = swissPairings(tournament)
+    byes = [p for p in pairings if p[2] is None]
+    if len(pairings) != 2 or len(byes) != 1 or pairings[-1] != byes[0]:
+        raise ValueError('swissPairings should give one bye for odd number of players')
+    bye_id = byes[0][0]
+    reportBye(bye_id, tournament)
+    (id1, _, id2, _) = pairings[0]
+    reportMatch(id1, id2, id1, tournament)
+    for (i, n, w, d, m, p) in playerStandings(tournament):
+        if i == bye_id and (w, m, p) != (1, 0, 2):
+            raise ValueError('A bye should score as a win without a match')
 
-    if try_odd():
-        print "13. playerStandings raises ValueError for odd number of players"
-    else:
-        raise ValueError('playerStandings does not raise for odd number of players')
+    pairings = swissPairings(tournament)
+    if [p[0] for p in pairings if p[2] is None] == [bye_id]:
+        raise ValueError('A player should not get a second bye')
+    print "13. swissPairings gives a bye for odd number of players"
 
 
 def testReportDuplicateMatchesRaisesValueError(tournament):
@@ -332,6 +357,927 @@ def testRegisterDuplicatePlayerToTournamentRaises(tournament):
     raise ValueError("Register player to tournament twice doesn't raise ")
 
 
+def testSession(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    with Session():
+        id1 = registerPlayer("Bruno Walton", (tournament,))
+        id2 = registerPlayer("Boots O'Neal", (tournament,))
+        reportMatch(id1, id2, id1, tournament)
+        standings = playerStandings(tournament)
+    if [row[0] for row in standings] != [id1, id2]:
+        raise ValueError("Operations in a session should see each other's writes")
+
+    try:
+        with Session():
+            registerPlayer("Cathy Burton", (tournament,))
+            raise RuntimeError("abort session")
+    except RuntimeError:
+        pass
+    if countPlayers() != 2:
+        raise ValueError("A session should be rolled back if its block raises")
+
+    # Every kind of change is undone, and only the session's
+    def state():
+        return (playerStandings(tournament), tournamentMatches(tournament),
+                tournamentByes(tournament), tournamentRounds(tournament),
+                playerRatings(tournament))
+    before = state()
+    try:
+        with Session():
+            id3 = registerPlayer("Cathy Burton", (tournament,))
+            startRound(tournament)
+            reportMatch(id1, id3, None, tournament)
+            reportBye(id2, tournament)
+            closeRound(tournament)
+            deleteMatches(tournament)
+            deleteTournamentPlayers(tournament)
+            raise RuntimeError("abort session")
+    except RuntimeError:
+        pass
+    if state() != before or countPlayers() != 2:
+        raise ValueError("A session should roll back all of its changes")
+    print "17. Sessions run several operations in one transaction"
+
+
+def testRegisterPlayers(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    names = ['Player %d' % i for i in xrange(2500)]
+    ids = registerPlayers(names, (tournament,))
+    if len(ids) != len(names) or countPlayers() != len(names):
+        raise ValueError("registerPlayers should register every player")
+    stored = dict((row[0], row[1]) for row in playerStandings(tournament))
+    if [stored[i] for i in ids] != names:
+        raise ValueError("registerPlayers should return IDs in input order")
+
+    extra = registerPlayers(['Bob', 'Alice'])
+    try:
+        registerPlayersToTournament([extra[0], ids[0], extra[1], ids[1]], tournament)
+    except DuplicateRegistrationError as e:
+        if e.duplicates != [(ids[0], tournament), (ids[1], tournament)]:
+            raise ValueError("All duplicate registrations should be reported")
+    else:
+        raise ValueError("Duplicate bulk registration doesn't raise")
+    if set(extra) & set(tournamentPlayers(tournament)):
+        raise ValueError("Failed bulk registration should register nobody")
+    print "18. Players can be registered in bulk"
+
+
+def testReportMatchesBatch(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    id1, id2, id3, id4, id5, id6 = registerPlayers(
+        ["Bruno Walton", "Boots O'Neal", "Cathy Burton",
+         "Diane Grant", "Lucy Himmel", "Reto Schweitzer"], (tournament,))
+    outsider = registerPlayer("Spy")
+    reportMatch(id1, id2, id1, tournament)
+
+    bad_batch = [(id3, id4, id3),        # fine
+                 (id2, id1, id2),        # already played
+                 (id5, id5, id5),        # self-match
+                 (id5, id6, id1),        # bad winner
+                 (id6, outsider, None),  # not registered
+                 (id4, id3, None)]       # repeated within the batch
+    try:
+        reportMatches(tournament, bad_batch)
+    except MatchReportError as e:
+        if [f[0] for f in e.failures] != [1, 2, 3, 4, 5]:
+            raise ValueError("reportMatches should report every failed entry")
+    else:
+        raise ValueError("reportMatches with invalid entries doesn't raise")
+    if sum(row[4] for row in playerStandings(tournament)) != 2:
+        raise ValueError("A failed batch should not record any match")
+
+    ids = reportMatches(tournament, [(id3, id4, id3), (id5, id6, None)])
+    if len(ids) != 2:
+        raise ValueError("reportMatches should return one ID per match")
+    points = dict((row[0], row[5]) for row in playerStandings(tournament))
+    if [points[i] for i in (id1, id2, id3, id4, id5, id6)] != [2, 0, 2, 0, 1, 1]:
+        raise ValueError("Batch-reported matches not scored correctly")
+    print "19. A round of matches can be reported in one batch"
+
+
+def testRebuildStandings(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    id1, id2, id3, id4 = registerPlayers(
+        ["Bruno Walton", "Boots O'Neal", "Cathy Burton", "Diane Grant"], (tournament,))
+    reportMatch(id1, id2, id1, tournament)
+    reportMatch(id3, id4, None, tournament)
+    deleteMatches(tournament)
+    reportMatch(id1, id3, id3, tournament)
+    if rebuildStandings(tournament, check_only=True):
+        raise ValueError("Maintained standings should agree with the standings view")
+
+    if getBackend() is None:
+        with Session() as session:
+            session.cursor().execute(
+                'UPDATE tournament_standings SET wins = 5 WHERE player_id = %s', (id2,))
+        if rebuildStandings(tournament) != [(tournament, id2)]:
+            raise ValueError("rebuildStandings should detect corrupted standings")
+        if rebuildStandings(tournament, check_only=True):
+            raise ValueError("rebuildStandings should repair corrupted standings")
+    print "20. Maintained standings can be checked and rebuilt"
+
+
+def testStandingsCache(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    configureCache(maxsize=16)
+    try:
+        id1, id2 = registerPlayers(["Bruno Walton", "Boots O'Neal"], (tournament,))
+        before = playerStandings(tournament)
+        if playerStandings(tournament) != before:
+            raise ValueError("Repeated playerStandings should return the same standings")
+        # Only the PostgreSQL backend goes through the cache
+        if getBackend() is None and cacheStats()['hits'] != 1:
+            raise ValueError("Repeated playerStandings should be served from the cache")
+        reportMatch(id1, id2, id1, tournament)
+        if playerStandings(tournament)[0][2] != 1:
+            raise ValueError("reportMatch should invalidate cached standings")
+        id3 = registerPlayer("Cathy Burton", (tournament,))
+        if id3 not in tournamentPlayers(tournament):
+            raise ValueError("Registration should invalidate cached players")
+        deleteMatches(tournament)
+        if any(row[4] for row in playerStandings(tournament)):
+            raise ValueError("deleteMatches should invalidate cached standings")
+    finally:
+        configureCache(None)
+    print "21. Standings are cached until the tournament changes"
+
+
+def testSimulateTournament(tournament):
+    try:
+        from simulate import simulateTournament, topProbabilities
+    except ImportError:
+        print "23. Skipped simulateTournament: NumPy is not installed"
+        return
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    id1, id2, id3, id4, id5 = registerPlayers(["Player %d" % i for i in xrange(5)],
+                                              (tournament,))
+    reportMatches(tournament, [(id1, id2, id1), (id3, id4, id3)])
+    reportBye(id5, tournament)
+    reportMatches(tournament, [(id1, id3, id1), (id5, id2, None)])
+    reportBye(id4, tournament)
+    if tournamentMatches(tournament) != [(id1, id2, id1), (id3, id4, id3),
+                                         (id1, id3, id1), (id5, id2, None)]:
+        raise ValueError("tournamentMatches should list the matches in order")
+    if tournamentByes(tournament) != [id5, id4]:
+        raise ValueError("tournamentByes should list the byes in order")
+
+    player_ids, odds = simulateTournament(tournament, 0, simulations=100)
+    if player_ids[0] != id1 or odds[0, 0] != 1.0:
+        raise ValueError("Without rounds left the leader should finish first")
+    player_ids, odds = simulateTournament(tournament, 3, simulations=2000,
+                                          seed=1, workers=2)
+    if abs(odds.sum(axis=0) - 1).max() > 1e-9 or abs(odds.sum(axis=1) - 1).max() > 1e-9:
+        raise ValueError("Every player should finish in exactly one place")
+    top = topProbabilities(player_ids, odds, 1)
+    if max(top, key=top.get) != id1:
+        raise ValueError("The leader should be the most likely winner")
+    print "23. simulateTournament estimates finishing-position odds"
+
+
+def testStandingsPages(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    ids = registerPlayers(["Player %d" % i for i in xrange(7)], (tournament,))
+    reportMatches(tournament, [(ids[0], ids[1], ids[1]), (ids[2], ids[3], None),
+                               (ids[4], ids[5], ids[4])])
+    standings = playerStandings(tournament)
+    if playerStandings(tournament, limit=3) != standings[:3]:
+        raise ValueError("playerStandings with limit should return the leaders")
+    if playerStandings(tournament, limit=2, offset=3) != standings[3:5]:
+        raise ValueError("playerStandings with offset should skip leading entries")
+    if playerStandings(tournament, offset=5) != standings[5:]:
+        raise ValueError("playerStandings with offset only should return the rest")
+    for place, row in enumerate(standings):
+        if playerRank(tournament, row[0]) != place + 1:
+            raise ValueError("playerRank should match the standings order")
+    outsider = registerPlayer("Outsider")
+    if playerRank(tournament, outsider) is not None:
+        raise ValueError("playerRank of an unregistered player should be None")
+    if list(iterStandings(tournament, chunk_size=2)) != standings:
+        raise ValueError("iterStandings should generate the standings")
+    print "24. Standings can be paged, ranked and streamed"
+
+
+def testQueryMetrics(tournament):
+    import logging
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    exported = []
+    addMetricsExporter(lambda *timing: exported.append(timing))
+    slow = []
+    handler = logging.Handler()
+    handler.emit = slow.append
+    logging.getLogger('tournament').addHandler(handler)
+    closePool()
+    configureMetrics(slow_query_threshold=0)
+    try:
+        id1, id2 = registerPlayers(["Bruno Walton", "Boots O'Neal"], (tournament,))
+        reportMatch(id1, id2, id1, tournament)
+        playerStandings(tournament)
+        # Generators run their statements while consumed, not when called
+        standings = iterStandings(tournament)
+        playerStandings(tournament)
+        list(standings)
+        stats = queryStats()
+        # Only the PostgreSQL backend issues statements
+        if getBackend() is None:
+            functions = set(function for function, _ in stats['queries'])
+            if not set(['registerPlayers', 'reportMatch', 'playerStandings',
+                        'iterStandings']) <= functions:
+                raise ValueError("Statements should be attributed to API functions")
+            streamed = [s for (function, statement), s in stats['queries'].items()
+                        if function == 'iterStandings' and 'tournament_standings' in statement]
+            if len(streamed) != 1 or streamed[0]['count'] != 1:
+                raise ValueError("iterStandings should be counted once")
+            # The insert may run as a prepared statement, see configurePool
+            inserts = [s for (function, statement), s in stats['queries'].items()
+                       if function == 'reportMatch' and
+                       statement.startswith(('INSERT', 'EXECUTE'))]
+            if len(inserts) != 1 or inserts[0]['count'] != 1 or sum(inserts[0]['histogram']) != 1:
+                raise ValueError("reportMatch should be counted once")
+            if not stats['connections']['count']:
+                raise ValueError("Connection opens should be timed")
+            if not slow or not exported:
+                raise ValueError("Statements over the threshold should be logged and exported")
+        resetQueryStats()
+        if queryStats()['queries']:
+            raise ValueError("resetQueryStats should zero the figures")
+    finally:
+        configureMetrics(False)
+        logging.getLogger('tournament').removeHandler(handler)
+    if queryStats() is not None:
+        raise ValueError("Disabled metrics should have no figures")
+    print "25. Statements are timed per API function"
+
+
+def testPreparedStatements(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    id1, id2 = registerPlayers(["Bruno Walton", "Boots O'Neal"], (tournament,))
+    # Other backends have no pool or prepared statements
+    for prepared in (True, False) if getBackend() is None else (None,):
+        if prepared is not None:
+            configurePool(prepared_statements=prepared)
+        deleteMatches(tournament)
+        reportMatch(id1, id2, id1, tournament)
+        standings = playerStandings(tournament)
+        if [row[2] for row in standings] != [1, 0]:
+            raise ValueError("Standings should be the same with or without prepared statements")
+        if getBackend() is None:
+            with Session() as session:
+                cur = session.cursor()
+                cur.execute("SELECT name FROM pg_prepared_statements")
+                names = set(row[0] for row in cur.fetchall())
+            if prepared != ('tournament_standings' in names):
+                raise ValueError("Statements should be prepared only when enabled")
+    if getBackend() is None:
+        configurePool()
+    print "26. Hot statements run as prepared statements"
+
+
+def testTiebreaks(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    a, b, d, c = registerPlayers(["A", "B", "D", "C"], (tournament,))
+    reportMatches(tournament, [(a, b, a), (c, d, None), (a, c, a), (b, d, b)])
+    # Points: a 4, b 2, c 1, d 1
+    expected = {a: (3, 3, 3.0, 0), b: (5, 5, 1.0, 0), c: (5, 5, 0.5, 1), d: (3, 3, 0.5, 1)}
+    standings = playerStandings(tournament, tiebreaks=TIEBREAKS)
+    if dict((row[0], row[6:]) for row in standings) != expected:
+        raise ValueError("Tie-breaks should be computed from the opponents' points")
+    if [row[0] for row in playerStandings(tournament)] != [a, b, d, c]:
+        raise ValueError("Without tie-breaks ties should be broken by id")
+    if [row[0] for row in playerStandings(tournament, tiebreaks=('buchholz',))] != [a, b, c, d]:
+        raise ValueError("Buchholz should break the tie between c and d")
+    page = playerStandings(tournament, limit=2, offset=2, tiebreaks=('head_to_head', 'buchholz'))
+    if [row[0] for row in page] != [c, d] or len(page[0]) != 8:
+        raise ValueError("Tie-breaks should apply to pages of the standings")
+    try:
+        playerStandings(tournament, tiebreaks=('coin_toss',))
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Unknown tie-breaks should raise ValueError")
+    print "27. playerStandings breaks ties with Buchholz and Sonneborn-Berger"
+
+
+def testManyTournaments(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    other = registerTournament("Other")
+    empty = registerTournament("Empty")
+    ids = registerPlayers(["Player %d" % i for i in xrange(5)], (tournament, other))
+    reportMatches(tournament, [(ids[0], ids[1], ids[0]), (ids[2], ids[3], None)])
+    reportMatches(other, [(ids[4], ids[0], ids[4])])
+    reportBye(ids[4], tournament)
+    standings = playerStandingsMany([tournament, other, empty])
+    if standings != {tournament: playerStandings(tournament),
+                     other: playerStandings(other), empty: []}:
+        raise ValueError("playerStandingsMany should match playerStandings")
+    expected = {tournament: swissPairings(tournament), other: swissPairings(other), empty: []}
+    for workers in (1, 2):
+        if swissPairingsMany([tournament, other, empty], workers=workers) != expected:
+            raise ValueError("swissPairingsMany should match swissPairings")
+    # Two players who already met can't be paired again
+    registerPlayerToTournament(ids[0], empty)
+    registerPlayerToTournament(ids[1], empty)
+    reportMatch(ids[0], ids[1], ids[0], empty)
+    try:
+        swissPairingsMany([tournament, empty], workers=2)
+    except PairingError as e:
+        if e.failures.keys() != [empty] or e.pairings != {tournament: expected[tournament]}:
+            raise ValueError("PairingError should list failed and paired tournaments")
+    else:
+        raise ValueError("swissPairingsMany should raise PairingError")
+    deleteTournamentPlayers(other)
+    deleteTournamentPlayers(empty)
+    print "28. Standings and pairings of many tournaments at once"
+
+
+def testRounds(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    a, b, c, d = registerPlayers(["A", "B", "C", "D"], (tournament,))
+    if startRound(tournament) != 1:
+        raise ValueError("The first round should be number 1")
+    try:
+        startRound(tournament)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Only one round at a time should be open")
+    reportMatches(tournament, [(a, b, a), (c, d, None)])
+    if roundStandings(tournament, 1) != []:
+        raise ValueError("An open round should have no standings")
+    if closeRound(tournament) != 1:
+        raise ValueError("closeRound should return the number of the round")
+    after_one = playerStandings(tournament)
+    startRound(tournament)
+    reportMatches(tournament, [(a, c, a), (b, d, b)])
+    closeRound(tournament)
+    if roundStandings(tournament, 1) != after_one:
+        raise ValueError("Round standings should not change after the round")
+    if roundStandings(tournament, 2) != playerStandings(tournament):
+        raise ValueError("The last round's standings should be the current ones")
+    if tournamentRounds(tournament) != [(1, True), (2, True)]:
+        raise ValueError("tournamentRounds should list the closed rounds")
+    try:
+        closeRound(tournament)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Closing with no open round should raise ValueError")
+    deleteMatches(tournament)
+    if tournamentRounds(tournament) != [] or roundStandings(tournament, 1) != []:
+        raise ValueError("deleteMatches should delete the rounds")
+    print "29. Rounds keep a snapshot of the standings when they close"
+
+
+def testArchive(tournament):
+    try:
+        from archive import TournamentArchive, exportTournament, importTournament
+    except ImportError:
+        print "30. Skipped archive: NumPy is not installed"
+        return
+    import os
+    import tempfile
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    a, b, c, d, e = registerPlayers(["A", "B", "C", "D", "E"], (tournament,))
+    reportMatches(tournament, [(a, b, a), (c, d, None), (a, c, c), (e, b, b)])
+    reportBye(e, tournament)
+    handle, path = tempfile.mkstemp(suffix='.tarch')
+    os.close(handle)
+    try:
+        exportTournament(tournament, path)
+        archive = TournamentArchive(path)
+        if archive.title != tournamentName(tournament):
+            raise ValueError("The archive should keep the tournament name")
+        if archive.standings() != playerStandings(tournament):
+            raise ValueError("Archived standings should match playerStandings")
+        copy = importTournament(path, name="Imported")
+        if ([row[1:] for row in playerStandings(copy)] !=
+                [row[1:] for row in playerStandings(tournament)]):
+            raise ValueError("An imported archive should have the same standings")
+        if len(tournamentMatches(copy)) != 4 or len(tournamentByes(copy)) != 1:
+            raise ValueError("An imported archive should have the same results")
+        deleteTournamentPlayers(copy)
+        deleteMatches(copy)
+    finally:
+        os.remove(path)
+    print "30. Tournaments export to and import from columnar archives"
+
+
+def testWriteBuffer(tournament):
+    if getBackend() is not None:
+        print "31. Skipped write buffer: it buffers PostgreSQL writes"
+        return
+    import os
+    import tempfile
+    import time
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    a, b, c, d, e, f = registerPlayers(["Player %d" % i for i in xrange(6)], (tournament,))
+    handle, journal = tempfile.mkstemp(suffix='.journal')
+    os.close(handle)
+    try:
+        configureWriteBuffer(journal, max_size=3, max_delay=None)
+        if reportMatch(a, b, a, tournament) is not None:
+            raise ValueError("Buffered results should have no id yet")
+        reportMatch(c, d, None, tournament)
+        if len(open(journal).readlines()) != 2:
+            raise ValueError("Buffered results should be journaled")
+        try:
+            reportMatch(b, a, b, tournament)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("Rematches with buffered results should raise ValueError")
+        standings = dict((row[0], row[4]) for row in playerStandings(tournament))
+        if standings != {a: 1, b: 1, c: 1, d: 1, e: 0, f: 0}:
+            raise ValueError("playerStandings should flush buffered results")
+        if os.path.getsize(journal):
+            raise ValueError("The journal should be emptied once results are written")
+        # The third buffered result triggers a write
+        reportMatch(a, c, a, tournament)
+        reportMatch(b, d, b, tournament)
+        reportMatch(e, f, e, tournament)
+        configureWriteBuffer(None)
+        if len(tournamentMatches(tournament)) != 5:
+            raise ValueError("A full buffer should be written")
+        # Results left in a journal are written, except those already stored
+        with open(journal, 'w') as j:
+            j.write('%d %d %d %d\n%d %d %d -\n' % (tournament, a, b, a, tournament, a, d))
+        configureWriteBuffer(journal, max_delay=0.1)
+        if flush() != [(tournament, (a, b, a), 'pairing %s, %s already played' % (a, b))]:
+            raise ValueError("flush should return the rejected results")
+        reportMatch(b, c, None, tournament)
+        time.sleep(0.5)
+        configureWriteBuffer(None)
+        if tournamentMatches(tournament)[-2:] != [(a, d, None), (b, c, None)]:
+            raise ValueError("Buffered results should be written in time")
+        _testBufferWritesUnlocked(tournament, journal, a, b, c, d)
+        _testBufferLoadsUnlocked(tournament, journal, a, b, c, d)
+        _testJournalGroupSync(tournament, journal)
+    finally:
+        configureWriteBuffer(None)
+        os.remove(journal)
+    print "31. Buffered match reports are journaled and group committed"
+
+
+def _testBufferWritesUnlocked(tournament, journal, a, b, c, d):
+    import threading
+    from write_buffer import ResultBuffer
+    started, release = threading.Event(), threading.Event()
+    written = []
+
+    def slowWrite(groups):
+        started.set()
+        release.wait(5)
+        written.append(groups)
+        return []
+
+    buf = ResultBuffer(journal, lambda t: ([a, b, c, d], []), slowWrite,
+                       max_delay=None, sync=False)
+    buf.add(tournament, a, b, a)
+    writer = threading.Thread(target=buf.flush)
+    writer.start()
+    started.wait(5)
+    # While the first result is being written
+    buf.add(tournament, c, d, None)
+    try:
+        buf.add(tournament, b, a, b)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Rematches with results being written should raise ValueError")
+    buf.flush(wait=False)
+    if written:
+        raise ValueError("Writes shouldn't block buffering, nor flushes that don't wait")
+    release.set()
+    writer.join()
+    if written != [{tournament: [(a, b, a)]}] or len(buf) != 1:
+        raise ValueError("Results buffered during a write should wait for the next")
+    if open(journal).read() != '%d %d %d -\n' % (tournament, c, d):
+        raise ValueError("The journal should keep the results buffered during a write")
+    buf.close()
+    if written[1:] != [{tournament: [(c, d, None)]}]:
+        raise ValueError("close should write the remaining results")
+
+
+def _testBufferLoadsUnlocked(tournament, journal, a, b, c, d):
+    import threading
+    from write_buffer import ResultBuffer
+    other = tournament + 1000
+    started, release = threading.Event(), threading.Event()
+    loads, written = [], []
+
+    def slowLoad(t):
+        loads.append(t)
+        if t == tournament and len(loads) == 1:
+            started.set()
+            release.wait(5)
+        return [a, b, c, d], []
+
+    buf = ResultBuffer(journal, slowLoad, lambda groups: written.append(groups) or [],
+                       max_delay=None, sync=False)
+    loader = threading.Thread(target=buf.add, args=(tournament, a, b, a))
+    loader.start()
+    started.wait(5)
+    # While the first tournament is being loaded
+    buf.add(other, a, b, a)
+    buf.forget(tournament)
+    buf.flush()
+    if written != [{other: [(a, b, a)]}]:
+        raise ValueError("Loading a tournament shouldn't block other reports nor flushes")
+    release.set()
+    loader.join()
+    if loads != [tournament, other, tournament] or len(buf) != 1:
+        raise ValueError("A tournament forgotten while loading should be loaded again")
+    buf.close()
+
+
+def _testJournalGroupSync(tournament, journal):
+    import threading
+    import time
+    import write_buffer
+    from write_buffer import ResultBuffer
+    players = range(1, 17)
+    buf = ResultBuffer(journal, lambda t: (players, []), lambda groups: [],
+                       max_delay=None)
+    fsync = write_buffer.os.fsync
+    syncs = []
+
+    def slowSync(fd):
+        syncs.append(fd)
+        time.sleep(0.05)
+        fsync(fd)
+
+    write_buffer.os.fsync = slowSync
+    try:
+        adders = [threading.Thread(target=buf.add, args=(tournament, p, p + 8, p))
+                  for p in players[:8]]
+        for adder in adders:
+            adder.start()
+        for adder in adders:
+            adder.join()
+    finally:
+        write_buffer.os.fsync = fsync
+    if len(open(journal).readlines()) != 8 or not 1 <= len(syncs) < 8:
+        raise ValueError("Concurrent adds should share journal fsyncs")
+    buf.close()
+
+
+def testRatings(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    other = registerTournament("Other")
+    a, b, c, d = registerPlayers(["A", "B", "C", "D"], (tournament,))
+    registerPlayersToTournament([c, d], other)
+    reportMatch(d, c, d, other)
+    reportMatch(a, b, a, tournament)
+    ratings = playerRatings(tournament)
+    if ratings[a][0] <= ELO_INITIAL or ratings[b][0] >= ELO_INITIAL or ratings[a][1] != 1:
+        raise ValueError("reportMatch should update the ratings of both players")
+    if abs(sum(r for r, _ in ratings.values()) - 4 * ELO_INITIAL) > 1e-6:
+        raise ValueError("Elo updates should keep the sum of the ratings")
+    # b, c and d have no points; d has the best rating and b and c tie
+    if [set(p[0::2]) for p in swissPairings(tournament)] != [set([a, d]), set([b, c])]:
+        raise ValueError("Players with equal points should be ranked by rating")
+    if getBackend() is None:
+        with Session(commit=False) as session:
+            cur = session.cursor()
+            cur.execute('SELECT initial, k, scale FROM elo_settings')
+            if cur.fetchone() != (ELO_INITIAL, ELO_K, ELO_SCALE):
+                raise ValueError("elo_settings should match ELO_INITIAL, ELO_K and ELO_SCALE")
+    # A few more rounds, with draws, for the ratings to diverge
+    for i in xrange(2):
+        for k, (p, _, q, _) in enumerate(swissPairings(tournament)):
+            reportMatch(p, q, None if k == i else q, tournament)
+    ratings = playerRatings(tournament)
+    try:
+        rebuildRatings()
+    except ImportError:
+        print "32. Skipped rebuildRatings: NumPy is not installed"
+    else:
+        rebuilt = playerRatings(tournament)
+        if any(abs(rebuilt[p][0] - ratings[p][0]) > 1e-6 or rebuilt[p][1] != ratings[p][1]
+               for p in ratings):
+            raise ValueError("rebuildRatings should reproduce the incremental ratings")
+        deleteMatches(tournament)
+        if rebuildRatings() != 1 or playerRatings(tournament)[a] != (ELO_INITIAL, 0):
+            raise ValueError("rebuildRatings should only replay the remaining matches")
+    deleteTournamentPlayers(other)
+    print "32. Elo ratings are kept up to date and seed the pairings"
+
+
+def testConcurrentReports(tournament):
+    import threading
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    ids = registerPlayers(["Player %d" % i for i in xrange(12)], (tournament,))
+    pairs = [(a, b) for i, a in enumerate(ids) for b in ids[i + 1:]]
+    outcomes = []
+
+    def report(batch):
+        for a, b in batch:
+            try:
+                reportMatch(a, b, a, tournament)
+                outcomes.append('stored')
+            except ValueError:
+                outcomes.append('rejected')
+            except Exception as e:
+                outcomes.append(repr(e))
+
+    # Every pairing is reported by two threads at once
+    threads = [threading.Thread(target=report, args=(pairs[k::4],)) for k in xrange(4) for _ in (0, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stored = [pairKey(a, b) for a, b, _ in tournamentMatches(tournament)]
+    if sorted(stored) != sorted(pairKey(a, b) for a, b in pairs):
+        raise ValueError("Concurrent reports should store every pairing once")
+    if outcomes.count('stored') != len(pairs) or outcomes.count('rejected') != len(pairs):
+        raise ValueError("Concurrent copies of a report should raise ValueError")
+    print "33. Concurrent reports of the same pairing store it once"
+
+
+def testReadReplicas(tournament):
+    if getBackend() is not None:
+        print "35. Skipped read replicas: they are PostgreSQL servers"
+        return
+    import threading
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    a, b, c, d = registerPlayers(["Player %d" % i for i in xrange(4)], (tournament,))
+    # The primary stands in for a replica, next to one that can't be reached
+    replica = 'dbname=%s application_name=replica' % DBNAME
+    try:
+        configurePool(replicas=[replica, 'host=/nonexistent dbname=%s' % DBNAME],
+                      read_your_writes=None)
+        for _ in xrange(4):
+            if len(playerStandings(tournament)) != 4:
+                raise ValueError("Reads from a replica should return the standings")
+        stats = replicaStats()
+        if stats[0]['checkouts'] != 4 or stats[0]['down'] or not stats[1]['down']:
+            raise ValueError("Reads should go to the replicas that are up: %s" % stats)
+        _testReplicaSessionReadOnly()
+
+        configurePool(replicas=[replica], read_your_writes=60)
+        reportMatch(a, b, a, tournament)
+        playerStandings(tournament)
+        if replicaStats()[0]['checkouts'] != 0:
+            raise ValueError("A thread should read from the primary after it wrote")
+        reader = threading.Thread(target=playerStandings, args=(tournament,))
+        reader.start()
+        reader.join()
+        if replicaStats()[0]['checkouts'] != 1:
+            raise ValueError("Other threads should read from replicas")
+        # Writes that leave the cache alone pin the thread's reads as well
+        def writeThenRead():
+            registerPlayer("Player 4")
+            playerStandings(tournament)
+        writer = threading.Thread(target=writeThenRead)
+        writer.start()
+        writer.join()
+        if replicaStats()[0]['checkouts'] != 1:
+            raise ValueError("A thread should read from the primary after any commit")
+        # On the primary as well, a replica session doesn't write
+        _testReplicaSessionReadOnly()
+        if replicaStats()[0]['checkouts'] != 1:
+            raise ValueError("A thread should read from the primary after it wrote")
+    finally:
+        configurePool()
+    print "35. Reads go to read replicas, except right after a write"
+
+
+def _testReplicaSessionReadOnly():
+    try:
+        with Session(replica=True):
+            registerPlayer("Player 5")
+    except psycopg2.InternalError as e:
+        if e.pgcode != '25006':     # read_only_sql_transaction
+            raise
+    else:
+        raise ValueError("Sessions with replica=True should be read-only")
+
+
+def testPlayedPairs(tournament):
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    a, b, c, d = registerPlayers(["Player %d" % i for i in xrange(4)], (tournament,))
+    reportMatch(a, b, a, tournament)
+    if not havePlayed(tournament, b, a) or havePlayed(tournament, a, c):
+        raise ValueError("havePlayed should tell which players met")
+    # The same through the played-pairs index, enabled with the cache
+    configureCache(maxsize=16)
+    try:
+        _testPlayedPairsIndexed(tournament, a, b, c, d)
+    finally:
+        configureCache(None)
+    print "36. havePlayed and opponents follow reports and deletions"
+
+
+def _testPlayedPairsIndexed(tournament, a, b, c, d):
+    if not havePlayed(tournament, b, a) or havePlayed(tournament, a, c):
+        raise ValueError("havePlayed should tell which players met")
+    reportMatches(tournament, [(a, c, None), (b, d, d)])
+    if opponents(tournament, a) != sorted([b, c]) or opponents(tournament, d) != [b]:
+        raise ValueError("opponents should list the players met")
+    try:
+        reportMatch(c, a, c, tournament)
+    except ValueError:
+        pass
+    else:
+        raise ValueError("Rematches should raise ValueError")
+    with Session(commit=False):
+        reportMatch(c, d, c, tournament)
+        if not havePlayed(tournament, c, d) or opponents(tournament, c) != sorted([a, d]):
+            raise ValueError("havePlayed and opponents should see the session's reports")
+    if havePlayed(tournament, c, d):
+        raise ValueError("Reports rolled back should be forgotten")
+    deleteMatches(tournament)
+    if havePlayed(tournament, a, b) or opponents(tournament, a):
+        raise ValueError("Deleted matches should be forgotten")
+
+
+def testPairingsSeeOtherConnections(tournament):
+    if getBackend() is not None:
+        print "38. Skipped reports from other connections: the backend has one"
+        return
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    players = registerPlayers(["Player %d" % i for i in xrange(4)], (tournament,))
+    configureCache(maxsize=16)
+    try:
+        for a, _, b, _ in swissPairings(tournament):
+            reportMatch(a, b, a, tournament)
+        havePlayed(tournament, *players[:2])
+        # The index loaded by havePlayed spares swissPairings the pairs query
+        configureMetrics()
+        try:
+            swissPairings(tournament)
+            if any(function == 'swissPairings' and 'played_pairs' in statement
+                   for function, statement in queryStats()['queries']):
+                raise ValueError("swissPairings should use the played-pairs index")
+        finally:
+            configureMetrics(False)
+        # Another process reports round 2 through a connection of its own
+        conn, cur = connect()
+        try:
+            with conn:
+                cur.executemany(
+                    'INSERT INTO matches(tournament_id, player_a_id, player_b_id, winner_id) '
+                    'VALUES (%s, %s, %s, %s)',
+                    [(tournament, a, b, a) for a, _, b, _ in swissPairings(tournament)])
+        finally:
+            conn.close()
+        played = set(pairKey(a, b) for a, b, _ in tournamentMatches(tournament))
+        pairings = swissPairings(tournament)
+        if any(pairKey(a, b) in played for a, _, b, _ in pairings):
+            raise ValueError("swissPairings should see the reports of other connections")
+        for a, _, b, _ in pairings:
+            reportMatch(a, b, a, tournament)
+        invalidateCache(tournament)
+        if not all(havePlayed(tournament, a, b) for a, b in played):
+            raise ValueError("havePlayed should see other connections' reports once invalidated")
+    finally:
+        configureCache(None)
+    print "38. swissPairings uses the index and sees reports made through other connections"
+
+
+def testLoadTest(tournament):
+    from load_test import EventDay, percentile
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    registerPlayers(["Player %d" % i for i in xrange(7)], (tournament,))
+    day = EventDay([tournament], rounds=3, reads=2, draws=0.5, seed=1)
+    day.run(4)
+    if any(day.errors.values()):
+        raise ValueError("The load test should play without errors: %s" % day.errors)
+    calls = dict((op, len(latencies)) for op, latencies in day.latencies.items())
+    if calls != {'swissPairings': 3, 'reportMatch': 9, 'reportBye': 3, 'playerStandings': 18}:
+        raise ValueError("The load test should pair, report and read every round: %s" % calls)
+    if len(tournamentMatches(tournament)) != 9 or len(tournamentByes(tournament)) != 3:
+        raise ValueError("The load test should store every result")
+    if [percentile(range(1, 101), q) for q in (0.5, 0.95, 0.99)] != [50, 95, 99]:
+        raise ValueError("Percentiles should be taken by the nearest rank")
+    print "37. The load test plays every round of a tournament"
+
+
+def testPython3(tournament):
+    import subprocess
+    # async_tournament.py and bench_async.py use pairing.py, and the
+    # latter tournament.py, from Python 3
+    script = """
+import sys
+from pairing import pairPlayers
+# The greedy pass pairs 1-2 and leaves 3-4, a rematch: the blossom
+# search has to re-pair
+pairs, bye = pairPlayers([1, 2, 3, 4], played={(3, 4)})
+assert sorted(pairs) == [(1, 3), (2, 4)], pairs
+if sys.argv[1:] == ['db']:
+    import tournament
+    with tournament.Session(commit=False) as session:
+        values = tournament._values(session.cursor(), '(%s, %s)', [(1, 'a'), (2, None)])
+    assert values == "(1, 'a'),(2, NULL)", values
+"""
+    args = ['db'] if getBackend() is None else []
+    try:
+        subprocess.check_call(['python3', '-c', script] + args)
+    except OSError:
+        print "39. Skipped Python 3 checks: no python3"
+        return
+    print "39. Pairing and multi-row inserts work on Python 3"
+
+
+def testAsync(tournament):
+    if getBackend() is not None:
+        print "40. Skipped asyncio: async_tournament.py runs on PostgreSQL"
+        return
+    import subprocess
+    deleteMatches(tournament)
+    deletePlayers()
+    deleteTournamentPlayers()
+    script = """
+import asyncio
+import sys
+try:
+    import aiopg
+except ImportError:
+    sys.exit(3)
+from psycopg2.extensions import TransactionRollbackError
+import async_tournament as at
+
+async def main(t):
+    a = await at.registerPlayer('A', [t])
+    b = await at.registerPlayer('B', [t])
+    # The first attempt loses a deadlock and is retried
+    select = at._select
+    deadlocks = [TransactionRollbackError('deadlock detected')]
+    async def deadlocking(query, vals=()):
+        if deadlocks:
+            raise deadlocks.pop()
+        return await select(query, vals)
+    at._select = deadlocking
+    try:
+        await at.reportMatch(a, b, a, t)
+    finally:
+        at._select = select
+    standings = await at.playerStandings(t)
+    assert [row[:3] for row in standings] == [(a, 'A', 1), (b, 'B', 0)], standings
+    try:
+        await at.reportMatch(b, a, b, t)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('A rematch should raise ValueError')
+    await at.closePool()
+
+asyncio.run(main(int(sys.argv[1])))
+"""
+    try:
+        code = subprocess.call(['python3', '-c', script, str(tournament)])
+    except OSError:
+        print "40. Skipped asyncio: no python3"
+        return
+    if code == 3:
+        print "40. Skipped asyncio: aiopg is not installed"
+        return
+    if code:
+        raise ValueError("async_tournament should report matches and read standings")
+    if len(tournamentMatches(tournament)) != 1:
+        raise ValueError("async_tournament should store the match once")
+    print "40. async_tournament reports matches, retrying deadlocks, and reads standings"
+
+
 def testMultipleTournaments():
 
     deletePlayers()
@@ -375,8 +1321,78 @@ def testMultipleTournaments():
     print "16. Players in multiple tournaments scored correctly"
 
 
+def _testRegisterDeleteUnlocked(tournament):
+    # Another connection registers and deletes a tournament while this
+    # one reads the matches of another: neither waits for the other
+    from tournament import _DELETE_TOURNAMENT
+    with Session(commit=False):
+        tournamentMatches(tournament)
+        conn, cur = connect()
+        try:
+            with conn:
+                cur.execute("SET LOCAL lock_timeout = '2s'")
+                cur.execute("INSERT INTO tournaments(name) VALUES ('t2') RETURNING id")
+                other = cur.fetchone()[0]
+                for statement in _DELETE_TOURNAMENT['tournaments']:
+                    cur.execute(statement, {'t': other})
+        finally:
+            conn.close()
+
+
+def testDeleteTournament():
+    deleteTournaments()
+    deletePlayers()
+    t0 = registerTournament('t0')
+    t1 = registerTournament('t1')
+    (id1, id2, id3, id4) = registerPlayers(['P1', 'P2', 'P3', 'P4'], (t0, t1))
+    for t in (t0, t1):
+        reportMatch(id1, id2, id1, t)
+        reportMatch(id3, id4, None, t)
+    reportBye(id1, t0)
+    standings = playerStandings(t1)
+
+    deleteTournaments(t0)
+    if tournamentName(t0) is not None or tournamentMatches(t0) or playerStandings(t0):
+        raise ValueError("Deleting a tournament should remove it with its matches")
+    if playerStandings(t1) != standings or countPlayers() != 4:
+        raise ValueError("Deleting a tournament should keep the others and the players")
+    try:
+        registerPlayerToTournament(id1, t0)
+    except IntegrityError:
+        pass
+    else:
+        raise ValueError("Registering to a deleted tournament should raise IntegrityError")
+    for t in (t0, t1 + 1000):
+        try:
+            reportMatch(id1, id3, id1, t)
+        except ValueError:
+            pass
+        else:
+            raise ValueError("Reporting to a tournament that doesn't exist should raise ValueError")
+
+    deleteMatches(t1)
+    if [row[2:] for row in playerStandings(t1)] != [(0, 0, 0, 0)] * 4:
+        raise ValueError("Deleting matches should reset the standings")
+    if rebuildStandings(t1, check_only=True):
+        raise ValueError("Running standings should match after deleting matches")
+    reportMatch(id1, id2, id2, t1)
+    if getBackend() is None:
+        _testRegisterDeleteUnlocked(t1)
+
+    resetAll()
+    if countPlayers() != 0 or tournamentName(t1) is not None:
+        raise ValueError("resetAll should remove all players and tournaments")
+    print "34. Tournaments can be deleted one at a time, or reset all at once"
+
+
 if __name__ == '__main__':
 
+    # ./tournament_test.py --memory runs the tests on the in-memory backend
+    if '--memory' in sys.argv[1:]:
+        from memory_backend import MemoryBackend
+        useBackend(MemoryBackend())
+        print 'Using the in-memory backend'
+
     deleteTournaments()
 
     for i in xrange(3):
@@ -395,10 +1411,34 @@ if __name__ == '__main__':
         testReportSelfMatchesRaisesIntegrityError(tid)
         testReportMatchesBadWinnerRaisesIntegrityError(tid)
         testReportMatchesWithDraws(tid)
-        testOddNumberPairingsRaisesValueError(tid)
+        testOddNumberPairingsGiveBye(tid)
         testRegisterPlayerToTournament(tid)
         testRegisterDuplicatePlayerToTournamentRaises(tid)
+        testSession(tid)
+        testRegisterPlayers(tid)
+        testReportMatchesBatch(tid)
+        testRebuildStandings(tid)
+        testStandingsCache(tid)
+        testPairingsAvoidRematches(tid)
+        testSimulateTournament(tid)
+        testStandingsPages(tid)
+        testQueryMetrics(tid)
+        testPreparedStatements(tid)
+        testTiebreaks(tid)
+        testManyTournaments(tid)
+        testRounds(tid)
+        testArchive(tid)
+        testWriteBuffer(tid)
+        testRatings(tid)
+        testConcurrentReports(tid)
+        testReadReplicas(tid)
+        testPlayedPairs(tid)
+        testLoadTest(tid)
+        testPairingsSeeOtherConnections(tid)
+        testPython3(tid)
+        testAsync(tid)
         print "Success!  All tests pass for tournament %d!" % tid, '\n'
 
     testMultipleTournaments()
+    testDeleteTournament()
     print "Success!  All tests pass!"
@@ -0,0 +1,292 @@
+#!/usr/bin/env python
+'''write_buffer.py -- journaled write-behind buffer of match results
+
+Results are validated against in-memory sets of registered players and
+played pairs, appended to a local journal file and kept in memory until
+they are written to storage as one group, when enough have accumulated,
+when the oldest has waited long enough, or when flush is called.
+
+Writes are made outside the lock that guards the buffered results, so
+that results keep being buffered, and other threads keep going, while a
+group is written. After each successful write the journal is replaced by
+one holding only the results buffered meanwhile. Results found in it when
+a buffer is created, left by a process that stopped before writing them,
+are written on the first flush. Some may already have been written if the
+process stopped between the write and the replacement: those are
+rejected as rematches.
+
+'''
+
+import logging
+import os
+import threading
+import time
+
+from psycopg2 import IntegrityError
+
+from pairing import pairKey
+
+_log = logging.getLogger('tournament')
+
+
+class ResultBuffer(object):
+    '''Buffer of (tournament, player_a, player_b, winner) results
+
+    Args:
+        journal: path of the journal file, created if needed.
+        load: load(tournament) returns the set of players registered in
+              tournament and the set of pairKeys already played in it.
+        write: write(groups) stores, in one transaction, the results of
+               a dict of tournament to a list of (player_a, player_b,
+               winner) tuples, except for those it rejects. It returns
+               the list of (tournament, (player_a, player_b, winner),
+               reason) of the rejected results.
+        max_size: number of buffered results that triggers a write.
+        max_delay: seconds a result may wait before it is written. None
+                   only writes by size and on flush.
+        sync: fsync the journal before add returns. Concurrent adds share
+              one fsync. Without it, results survive a crash of the
+              process but not of the machine.
+    '''
+
+    def __init__(self, journal, load, write, max_size=500, max_delay=0.5, sync=True):
+        if max_size < 1:
+            raise ValueError('Invalid buffer size %s' % max_size)
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.sync = sync
+        self._load = load
+        self._write = write
+        # Guards the buffered results, the state and the journal. Never
+        # held while writing.
+        self._lock = threading.RLock()
+        # Serializes writes, and so the replacements of the journal
+        self._write_lock = threading.Lock()
+        # Serializes fsyncs of the journal and its replacements. Taken
+        # before _lock, never while holding it.
+        self._sync_lock = threading.Lock()
+        self._appended = 0      # lines appended to the journal
+        self._synced = 0        # of which known to be on disk
+        self._writer = None     # ident of the thread writing, if any
+        self._pending = self._recover(journal)
+        self._writing = []      # results of the write in progress
+        self._oldest = time.time() if self._pending else None
+        self._state = {}    # tournament -> (registered players, played pairs)
+        self._forgets = 0   # calls of forget, to discard loads they overtook
+        self._path = journal
+        self._journal = open(journal, 'a')
+        self._closed = threading.Event()
+        self._flusher = None
+        if max_delay is not None:
+            self._flusher = threading.Thread(target=self._flushPeriodically,
+                                             name='ResultBuffer flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    @staticmethod
+    def _recover(journal):
+        '''Return the results left in journal, skipping a torn last line'''
+        if not os.path.exists(journal):
+            return []
+        pending = []
+        with open(journal) as f:
+            for line in f:
+                if not line.endswith('\n'):
+                    break
+                t, a, b, w = line.split()
+                pending.append((int(t), int(a), int(b), None if w == '-' else int(w)))
+        return pending
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, tournament, player_a, player_b, winner=None):
+        """Validate a result and buffer it.
+
+        Raises:
+            ValueError if players already played each other in this
+            tournament, counting buffered results.
+            ValueError if either player isn't registered in the tournament.
+            IntegrityError if player_a == player_b.
+            IntegrityError if winner is not player_a or player_b or None.
+        """
+        # Imported here: tournament.py imports this module
+        from tournament import _MATCH_CONSTRAINT_ERRORS
+        if player_a == player_b or winner not in (player_a, player_b, None):
+            raise IntegrityError('new row for relation "matches" violates check constraint')
+        values = {'a': player_a, 'b': player_b, 't': tournament}
+        while True:
+            state = self._stateOf(tournament)
+            with self._lock:
+                if self._state.get(tournament) is not state:
+                    # Forgotten since it was loaded
+                    continue
+                registered, played = state
+                if player_a not in registered or player_b not in registered:
+                    raise ValueError(_MATCH_CONSTRAINT_ERRORS['matches_player_a_registered'] % values)
+                pair = pairKey(player_a, player_b)
+                if pair in played:
+                    raise ValueError(_MATCH_CONSTRAINT_ERRORS['matches_pairing_unique'] % values)
+                self._journal.write(self._line((tournament, player_a, player_b, winner)))
+                self._journal.flush()
+                self._appended += 1
+                appended = self._appended
+                played.add(pair)
+                self._pending.append((tournament, player_a, player_b, winner))
+                if self._oldest is None:
+                    self._oldest = time.time()
+                full = len(self._pending) >= self.max_size
+                break
+        if self.sync:
+            self._syncJournal(appended)
+        if full:
+            self.flush()
+
+    def _syncJournal(self, appended):
+        '''Return once the first appended lines of the journal are on disk
+
+        Group commit: the thread that gets the sync lock fsyncs every line
+        appended so far, and those waiting behind it find theirs synced.
+        '''
+        with self._sync_lock:
+            if self._synced >= appended:
+                return
+            with self._lock:
+                target = self._appended
+                self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._synced = target
+
+    @staticmethod
+    def _line(result):
+        t, a, b, w = result
+        return '%d %d %d %s\n' % (t, a, b, '-' if w is None else w)
+
+    def _stateOf(self, tournament):
+        '''Return the (registered players, played pairs) of tournament
+
+        Loads them if needed without holding the lock, which flushes
+        need: load may wait for a connection and a query.
+        '''
+        while True:
+            with self._lock:
+                state = self._state.get(tournament)
+                if state is not None:
+                    return state
+                forgets = self._forgets
+            registered, played = self._load(tournament)
+            with self._lock:
+                state = self._state.get(tournament)
+                if state is not None:
+                    # Loaded by another thread meanwhile
+                    return state
+                if forgets != self._forgets:
+                    # A write or another change may be missing: load again
+                    continue
+                played = set(played)
+                # Those being written may not be committed yet
+                played.update(pairKey(a, b) for t, a, b, _ in self._writing + self._pending
+                              if t == tournament)
+                state = self._state[tournament] = (set(registered), played)
+                return state
+
+    def forget(self, tournament=None):
+        '''Drop the registrations and pairs loaded for a tournament (all if
+        None), after they were changed by other means'''
+        with self._lock:
+            self._forgets += 1
+            if tournament is None:
+                self._state.clear()
+            else:
+                self._state.pop(tournament, None)
+
+    def flush(self, wait=True):
+        """Write all buffered results, as one group.
+
+        Results that the write rejects, such as pairs reported meanwhile
+        by another process, are dropped and logged. Only one thread
+        writes at a time; results buffered during a write are left for
+        the next flush.
+
+        Args:
+            wait: if False and another thread is writing, return at once
+                  instead of waiting for it, as callers holding a pooled
+                  connection should: the writer may be waiting for one.
+
+        Returns:
+            List of (tournament, (player_a, player_b, winner), reason) of
+            the rejected results.
+
+        Raises:
+            Errors of write, other than rejections. The results stay
+            buffered and journaled, and are retried by the next flush.
+        """
+        if self._writer == threading.current_thread().ident:
+            # Called by write itself, through the functions it uses
+            return []
+        if not self._write_lock.acquire(wait):
+            return []
+        try:
+            self._writer = threading.current_thread().ident
+            with self._lock:
+                if not self._pending:
+                    return []
+                pending, self._pending = self._pending, []
+                self._writing = pending
+                oldest, self._oldest = self._oldest, None
+            groups = {}
+            for t, a, b, w in pending:
+                groups.setdefault(t, []).append((a, b, w))
+            try:
+                rejected = self._write(groups)
+            except BaseException:
+                with self._lock:
+                    self._pending = pending + self._pending
+                    self._oldest = oldest
+                raise
+            finally:
+                with self._lock:
+                    self._writing = []
+            with self._sync_lock:
+                with self._lock:
+                    self._replaceJournal()
+        finally:
+            self._writer = None
+            self._write_lock.release()
+        for t, entry, reason in rejected:
+            _log.error('Buffered result %s of tournament %s rejected: %s', entry, t, reason)
+        return rejected
+
+    def _replaceJournal(self):
+        '''Replace the journal by one holding the pending results only'''
+        replacement = self._path + '.new'
+        with open(replacement, 'w') as f:
+            f.writelines(self._line(result) for result in self._pending)
+            f.flush()
+            if self.sync:
+                os.fsync(f.fileno())
+        os.rename(replacement, self._path)
+        self._journal.close()
+        self._journal = open(self._path, 'a')
+        # The replacement was synced
+        self._synced = self._appended
+
+    def _flushPeriodically(self):
+        while not self._closed.wait(self.max_delay / 2.0):
+            oldest = self._oldest
+            if oldest is None or time.time() - oldest < self.max_delay:
+                continue
+            try:
+                self.flush()
+            except Exception:
+                _log.exception('Flushing buffered results failed')
+
+    def close(self):
+        '''Flush and stop the periodic writes. The journal is kept.'''
+        self._closed.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        try:
+            self.flush()
+        finally:
+            self._journal.close()